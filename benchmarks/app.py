@@ -0,0 +1,135 @@
+"""Application, contexts and scenarios used by the benchmark runner."""
+
+from os import path
+
+from flask import Flask
+from flaskext.genshi import Genshi
+from genshi.filters import Transformer, Translator
+
+
+TEMPLATES = path.join(path.dirname(__file__), 'templates')
+
+
+def create_app():
+    app = Flask(__name__)
+    Genshi(app)
+    return app
+
+
+def make_context(size):
+    """Build a template context; ``'large'`` contexts have many rows as well
+    as many unrelated names to exercise context construction."""
+    rows = 10 if size == 'small' else 2000
+    context = dict(
+        title='Benchmark & <friends>',
+        rows=[dict(id=i, name='Item %d' % i, tags=['a', 'b'][:i % 3])
+              for i in xrange(rows)],
+    )
+    if size == 'large':
+        for i in xrange(1000):
+            context['unused_%d' % i] = i
+    return context
+
+
+def setup_filters(genshi):
+    @genshi.filter('html')
+    def add_class(stream):
+        return stream | Transformer('body/h1').attr('class', 'title')
+
+    @genshi.filter('html')
+    def strip_links(stream):
+        return stream | Transformer('body//a').unwrap()
+
+    @genshi.filter('html')
+    def passthrough(stream, context):
+        return stream
+
+
+def setup_translator(genshi):
+    @genshi.template_parsed
+    def callback(template):
+        Translator(lambda s: s.upper()).setup(template)
+
+
+def setup_compiled(genshi):
+    genshi.app.config['GENSHI_COMPILE'] = True
+
+
+def setup_flatland(genshi):
+    from flatland.out.genshi import setup
+    @genshi.template_parsed
+    def callback(template):
+        setup(template)
+
+
+def flatland_context(size):
+    from flatland import Form, String
+    class SignupForm(Form):
+        username = String
+        email = String
+        password = String
+        about = String
+    return dict(form=SignupForm({'username': 'dag', 'about': 'Hello'}))
+
+
+class Scenario(object):
+    """One benchmark: a template rendered with one method and context."""
+
+    def __init__(self, name, template, method=None, size='small',
+                 string=False, setup=None, context=make_context):
+        self.name = name
+        self.template = template
+        self.method = method
+        self.size = size
+        self.string = string
+        self.setup = setup
+        self.context = context
+
+    def prepare(self):
+        """Create a fresh application for this scenario and return it with
+        the keyword arguments for
+        :func:`~flaskext.genshi.render_template`."""
+        app = create_app()
+        if self.setup is not None:
+            self.setup(app.extensions['genshi'])
+        kwargs = dict(context=self.context(self.size), method=self.method)
+        if self.string:
+            with open(path.join(TEMPLATES, self.template)) as source:
+                kwargs['string'] = source.read()
+        else:
+            kwargs['template'] = self.template
+        return app, kwargs
+
+
+METHODS = [
+    ('html', 'page.html'),
+    ('html5', 'page.html'),
+    ('xhtml', 'page.html'),
+    ('xml', 'page.xml'),
+    ('svg', 'chart.svg'),
+    ('text', 'report.txt'),
+    ('js', 'data.js'),
+    ('css', 'theme.css'),
+]
+
+
+def scenarios():
+    for method, template in METHODS:
+        for size in ('small', 'large'):
+            yield Scenario('%s-%s' % (method, size), template, method, size)
+        yield Scenario('%s-string' % method, template, method, string=True)
+    for size in ('small', 'large'):
+        yield Scenario('layout-%s' % size, 'layout_page.html', size=size)
+        yield Scenario('filters-%s' % size, 'page.html', size=size,
+                       setup=setup_filters)
+        yield Scenario('translator-%s' % size, 'i18n.html', size=size,
+                       setup=setup_translator)
+        yield Scenario('compiled-%s' % size, 'page.html', 'html', size,
+                       setup=setup_compiled)
+    try:
+        import flatland
+    except ImportError:
+        pass
+    else:
+        yield Scenario('flatland', 'form.html', setup=setup_flatland,
+                       context=flatland_context)
@@ -0,0 +1,180 @@
+"""Benchmark every rendering method and integration.
+
+Run from the repository root::
+
+    python -m benchmarks.run                 # compare with the baseline
+    python -m benchmarks.run --save          # record a new baseline
+    python -m benchmarks.run html layout     # only matching scenarios
+
+Each scenario renders with :func:`~flaskext.genshi.render_template` in a
+fresh application, after one warm-up render so the template is parsed and
+cached. Throughput is reported in renders per second. Memory is reported as
+the growth of the peak resident set while rendering, measured in a forked
+process so scenarios don't share a high-water mark, and as the peak traced
+allocation when :mod:`tracemalloc` is available.
+
+Scenarios whose throughput falls more than ``--threshold`` below the
+baseline are reported as regressions and make the runner exit with status 1.
+Baselines are only meaningful on the machine that recorded them.
+"""
+
+from __future__ import with_statement
+
+import gc
+import json
+import os
+import sys
+from optparse import OptionParser
+from os import path
+from time import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from flaskext.genshi import render_template
+
+from benchmarks.app import scenarios
+
+
+BASELINE = path.join(path.dirname(__file__), 'baseline.json')
+
+
+def maxrss():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(scenario, min_time):
+    """Render *scenario* repeatedly for at least *min_time* seconds."""
+    app, kwargs = scenario.prepare()
+    with app.test_request_context():
+        render_template(**kwargs)
+        gc.collect()
+        result = dict(peak_kb=None, traced_kb=None)
+        before = maxrss()
+        if tracemalloc is not None:
+            tracemalloc.start()
+            render_template(**kwargs)
+            result['traced_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+            tracemalloc.stop()
+        loops, elapsed, batch = 0, 0.0, 1
+        while elapsed < min_time:
+            started = time()
+            for _ in xrange(batch):
+                render_template(**kwargs)
+            elapsed += time() - started
+            loops += batch
+            batch *= 2
+        if before is not None:
+            result['peak_kb'] = maxrss() - before
+        result['renders'] = loops / elapsed
+        return result
+
+
+def measure_isolated(scenario, min_time):
+    """Run :func:`measure` in a child process when the platform can fork."""
+    if not hasattr(os, 'fork'):
+        return measure(scenario, min_time)
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        status = 0
+        try:
+            try:
+                payload = measure(scenario, min_time)
+            except Exception, e:
+                payload = dict(error='%s: %s' % (type(e).__name__, e))
+                status = 1
+            os.write(write, json.dumps(payload))
+        finally:
+            os._exit(status)
+    os.close(write)
+    chunks = []
+    while True:
+        chunk = os.read(read, 4096)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read)
+    os.waitpid(pid, 0)
+    result = json.loads(''.join(chunks))
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    return result
+
+
+def report(results, baseline, threshold):
+    """Print a table of *results* against *baseline* and return the names of
+    regressed scenarios."""
+    regressions = []
+    print '%-20s %12s %9s %9s %12s %8s' % (
+        'scenario', 'renders/s', 'peak KB', 'traced KB', 'baseline', 'change')
+    for name, result in results:
+        reference = baseline.get(name, {}).get('renders')
+        change = ''
+        if reference:
+            ratio = result['renders'] / reference - 1
+            change = '%+.1f%%' % (ratio * 100)
+            if ratio < -threshold:
+                regressions.append(name)
+                change += ' !'
+        print '%-20s %12.1f %9s %9s %12s %8s' % (
+            name, result['renders'],
+            '-' if result['peak_kb'] is None else result['peak_kb'],
+            '-' if result['traced_kb'] is None else result['traced_kb'],
+            '-' if reference is None else '%.1f' % reference,
+            change)
+    return regressions
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('--time', type='float', default=1.0,
+                      help='minimum seconds to spend on each scenario')
+    parser.add_option('--baseline', default=BASELINE,
+                      help='baseline file to compare with or save to')
+    parser.add_option('--threshold', type='float', default=0.2,
+                      help='slowdown relative to the baseline that counts '
+                           'as a regression (default 0.2, i.e. 20%)')
+    parser.add_option('--save', action='store_true',
+                      help='save the results as the new baseline')
+    options, names = parser.parse_args(argv)
+
+    results = []
+    for scenario in scenarios():
+        if names and not any(name in scenario.name for name in names):
+            continue
+        results.append((scenario.name,
+                        measure_isolated(scenario, options.time)))
+
+    baseline = {}
+    if path.exists(options.baseline):
+        with open(options.baseline) as fp:
+            baseline = json.load(fp)
+    regressions = report(results, baseline, options.threshold)
+
+    if options.save:
+        baseline.update(results)
+        with open(options.baseline, 'w') as fp:
+            json.dump(baseline, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+        return 0
+    if regressions:
+        print
+        print 'Regressed by more than %d%%: %s' % (
+            options.threshold * 100, ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
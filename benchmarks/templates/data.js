@@ -0,0 +1,6 @@
+var title = "$title";
+var rows = [
+{% for row in rows %}\
+  {id: ${row.id}, name: "${row.name}", tags: ${len(row.tags)}},
+{% end %}\
+];
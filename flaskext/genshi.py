@@ -11,24 +11,3161 @@
 
 from __future__ import absolute_import
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from copy import copy
+from itertools import chain, count
+from cStringIO import StringIO
+from functools import partial
+from hashlib import sha1
+from Queue import Queue, Full
+from types import (CodeType, ModuleType, FunctionType, MethodType,
+                   BuiltinFunctionType)
+import ast
+import cPickle as pickle
+import errno
+import imp
+import marshal
 import os.path
+import platform
+import re
+import sys
+import tempfile
+import zlib
+from time import time
+from traceback import format_exc
 from warnings import warn
-from inspect import getargspec
+from inspect import getargspec, ismethod
+from weakref import WeakKeyDictionary
 
-from genshi.template import (NewTextTemplate, MarkupTemplate,
-                             loader, TemplateLoader)
-from werkzeug import cached_property
-from flask import current_app
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
+from genshi import __version__ as genshi_version
+from genshi.template import (NewTextTemplate, MarkupTemplate, Context,
+                             loader, Template, TemplateLoader,
+                             TemplateSyntaxError)
+from genshi.template.base import (DirectiveFactory, TemplateError,
+                                  TemplateRuntimeError, _apply_directives,
+                                  _eval_expr, EXEC, EXPR, INCLUDE, SUB)
+from genshi.template.directives import (Directive, AttrsDirective,
+                                        ChooseDirective, DefDirective,
+                                        ForDirective, IfDirective,
+                                        MatchDirective, OtherwiseDirective,
+                                        StripDirective, WhenDirective,
+                                        WithDirective)
+from genshi.template.eval import BUILTINS, CONSTANTS, Code
+from genshi.template.loader import TemplateNotFound
+from genshi.core import (Stream, Markup, QName, Attrs, START, END, TEXT,
+                         COMMENT, PI, DOCTYPE, XML_DECL, START_NS, END_NS,
+                         START_CDATA, END_CDATA, escape, _ensure)
+from genshi.output import (DocType, XMLSerializer, XHTMLSerializer,
+                           HTMLSerializer, TextSerializer)
+from genshi.filters.transform import Transformer, ATTR, BREAK, OUTSIDE
+from genshi.path import ATTRIBUTE, LocalNameTest, QualifiedNameTest
+from genshi.util import LRUCache
+from werkzeug.contrib.cache import BaseCache
+from flask import current_app, request, _request_ctx_stack
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+try:
+    from flask.module import blueprint_is_module
+except ImportError:
+    def blueprint_is_module(blueprint):
+        return not hasattr(blueprint, 'template_folder')
+
+try:
+    from flask import stream_with_context
+except ImportError:
+    stream_with_context = None
+
+try:
+    from flask import _app_ctx_stack
+except ImportError:
+    _app_ctx_stack = None
+
+try:
+    from flask import signals_available
+except ImportError:
+    signals_available = False
+else:
+    from flask.signals import Namespace
+    signals = Namespace()
+    template_generated = signals.signal('template-generated')
+    before_render = signals.signal('before-render')
+    after_render = signals.signal('after-render')
+
+
+def _string_template(cls, source):
+    """Parse a `cls` template from a `source` string. As the template has
+    no file path, the digest of its source identifies it to the
+    ``cache:fragment`` directive."""
+    template = cls(source)
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    template.source_digest = sha1(source).hexdigest()
+    _add_directives(template)
+    _context_names(template)
+    return template
+
+
+class TemplateCache(object):
+    """A thread-safe least-recently-used cache of compiled templates,
+    keyed by template class and source. Used by :func:`generate_template`
+    so that templates rendered from strings are only parsed once.
+
+    A `capacity` of ``0`` disables caching.
+
+    .. versionadded:: 0.6
+
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._cache = LRUCache(capacity)
+        self._lock = threading.Lock()
+
+        #: Number of lookups that found a compiled template.
+        self.hits = 0
+
+        #: Number of lookups that had to compile the template.
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def load(self, cls, source):
+        """Return a `cls` template compiled from `source`, compiling and
+        caching it if it was not already cached.
+
+        """
+        if not self.capacity:
+            self.misses += 1
+            return _string_template(cls, source)
+        key = (cls, source)
+        self._lock.acquire()
+        try:
+            try:
+                template = self._cache[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                return template
+        finally:
+            self._lock.release()
+        template = _string_template(cls, source)
+        self._lock.acquire()
+        try:
+            self._cache[key] = template
+        finally:
+            self._lock.release()
+        return template
+
+    def clear(self):
+        """Empty the cache and reset the counters."""
+        self._lock.acquire()
+        try:
+            self._cache = LRUCache(self.capacity)
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+
+class RenderStats(object):
+    """A registry of the time spent in each phase of rendering templates,
+    keeping the last `samples` timings of each phase by template. See
+    :func:`render_template` for the phases.
+
+    .. versionadded:: 0.6
+
+    """
+
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self._timings = {}
+        self._loads = {}
+        self._lock = threading.Lock()
+
+    def record(self, template, timings):
+        """Record the `timings` of a render of `template`."""
+        self._lock.acquire()
+        try:
+            phases = self._timings.setdefault(template, {})
+            for phase, value in timings.iteritems():
+                if phase == 'loader':
+                    loads = self._loads.setdefault(template,
+                                                   {'hit': 0, 'miss': 0})
+                    loads[value] += 1
+                    continue
+                if phase not in phases:
+                    phases[phase] = deque(maxlen=self.samples)
+                phases[phase].append(value)
+        finally:
+            self._lock.release()
+
+    def percentile(self, template, phase, percent):
+        """The `percent` percentile of the recorded values of `phase` for
+        `template`, or ``None`` if there are none.
+
+        """
+        self._lock.acquire()
+        try:
+            values = sorted(self._timings.get(template, {}).get(phase, ()))
+        finally:
+            self._lock.release()
+        if not values:
+            return None
+        index = int(round(percent / 100.0 * (len(values) - 1)))
+        return values[index]
+
+    def summary(self):
+        """A dict of dicts of the recorded count, mean, median, 90th and
+        99th percentile and maximum value of each phase, by template and
+        phase. Template loader hits and misses are under ``loader``.
+
+        """
+        self._lock.acquire()
+        try:
+            timings = dict((template, dict((phase, sorted(values))
+                                           for phase, values
+                                           in phases.iteritems()))
+                           for template, phases in self._timings.iteritems())
+            loads = dict((template, dict(counts))
+                         for template, counts in self._loads.iteritems())
+        finally:
+            self._lock.release()
+        summary = {}
+        for template, phases in timings.iteritems():
+            summary[template] = phase_summary = {}
+            for phase, values in phases.iteritems():
+                last = len(values) - 1
+                phase_summary[phase] = {
+                    'count': len(values),
+                    'mean': sum(values) / float(len(values)),
+                    'p50': values[int(round(0.5 * last))],
+                    'p90': values[int(round(0.9 * last))],
+                    'p99': values[int(round(0.99 * last))],
+                    'max': values[-1],
+                }
+            if template in loads:
+                phase_summary['loader'] = loads[template]
+        return summary
+
+    def clear(self):
+        """Forget all recorded timings."""
+        self._lock.acquire()
+        try:
+            self._timings = {}
+            self._loads = {}
+        finally:
+            self._lock.release()
+
+
+class _TimedIterator(object):
+    """Iterator that keeps track of the time spent getting items from
+    `iterable`.
+
+    """
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.elapsed = 0.0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        started = time()
+        try:
+            return self.iterator.next()
+        finally:
+            self.elapsed += time() - started
+
+
+class LazyValue(object):
+    """A template context value that is computed by calling `function`
+    when a template first uses it in a render. Made with :func:`lazy`.
+
+    .. versionadded:: 0.6
+
+    """
+
+    __slots__ = ('function',)
+
+    def __init__(self, function):
+        self.function = function
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.function)
+
+
+class _LazyContext(Context):
+    """A :class:`~genshi.template.Context` that computes
+    :class:`LazyValue` values when they are looked up, once per context."""
+
+    def __init__(self, **data):
+        Context.__init__(self, **data)
+        self._computed = {}
+        self._match_templates = _MatchTemplates()
+
+    def __contains__(self, key):
+        for frame in self.frames:
+            if key in frame:
+                return True
+        return False
+
+    has_key = __contains__
+
+    def _find(self, key, default=None):
+        for frame in self.frames:
+            if key in frame:
+                value = frame[key]
+                if type(value) is LazyValue:
+                    try:
+                        value = self._computed[value]
+                    except KeyError:
+                        pending = value
+                        value = self._computed[pending] = pending.function()
+                return value, frame
+        return default, None
+
+    def get(self, key, default=None):
+        value, frame = self._find(key)
+        if frame is None:
+            return default
+        return value
+
+
+class _JinjaNamespace(object):
+    """A read-only namespace of the globals, filters and tests of a Jinja
+    environment, with tests prefixed by ``is``. Values are looked up in the
+    environment on each access, so changes to it are always seen."""
+
+    def __init__(self, env):
+        self.env = env
+
+    def __contains__(self, key):
+        env = self.env
+        return (key in env.globals or key in ('filters', 'tests') or
+                key in env.filters or
+                (key[:2] == 'is' and key[2:] in env.tests))
+
+    def __getitem__(self, key):
+        env = self.env
+        if key in env.globals:
+            return env.globals[key]
+        if key == 'filters':
+            return env.filters
+        if key == 'tests':
+            return env.tests
+        if key in env.filters:
+            return env.filters[key]
+        if key[:2] == 'is' and key[2:] in env.tests:
+            return env.tests[key[2:]]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        env = self.env
+        keys = set('is%s' % key for key in env.tests)
+        keys.update(env.filters, env.globals, ['filters', 'tests'])
+        return list(keys)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def isdisjoint(self, names):
+        return not any(name in self for name in names)
+
+
+#: Names that templates can look up without them being in their context.
+_PROVIDED_NAMES = (frozenset(BUILTINS) | CONSTANTS |
+                   frozenset(['defined', 'value_of', 'select']))
+
+#: Functions that look up names that can't be found by reading a template.
+_DYNAMIC_LOOKUPS = frozenset(['locals', 'globals', 'eval', 'execfile'])
+
+
+class _NameFinder(ast.NodeVisitor):
+    """Records in `names`, a :class:`_TemplateNames`, the names that Python
+    code of a template looks up without binding them first. Names the code
+    binds are added to `scope`."""
+
+    def __init__(self, names, scope):
+        self.names = names
+        self.scope = scope
+
+    def nested(self, *names):
+        scope = set(self.scope)
+        scope.update(name for name in names if name is not None)
+        return _NameFinder(self.names, scope)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            if node.id not in self.scope:
+                self.names.free.add(node.id)
+        elif isinstance(node.ctx, (ast.Store, ast.Param)):
+            self.scope.add(node.id)
+            self.names.bound.add(node.id)
+
+    def visit_Call(self, node):
+        func = node.func
+        if isinstance(func, ast.Name) and func.id not in self.scope:
+            if func.id in ('defined', 'value_of'):
+                if node.args and isinstance(node.args[0], ast.Str):
+                    self.names.free.add(node.args[0].s)
+                    self.names.optional.add(node.args[0].s)
+                else:
+                    self.names.complete = False
+            elif func.id in _DYNAMIC_LOOKUPS or (func.id == 'vars' and
+                                                 not node.args):
+                self.names.complete = False
+        self.generic_visit(node)
+
+    def visit_Lambda(self, node):
+        for default in node.args.defaults:
+            self.visit(default)
+        finder = self.nested(node.args.vararg, node.args.kwarg)
+        for arg in node.args.args:
+            finder.visit(arg)
+        finder.visit(node.body)
+
+    def visit_FunctionDef(self, node):
+        for expr in node.decorator_list + node.args.defaults:
+            self.visit(expr)
+        self.scope.add(node.name)
+        self.names.bound.add(node.name)
+        finder = self.nested(node.name, node.args.vararg, node.args.kwarg)
+        for arg in node.args.args:
+            finder.visit(arg)
+        for statement in node.body:
+            finder.visit(statement)
+
+    def visit_ClassDef(self, node):
+        for expr in node.decorator_list + node.bases:
+            self.visit(expr)
+        self.scope.add(node.name)
+        self.names.bound.add(node.name)
+        finder = self.nested()
+        for statement in node.body:
+            finder.visit(statement)
+
+    def visit_GeneratorExp(self, node):
+        finder = self.nested()
+        for generator in node.generators:
+            finder.visit(generator.iter)
+            finder.visit(generator.target)
+            for condition in generator.ifs:
+                finder.visit(condition)
+        if hasattr(node, 'key'):
+            finder.visit(node.key)
+            finder.visit(node.value)
+        else:
+            finder.visit(node.elt)
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp
+
+    def visit_Assign(self, node):
+        self.visit(node.value)
+        for target in node.targets:
+            self.visit(target)
+
+    def visit_AugAssign(self, node):
+        self.visit(node.value)
+        if isinstance(node.target, ast.Name):
+            if node.target.id not in self.scope:
+                self.names.free.add(node.target.id)
+        else:
+            self.visit(node.target)
+
+    def visit_For(self, node):
+        self.visit(node.iter)
+        self.visit(node.target)
+        for statement in node.body + node.orelse:
+            self.visit(statement)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.name == '*':
+                self.names.complete = False
+            name = alias.asname or alias.name.split('.')[0]
+            self.scope.add(name)
+            self.names.bound.add(name)
+
+    visit_ImportFrom = visit_Import
+
+    def visit_Exec(self, node):
+        self.names.complete = False
+        self.generic_visit(node)
+
+
+def _assigned_names(assign):
+    """The names bound by an assignment function of a Genshi directive."""
+    names = []
+    pending = [assign.func_defaults[0]]
+    while pending:
+        target = pending.pop()
+        if type(target) is tuple:
+            pending.extend(target)
+        elif target is not None:
+            names.append(target)
+    return names
+
+
+class _TemplateNames(object):
+    """The names that the expressions and code blocks of one parsed
+    `template` use, not counting the templates it includes. Names bound by
+    directives and code blocks are only free outside of their scope.
+
+    """
+
+    def __init__(self, template):
+        #: Names looked up in the context.
+        self.free = set()
+        #: Names only used through ``defined()`` and ``value_of()``.
+        self.optional = set()
+        #: Names bound anywhere in the template.
+        self.bound = set()
+        #: ``(href, cls, relative_to)`` of includes resolved when rendering.
+        self.includes = []
+        #: Whether all names could be found.
+        self.complete = True
+        self._events(template.stream, set())
+
+    def _code(self, code, scope):
+        _NameFinder(self, scope).visit(code.ast)
+
+    def _events(self, stream, scope):
+        for kind, data, pos in stream:
+            if kind is EXPR or kind is EXEC:
+                self._code(data, scope)
+            elif kind is START:
+                for name, value in data[1]:
+                    if type(value) is list:
+                        self._events(value, scope)
+            elif kind is SUB:
+                self._directives(data[0], data[1], set(scope))
+            elif kind is INCLUDE:
+                href, cls, fallback = data
+                if isinstance(href, basestring):
+                    self.includes.append((href, cls, pos[0]))
+                else:
+                    self.complete = False
+                    if type(href) is list:
+                        self._events(href, scope)
+                if fallback:
+                    self._events(fallback, scope)
+
+    def _directives(self, directives, stream, scope):
+        for directive in directives:
+            if isinstance(directive, DefDirective):
+                for expr in directive.defaults.itervalues():
+                    self._code(expr, scope)
+                names = [directive.name, directive.star_args,
+                         directive.dstar_args] + directive.args
+                names = [name for name in names if name is not None]
+                scope.update(names)
+                self.bound.update(names)
+                continue
+            if isinstance(directive, WithDirective):
+                for targets, expr in directive.vars:
+                    self._code(expr, scope)
+                    for assign in targets:
+                        names = _assigned_names(assign)
+                        scope.update(names)
+                        self.bound.update(names)
+                continue
+            for cls in type(directive).__mro__:
+                for slot in cls.__dict__.get('__slots__', ()):
+                    value = getattr(directive, slot, None)
+                    if isinstance(value, Code):
+                        self._code(value, scope)
+            module = type(directive).__module__
+            if isinstance(directive, ForDirective):
+                names = _assigned_names(directive.assign)
+                scope.update(names)
+                self.bound.update(names)
+            elif isinstance(directive, MatchDirective):
+                scope.add('select')
+            elif module == 'genshi.filters.i18n':
+                self.free.update(getattr(directive, 'params', None) or ())
+            elif module not in ('genshi.template.directives', __name__):
+                self.complete = False
+        self._events(stream, scope)
+
+
+def _context_names(template):
+    """Return the names that `template` and the templates it includes may
+    look up in their context, and the subset of them that must be in the
+    context, as two frozensets, or ``None`` for both if that can't be
+    determined, for example because a template includes a template with
+    an expression as path or calls :func:`locals`.
+
+    The first set is stored as the ``free_names`` attribute of `template`.
+    The result is kept with the template unless an included template may
+    be reloaded without it.
+
+    """
+    cached = template.__dict__.get('_context_names')
+    if cached is not None:
+        return cached
+    free, optional, bound = set(), set(), set()
+    complete = True
+    reloads = False
+    seen = set()
+    pending = [template]
+    while pending:
+        current = pending.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        names = current.__dict__.get('_names')
+        if names is None:
+            names = current._names = _TemplateNames(current)
+        free |= names.free
+        optional |= names.optional
+        bound |= names.bound
+        complete = complete and names.complete
+        if not names.includes:
+            continue
+        if current.loader is None:
+            complete = False
+            continue
+        reloads = reloads or current.loader.auto_reload
+        for href, cls, relative_to in names.includes:
+            try:
+                pending.append(current.loader.load(
+                    href, relative_to=relative_to,
+                    cls=cls or current.__class__))
+            except TemplateNotFound:
+                pass
+    if complete:
+        result = (frozenset(free),
+                  frozenset(free - optional - bound - _PROVIDED_NAMES))
+    else:
+        result = (None, None)
+    template.free_names = result[0]
+    if not reloads:
+        template._context_names = result
+    return result
+
+
+class MemoryCache(BaseCache):
+    """An in-process cache that keeps at most `capacity` items, discarding
+    the least recently used ones, for use with the fragment cache. Any
+    :class:`~werkzeug.contrib.cache.BaseCache` can be used in its place.
+
+    .. versionadded:: 0.6
+
+    """
+
+    def __init__(self, capacity=100, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.capacity = capacity
+        self._cache = LRUCache(capacity)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            try:
+                expires, value = self._cache[key]
+            except KeyError:
+                return None
+        finally:
+            self._lock.release()
+        if expires < time():
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        self._lock.acquire()
+        try:
+            self._cache[key] = (time() + timeout, value)
+        finally:
+            self._lock.release()
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is None:
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._cache:
+                self._cache[key] = (0, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache = LRUCache(self.capacity)
+        finally:
+            self._lock.release()
+
+
+class FragmentDirective(Directive):
+    """Implementation of the ``cache:fragment`` template directive, which
+    caches the rendered events of an element in
+    :attr:`Genshi.fragment_cache`, keyed by the value of an expression.
+
+    .. code-block:: html+genshi
+
+        <ul xmlns:cache="http://packages.python.org/Flask-Genshi/cache"
+            cache:fragment="'navigation', g.user.id">
+          ...
+        </ul>
+
+    As an element, a cache timeout in seconds can also be given:
+
+    .. code-block:: html+genshi
+
+        <cache:fragment key="'sidebar'" timeout="60">
+          ...
+        </cache:fragment>
+
+    .. versionadded:: 0.6
+
+    """
+
+    __slots__ = ['template', 'timeout', 'location']
+
+    def __init__(self, value, template=None, namespaces=None, lineno=-1,
+                 offset=-1):
+        Directive.__init__(self, value, template, namespaces, lineno, offset)
+        self.template = template
+        self.timeout = None
+        self.location = (template.filepath or
+                         getattr(template, 'source_digest', None),
+                         lineno, offset)
+
+    @classmethod
+    def attach(cls, template, stream, value, namespaces, pos):
+        timeout = None
+        if type(value) is dict:
+            timeout = value.get('timeout')
+            value = value.get('key')
+            if not value:
+                raise TemplateSyntaxError('missing required attribute "key"',
+                                          template.filepath, *pos[1:])
+        directive = cls(value, template, namespaces, *pos[1:])
+        if timeout:
+            directive.timeout = int(timeout)
+        return directive, stream
+
+    def __call__(self, stream, directives, ctxt, **vars):
+        cache = current_app.extensions['genshi'].fragment_cache
+        if cache is None:
+            return _apply_directives(stream, directives, ctxt, vars)
+        key = (self.location, _eval_expr(self.expr, ctxt, vars))
+        key = 'flask-genshi/fragment/%s' % sha1(repr(key)).hexdigest()
+        events = cache.get(key)
+        if events is None:
+            stream = _apply_directives(stream, directives, ctxt, vars)
+            events = list(self.template._flatten(stream, ctxt, **vars))
+            cache.set(key, events, self.timeout)
+        return events
+
+
+class CacheDirectives(DirectiveFactory):
+    """The directives in the :data:`CACHE_NAMESPACE`, added to every
+    markup template loaded by Flask-Genshi.
+
+    .. versionadded:: 0.6
+
+    """
+
+    directives = [('fragment', FragmentDirective)]
+
+    def get_directive_index(self, dir_cls):
+        # Cache the output of any other directives on the same element.
+        return -1
+
+
+#: The XML namespace of the :class:`CacheDirectives`.
+CACHE_NAMESPACE = 'http://packages.python.org/Flask-Genshi/cache'
+
+_cache_directives = CacheDirectives()
+
+
+def _add_directives(template):
+    """Add the Flask-Genshi directives and :func:`_match` filter to a newly
+    parsed `template`."""
+    if isinstance(template, MarkupTemplate):
+        template.add_directives(CACHE_NAMESPACE, _cache_directives)
+        index = template.filters.index(template._match)
+        template._match = template.filters[index] = MethodType(_match,
+                                                               template)
+    return template
+
+
+def _path_tags(path, namespaces):
+    """The tags of the elements that the ``py:match`` `path` can match, as
+    local and qualified names, or ``None`` if it can match other events or
+    depends on where they are in the stream."""
+    try:
+        return path._tags
+    except AttributeError:
+        pass
+    tags = set()
+    for steps in path.paths:
+        if len(steps) != 1:
+            tags = None
+            break
+        axis, test, predicates = steps[0]
+        if predicates or axis is ATTRIBUTE:
+            tags = None
+            break
+        if type(test) is LocalNameTest:
+            tags.add(test.name)
+        elif type(test) is QualifiedNameTest:
+            tags.add(QName('%s}%s' % (namespaces.get(test.prefix),
+                                      test.name)))
+        else:
+            tags = None
+            break
+    else:
+        tags = frozenset(tags)
+    path._tags = tags
+    return tags
+
+
+class _MatchTemplates(list):
+    """The match templates of a :class:`_LazyContext`. Knows which tags the
+    match templates in each range of the list can match, so :func:`_match`
+    only tests those that can, and counts the tests."""
+
+    def __init__(self, items=()):
+        list.__init__(self, items)
+        self._tags = {}
+
+        #: Number of match templates defined while rendering.
+        self.defined = len(self)
+
+        #: Number of times a match template was tested against an event.
+        self.tests = 0
+
+    def tags(self, start, end):
+        """The tags that the match templates from `start` to `end` can
+        match, or ``None`` if they can match any event."""
+        try:
+            return self._tags[start, end]
+        except KeyError:
+            pass
+        tags = set()
+        for entry in self[start:end]:
+            entry_tags = _path_tags(entry[1], entry[4])
+            if entry_tags is None:
+                tags = None
+                break
+            tags.update(entry_tags)
+        else:
+            tags = frozenset(tags)
+        self._tags[start, end] = tags
+        return tags
+
+    def append(self, entry):
+        list.append(self, entry)
+        self._tags = {}
+        self.defined += 1
+
+    def extend(self, entries):
+        entries = list(entries)
+        list.extend(self, entries)
+        self._tags = {}
+        self.defined += len(entries)
+
+    def _changed(name):
+        method = getattr(list, name)
+        def changed(self, *args):
+            self._tags = {}
+            return method(self, *args)
+        changed.__name__ = name
+        return changed
+
+    for name in ('__setitem__', '__delitem__', '__setslice__',
+                 '__delslice__', '__iadd__', '__imul__', 'insert', 'pop',
+                 'remove', 'reverse', 'sort'):
+        locals()[name] = _changed(name)
+    del _changed, name
+
+
+def _match(self, stream, ctxt, start=0, end=None, **vars):
+    """The filter that applies ``py:match`` templates, in place of
+    :meth:`MarkupTemplate._match <genshi.template.MarkupTemplate>`.
+
+    Genshi tests every match template against every start and end event.
+    This one passes on the events that none of the match templates can
+    match without testing them, which is most of them when the templates
+    match elements by name, as layouts do. Once the match templates with
+    ``once="true"`` have matched, the stream passes through untouched.
+
+    """
+    match_templates = ctxt._match_templates
+    if type(match_templates) is not _MatchTemplates:
+        return MarkupTemplate._match(self, stream, ctxt, start, end, **vars)
+    return _match_events(self, stream, ctxt, match_templates, start, end,
+                         vars)
+
+
+def _match_events(self, stream, ctxt, match_templates, start, end, vars):
+    def _strip(stream, append):
+        depth = 1
+        next = stream.next
+        while 1:
+            event = next()
+            if event[0] is START:
+                depth += 1
+            elif event[0] is END:
+                depth -= 1
+            if depth > 0:
+                yield event
+            else:
+                append(event)
+                break
+
+    tests = 0
+    try:
+        for event in stream:
+            kind = event[0]
+            if kind is not START and kind is not END:
+                yield event
+                continue
+
+            tags = match_templates.tags(start, end)
+            if tags is not None and (kind is END or
+                                     (event[1][0] not in tags and
+                                      event[1][0].localname not in tags)):
+                yield event
+                continue
+
+            for idx, (test, path, template, hints, namespaces, directives) \
+                    in enumerate(match_templates):
+                if idx < start or end is not None and idx >= end:
+                    continue
+
+                tests += 1
+                if test(event, namespaces, ctxt) is True:
+                    if 'match_once' in hints:
+                        del match_templates[idx]
+                        idx -= 1
+
+                    # Let the remaining match templates update their state.
+                    remaining = [mt[0] for mt in match_templates[idx + 1:]]
+                    tests += len(remaining)
+                    for test in remaining:
+                        test(event, namespaces, ctxt, updateonly=True)
+
+                    # Consume the events up to the matching end event.
+                    pre_end = idx + 1
+                    if 'match_once' not in hints and 'not_recursive' in hints:
+                        pre_end -= 1
+                    tail = []
+                    inner = _strip(stream, tail.append)
+                    if pre_end > 0:
+                        inner = self._match(inner, ctxt, start=start,
+                                            end=pre_end, **vars)
+                    content = self._include(chain([event], inner, tail),
+                                            ctxt)
+                    if 'not_buffered' not in hints:
+                        content = list(content)
+                    content = Stream(content)
+
+                    selected = [False]
+                    def select(path):
+                        selected[0] = True
+                        return content.select(path, namespaces, ctxt)
+                    vars = dict(select=select)
+
+                    template = _apply_directives(template, directives, ctxt,
+                                                 vars)
+                    for event in self._match(self._flatten(template, ctxt,
+                                                           **vars),
+                                             ctxt, start=idx + 1, **vars):
+                        yield event
+
+                    # Consume the matched events if select() wasn't called.
+                    if not selected[0]:
+                        for event in content:
+                            pass
+
+                    # Let the match templates see the last matched event.
+                    remaining = [mt[0] for mt in match_templates[idx:]]
+                    tests += len(remaining)
+                    for test in remaining:
+                        test(tail[0], namespaces, ctxt, updateonly=True)
+
+                    break
+
+            else:
+                yield event
+    finally:
+        match_templates.tests += tests
+
+
+_OPAQUE_TYPES = (type, ModuleType, FunctionType, MethodType,
+                 BuiltinFunctionType)
+
+
+def _estimate_size(template):
+    """Estimate the memory used by a parsed `template` in bytes, by adding
+    up the sizes of the objects it refers to. Other templates, the loader,
+    filters and functions are not counted since they are shared.
+
+    """
+    return sum(_template_objects(template).itervalues())
+
+
+def _template_objects(template):
+    """The sizes of the objects that `template` refers to, by their id, as
+    counted by :func:`_estimate_size`."""
+    seen = {id(template.loader): 0, id(template.filters): 0}
+    stack = [template]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _OPAQUE_TYPES):
+            continue
+        if isinstance(obj, Template) and obj is not template:
+            continue
+        seen[id(obj)] = sys.getsizeof(obj)
+        if isinstance(obj, basestring):
+            continue
+        elif isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (tuple, list, set, frozenset, deque)):
+            stack.extend(obj)
+        elif isinstance(obj, CodeType):
+            stack.extend((obj.co_code, obj.co_consts, obj.co_names,
+                          obj.co_varnames, obj.co_lnotab))
+        else:
+            stack.extend(getattr(obj, '__dict__', {}).itervalues())
+            for class_ in type(obj).__mro__:
+                for name in getattr(class_, '__slots__', ()):
+                    stack.append(getattr(obj, name, None))
+    del seen[id(template.loader)], seen[id(template.filters)]
+    return seen
+
+
+_INTERNED_KINDS = frozenset([START, END, TEXT, COMMENT, PI, DOCTYPE,
+                             XML_DECL, START_NS, END_NS, START_CDATA,
+                             END_CDATA])
+
+
+def _compact(template, interned, drop_positions=False):
+    """Replace the strings, names, attribute sets, positions and events in
+    the parsed stream of `template` with equal ones from `interned`, a dict
+    shared by the templates of a loader, adding those it lacks. With
+    `drop_positions`, the line and column of events are dropped and only
+    the file name is kept.
+
+    Expressions and events that contain them are never shared, since equal
+    expressions in different templates report errors for their own file.
+
+    """
+    def intern(obj):
+        try:
+            return interned.setdefault((type(obj), obj), obj)
+        except TypeError:
+            return obj
+
+    def compact(stream):
+        events = []
+        for kind, data, pos in stream:
+            if pos is not None:
+                if drop_positions:
+                    pos = intern((intern(pos[0]), -1, -1))
+                else:
+                    pos = intern((intern(pos[0]),) + tuple(pos[1:]))
+            if kind is START:
+                tag, attrs = data
+                attrs = Attrs([(intern(name), compact(value)
+                                if type(value) is list else intern(value))
+                               for name, value in attrs])
+                data = intern((intern(tag), intern(attrs)))
+            elif kind is SUB:
+                directives, substream = data
+                data = directives, compact(substream)
+            elif kind is INCLUDE:
+                href, cls, fallback = data
+                if type(href) is list:
+                    href = compact(href)
+                if fallback is not None:
+                    fallback = compact(fallback)
+                data = href, cls, fallback
+            elif kind in _INTERNED_KINDS:
+                data = intern(data)
+            if kind in _INTERNED_KINDS:
+                events.append(intern((kind, data, pos)))
+            else:
+                events.append((kind, data, pos))
+        return events
+
+    template._stream = compact(template._stream)
+    return template
+
+
+class _TemplateLRUCache(LRUCache):
+    """The template cache of a :class:`FlaskTemplateLoader`, which also
+    evicts the least recently used templates while their estimated size
+    exceeds `memory` bytes, and reports evictions to the loader."""
+
+    def __init__(self, capacity, memory, loader):
+        LRUCache.__init__(self, capacity)
+        self.memory = memory
+        self.loader = loader
+        self.sizes = {}
+        self.used = 0
+
+    def __setitem__(self, key, template):
+        if key in self._dict:
+            self.loader._released()
+        self.used -= self.sizes.pop(key, 0)
+        if self.memory is not None:
+            self.sizes[key] = _estimate_size(template)
+            self.used += self.sizes[key]
+        LRUCache.__setitem__(self, key, template)
+
+    def _manage_size(self):
+        while len(self._dict) > self.capacity or (
+                self.memory is not None and len(self._dict) > 1 and
+                self.used > self.memory):
+            item = self.tail
+            del self._dict[item.key]
+            if item.prv is None:
+                self.head = self.tail = None
+            else:
+                self.tail = item.prv
+                self.tail.nxt = None
+            self.used -= self.sizes.pop(item.key, 0)
+            self.loader._evicted(item.value)
+            self.loader._released()
+
+
+class TemplateStore(object):
+    """A thread-safe least-recently-used store of parsed templates that
+    several :class:`FlaskTemplateLoader` instances, for example those of
+    several applications in one process, can share so that each template
+    file is only parsed once.
+
+    Templates are stored as they are right after parsing, keyed like the
+    templates a loader keeps in its `cache_dir`. Loaders get their own
+    copy, which shares the parsed events and expressions with the stored
+    template, and set it up with their own callback and includes.
+
+    A `capacity` of ``0`` disables the store.
+
+    .. versionadded:: 0.6
+
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self._templates = LRUCache(capacity)
+        self._lock = threading.Lock()
+
+        #: Number of templates that were found in the store.
+        self.hits = 0
+
+        #: Number of templates that had to be parsed.
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._templates)
+
+    def get(self, key):
+        """Return a copy of the template stored under `key`, or ``None``
+        if there is none."""
+        self._lock.acquire()
+        try:
+            try:
+                template = self._templates[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return copy(template)
+        finally:
+            self._lock.release()
+
+    def set(self, key, template):
+        """Store a copy of the newly parsed `template` under `key`."""
+        if not self.capacity:
+            return
+        template = copy(template)
+        self._lock.acquire()
+        try:
+            self._templates[key] = template
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Empty the store and reset the counters."""
+        self._lock.acquire()
+        try:
+            self._templates = LRUCache(self.capacity)
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+
+#: The :class:`TemplateStore` shared by the template loaders of the
+#: applications that set ``GENSHI_SHARED_TEMPLATES``.
+shared_templates = TemplateStore()
+
+
+class FlaskTemplateLoader(TemplateLoader):
+    """A :class:`~genshi.template.TemplateLoader` that can keep parsed
+    templates in `cache_dir`, so that other processes and later runs can
+    load them without parsing them again, and share them with other loaders
+    in the same process through a :class:`TemplateStore`, `store`.
+
+    Cached templates are keyed by the template's path, modification time,
+    size and content, the Python implementation and bytecode version, the
+    Genshi version, the template class and the loader's callback, so they
+    are invalidated when any of those change. They are unpickled when
+    loaded, so `cache_dir` must only be writable by trusted users.
+
+    At most `max_cache_size` parsed templates are kept in memory, and if
+    `max_cache_memory` is set, least recently used templates are also
+    evicted while the estimated size of the cached templates exceeds that
+    many bytes. :meth:`cache_stats` reports how well the cache works.
+
+    With `auto_reload`, whether a template changed is checked at most once
+    every `reload_interval` seconds per template. If `reload_interval` is
+    ``None`` templates are never checked when loaded and are only reloaded
+    after :meth:`invalidate`, as done by a :class:`TemplateWatcher`.
+
+    .. versionadded:: 0.6
+
+    """
+
+    def __init__(self, search_path=None, cache_dir=None, reload_interval=0,
+                 max_cache_size=25, max_cache_memory=None, store=None,
+                 drop_positions=False, **kwargs):
+        TemplateLoader.__init__(self, search_path,
+                                max_cache_size=max_cache_size, **kwargs)
+
+        #: Directory for parsed templates, or ``None`` to not keep them.
+        self.cache_dir = cache_dir
+
+        #: The :class:`TemplateStore` to share parsed templates through, or
+        #: ``None`` to not share them.
+        self.store = store
+
+        #: Whether to drop the line and column of template events when
+        #: templates are loaded. Errors are then reported without them.
+        self.drop_positions = drop_positions
+
+        self._interned = {}
+        self._releases = 0
+
+        #: Minimum seconds between checks of whether a template changed.
+        self.reload_interval = reload_interval
+
+        self._uptodate = _ReloadChecks(self)
+        self._cache = _TemplateLRUCache(max_cache_size, max_cache_memory,
+                                        self)
+        self._stats = {}
+        self._parses = 0
+
+    def load(self, filename, relative_to=None, cls=None, encoding=None):
+        self._lock.acquire()
+        try:
+            parses = self._parses
+            template = TemplateLoader.load(self, filename, relative_to, cls,
+                                           encoding)
+            stats = self._stats.setdefault(template.filename, [0, 0, 0])
+            if self._parses == parses:
+                stats[0] += 1
+            else:
+                stats[1] += 1
+                _context_names(template)
+            return template
+        finally:
+            self._lock.release()
+
+    def _evicted(self, template):
+        self._stats.setdefault(template.filename, [0, 0, 0])[2] += 1
+
+    def _released(self):
+        self._releases += 1
+
+    def _compact(self, template):
+        """Compact `template` with the objects interned by this loader.
+
+        The table of interned objects keeps the objects of templates that
+        were evicted or reloaded alive, so once as many templates left the
+        cache as it holds, the table is rebuilt from the cached templates.
+
+        """
+        if self._releases > len(self._cache):
+            self._interned = {}
+            self._releases = 0
+            for item in self._cache._dict.values():
+                _compact(item.value, self._interned)
+        return _compact(template, self._interned, self.drop_positions)
+
+    def cache_stats(self):
+        """Return a dict of the cache ``hits``, ``misses`` (loads that
+        parsed the template), ``evictions`` and estimated ``size`` in bytes
+        of each template that was loaded, by template name. The size is
+        ``None`` if the template is not cached or the loader has no
+        `max_cache_memory`.
+
+        """
+        self._lock.acquire()
+        try:
+            sizes = dict((item.value.filename, self._cache.sizes.get(key))
+                         for key, item in self._cache._dict.iteritems())
+            return dict((name, dict(hits=hits, misses=misses,
+                                    evictions=evictions,
+                                    size=sizes.get(name)))
+                        for name, (hits, misses, evictions)
+                        in self._stats.iteritems())
+        finally:
+            self._lock.release()
+
+    def memory_report(self):
+        """Return a dict of the estimated ``size`` in bytes of each cached
+        template, by template name, and how many of those bytes are
+        ``shared`` with other cached templates, such as the strings, names
+        and attribute sets that templates are compacted to share when they
+        are loaded.
+
+        """
+        self._lock.acquire()
+        try:
+            templates = [item.value for item in self._cache._dict.values()]
+        finally:
+            self._lock.release()
+        objects = [(template.filename, _template_objects(template))
+                   for template in templates]
+        references = defaultdict(int)
+        for name, sizes in objects:
+            for key in sizes:
+                references[key] += 1
+        return dict((name, dict(size=sum(sizes.itervalues()),
+                                shared=sum(size for key, size
+                                           in sizes.iteritems()
+                                           if references[key] > 1)))
+                    for name, sizes in objects)
+
+    def invalidate(self, filename):
+        """Parse the template loaded as `filename` again the next time it
+        is loaded. Only has an effect with `auto_reload`."""
+        self._lock.acquire()
+        try:
+            if filename in self._uptodate:
+                self._uptodate[filename] = None
+        finally:
+            self._lock.release()
+
+    def changed(self):
+        """Check every loaded template and return the names of those that
+        changed or were removed since they were parsed."""
+        self._lock.acquire()
+        try:
+            checks = self._uptodate.items()
+        finally:
+            self._lock.release()
+        changed = []
+        for filename, check in checks:
+            if check is None:
+                continue
+            try:
+                if check.uptodate():
+                    continue
+            except OSError:
+                pass
+            changed.append(filename)
+        return changed
+
+    def _instantiate(self, cls, fileobj, filepath, filename, encoding=None):
+        self._parses += 1
+        if self.cache_dir is None and self.store is None:
+            template = TemplateLoader._instantiate(self, cls, fileobj,
+                                                   filepath, filename,
+                                                   encoding)
+            return self._compact(_add_directives(template))
+        source = fileobj.read()
+        key = self._cache_key(cls, source, filepath, filename, encoding)
+        template = None
+        if self.store is not None:
+            template = self.store.get(key)
+        if template is None:
+            if self.cache_dir is None:
+                template = TemplateLoader._instantiate(self, cls,
+                                                       StringIO(source),
+                                                       filepath, filename,
+                                                       encoding)
+            else:
+                template = self._instantiate_cached(cls, source, key,
+                                                    filepath, filename,
+                                                    encoding)
+            if self.store is not None:
+                # Stored as parsed, since the directives must be added
+                # while the events still have their positions, and the
+                # loaders sharing it can compact it differently.
+                self.store.set(key, template)
+        template.loader = self
+        return self._compact(_add_directives(template))
+
+    def _instantiate_cached(self, cls, source, key, filepath, filename,
+                            encoding=None):
+        path = os.path.join(self.cache_dir, '%s.pickle' % key)
+        try:
+            template = self._load_cached(path)
+        except Exception:
+            template = None
+        if template is None:
+            template = TemplateLoader._instantiate(self, cls, StringIO(source),
+                                                   filepath, filename,
+                                                   encoding)
+            self._dump_cached(path, template)
+        return template
+
+    def _cache_key(self, cls, source, filepath, filename, encoding):
+        stat = os.stat(filepath)
+        callback = self.callback
+        if callback is not None:
+            callback = '%s.%s' % (getattr(callback, '__module__', None),
+                                  getattr(callback, '__name__',
+                                          type(callback).__name__))
+        return sha1(repr((platform.python_implementation(), imp.get_magic(),
+                          genshi_version, cls.__module__, cls.__name__,
+                          filepath, filename, stat.st_mtime, stat.st_size,
+                          sha1(source).hexdigest(), encoding,
+                          self.default_encoding, self.allow_exec,
+                          repr(self.variable_lookup), callback))).hexdigest()
+
+    def _load_cached(self, path):
+        try:
+            fileobj = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            unpickler = pickle.Unpickler(fileobj)
+            unpickler.persistent_load = marshal.loads
+            return unpickler.load()
+        finally:
+            fileobj.close()
+
+    def _dump_cached(self, path, template):
+        # Templates refer to their loader, which can't be pickled, and
+        # expressions can contain code objects, which are marshalled.
+        def persistent_id(obj):
+            if type(obj) is CodeType:
+                return marshal.dumps(obj)
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                return
+        try:
+            fd, tmppath = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        except OSError:
+            return
+        fileobj = os.fdopen(fd, 'wb')
+        template.loader = None
+        try:
+            try:
+                pickler = pickle.Pickler(fileobj, pickle.HIGHEST_PROTOCOL)
+                pickler.persistent_id = persistent_id
+                pickler.dump(template)
+                fileobj.close()
+                os.rename(tmppath, path)
+            except Exception:
+                fileobj.close()
+                os.remove(tmppath)
+        finally:
+            template.loader = self
+
+
+class _ReloadCheck(object):
+    """Wraps the up-to-date check returned by a Genshi load function to only
+    call it once every `reload_interval` seconds of its loader."""
+
+    __slots__ = ('uptodate', 'loader', 'checked')
+
+    def __init__(self, uptodate, loader):
+        self.uptodate = uptodate
+        self.loader = loader
+        self.checked = time()
+
+    def __call__(self):
+        interval = self.loader.reload_interval
+        if interval is None:
+            return True
+        now = time()
+        if now - self.checked < interval:
+            return True
+        self.checked = now
+        return self.uptodate()
+
+
+class _ReloadChecks(dict):
+    """The ``_uptodate`` mapping of a :class:`FlaskTemplateLoader`, which
+    wraps checks in :class:`_ReloadCheck` as Genshi stores them."""
+
+    def __init__(self, loader):
+        dict.__init__(self)
+        self.loader = loader
+
+    def __setitem__(self, filename, uptodate):
+        if uptodate is not None:
+            uptodate = _ReloadCheck(uptodate, self.loader)
+        dict.__setitem__(self, filename, uptodate)
+
+
+def _walk_templates(paths):
+    """Yield ``(name, filepath)`` for the files in the template directories
+    `paths`, a list of ``(prefix, path)`` pairs, in order of precedence.
+    A name can be yielded more than once.
+
+    """
+    for prefix, path in paths:
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.join(dirpath, filename)
+                name = os.path.relpath(filepath, path).replace(os.path.sep,
+                                                               '/')
+                if prefix is not None:
+                    name = '%s/%s' % (prefix, name)
+                yield name, filepath
+
+
+class TemplateIndex(object):
+    """A Genshi load function that finds templates in an index of template
+    names to file paths, built from `paths`, a list of ``(prefix, path)``
+    pairs of template directories in order of precedence.
+
+    Names that are not in the index are looked for in the directories, in
+    case the template was added later. If `remember_missing` is true, names
+    that are not found there either are remembered and not looked for again
+    until the index is rebuilt.
+
+    .. versionadded:: 0.6
+
+    """
+
+    def __init__(self, paths, remember_missing=True):
+        self.paths = paths
+        self.remember_missing = remember_missing
+        self.rebuild()
+
+    def rebuild(self):
+        """Build the index again, and forget missing names."""
+        index = {}
+        for name, filepath in _walk_templates(self.paths):
+            index.setdefault(name, filepath)
+        self._index = index
+        self._missing = set()
+
+    def names(self):
+        """The sorted names of the templates in the index."""
+        return sorted(self._index)
+
+    def find(self, filename):
+        """Return the path of the template named `filename`, or ``None`` if
+        there is no such template."""
+        filepath = self._index.get(filename)
+        if filepath is not None or filename in self._missing:
+            return filepath
+        for prefix, path in self.paths:
+            name = filename
+            if prefix is not None:
+                if not filename.startswith(prefix + '/'):
+                    continue
+                name = filename[len(prefix) + 1:]
+            filepath = os.path.join(path, name)
+            if os.path.isfile(filepath):
+                self._index[filename] = filepath
+                return filepath
+        if self.remember_missing:
+            self._missing.add(filename)
+
+    def __call__(self, filename):
+        filepath = self.find(filename)
+        if filepath is None:
+            raise IOError(errno.ENOENT, 'Template not found', filename)
+        try:
+            fileobj = open(filepath, 'rb')
+        except IOError:
+            self._index.pop(filename, None)
+            filepath = self.find(filename)
+            if filepath is None:
+                raise
+            fileobj = open(filepath, 'rb')
+        mtime = os.path.getmtime(filepath)
+        def uptodate():
+            return mtime == os.path.getmtime(filepath)
+        return filepath, filename, fileobj, uptodate
+
+
+class TemplateWatcher(object):
+    """Reloads templates of a :class:`FlaskTemplateLoader` when their files
+    change, so the loader doesn't have to check them each time they are
+    loaded. The loader should be created with `auto_reload` and a
+    `reload_interval` of ``None``.
+
+    :meth:`start` watches the `paths` with watchdog_ if it is installed and
+    otherwise polls the loaded templates every `interval` seconds in a
+    background thread. :meth:`poll` can also be called directly.
+
+    .. _watchdog: http://pypi.python.org/pypi/watchdog
+
+    .. versionadded:: 0.6
+
+    """
+
+    def __init__(self, loader, paths=(), interval=1.0):
+        self.loader = loader
+        self.paths = list(paths)
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._observer = None
+
+    def poll(self):
+        """Invalidate changed templates and return their names. Also
+        rebuilds any :class:`TemplateIndex` of the loader, to pick up added
+        and removed templates."""
+        for loadfunc in self.loader.search_path:
+            if isinstance(loadfunc, TemplateIndex):
+                loadfunc.rebuild()
+        changed = self.loader.changed()
+        for filename in changed:
+            self.loader.invalidate(filename)
+        return changed
+
+    def dispatch(self, event):
+        # Called by watchdog for any file system event in the paths.
+        self.poll()
+
+    def start(self):
+        """Start watching in the background."""
+        self._stopped.clear()
+        if Observer is not None and self.paths:
+            self._observer = Observer()
+            for path in self.paths:
+                if os.path.isdir(path):
+                    self._observer.schedule(self, path, recursive=True)
+            self._observer.start()
+        else:
+            thread = threading.Thread(target=self._run)
+            thread.setDaemon(True)
+            thread.start()
+
+    def stop(self):
+        """Stop watching."""
+        self._stopped.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+
+    def _run(self):
+        while True:
+            self._stopped.wait(self.interval)
+            if self._stopped.isSet():
+                break
+            self.poll()
+
+
+class _Changes(object):
+    """Counts changes to the configuration of a :class:`Genshi` instance."""
+
+    def __init__(self):
+        self.count = 0
+
+
+def _tracked(value, changes):
+    """Wrap dicts and lists in `value` to count their changes in
+    `changes`."""
+    if isinstance(value, (_TrackedDict, _TrackedList)) and \
+            value.changes is changes:
+        return value
+    if isinstance(value, dict):
+        return _TrackedDict(changes, value,
+                            getattr(value, 'default_factory', None))
+    if isinstance(value, list):
+        return _TrackedList(changes, value)
+    return value
+
+
+class _TrackedDict(dict):
+    """A dict that counts its changes, and those of the dicts and lists it
+    contains. Can have a `default_factory` like a
+    :class:`~collections.defaultdict`."""
+
+    def __init__(self, changes, items=(), default_factory=None):
+        dict.__init__(self)
+        self.changes = changes
+        self.default_factory = default_factory
+        self.update(items)
+
+    def __reduce__(self):
+        return (type(self), (self.changes, dict(self), self.default_factory))
+
+    def __missing__(self, key):
+        if self.default_factory is None:
+            raise KeyError(key)
+        self[key] = self.default_factory()
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, _tracked(value, self.changes))
+        self.changes.count += 1
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.changes.count += 1
+
+    def clear(self):
+        dict.clear(self)
+        self.changes.count += 1
+
+    def pop(self, *args):
+        self.changes.count += 1
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.changes.count += 1
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+
+class _TrackedList(list):
+    """A list that counts its changes."""
+
+    def __init__(self, changes, items=()):
+        list.__init__(self, items)
+        self.changes = changes
+
+    def __reduce__(self):
+        return (type(self), (self.changes, list(self)))
+
+    def _changed(name):
+        method = getattr(list, name)
+        def changed(self, *args):
+            self.changes.count += 1
+            return method(self, *args)
+        changed.__name__ = name
+        return changed
+
+    for name in ('__setitem__', '__delitem__', '__setslice__',
+                 '__delslice__', '__iadd__', '__imul__', 'append', 'extend',
+                 'insert', 'pop', 'remove', 'reverse', 'sort'):
+        locals()[name] = _changed(name)
+    del _changed, name
+
+
+def _encoding_errors(method):
+    """How to encode characters that the output encoding can't represent
+    for the serialization `method`: as character references, or as ``?``
+    for ``text``."""
+    if method == 'text':
+        return 'replace'
+    return 'xmlcharrefreplace'
+
+
+# Elements whose content is left alone when minifying HTML.
+_PRESERVE = frozenset(['pre', 'textarea', 'script', 'style'])
+
+# Elements that whitespace around can be dropped from when minifying HTML.
+_BLOCK = frozenset([
+    'address', 'article', 'aside', 'base', 'blockquote', 'body', 'br',
+    'caption', 'col', 'colgroup', 'dd', 'div', 'dl', 'dt', 'fieldset',
+    'figcaption', 'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5',
+    'h6', 'head', 'header', 'hr', 'html', 'li', 'link', 'main', 'meta', 'nav',
+    'noscript', 'ol', 'option', 'p', 'script', 'section', 'style', 'table',
+    'tbody', 'td', 'tfoot', 'th', 'thead', 'title', 'tr', 'ul',
+])
+
+_XML_SPACE = QName('http://www.w3.org/XML/1998/namespace}space')
+
+# Not \s, which would also match non-breaking spaces.
+_SPACES = re.compile(u'[ \t\n\r\f]+')
+
+
+def _minify_markup(stream, html=True):
+    """Drop comments and insignificant whitespace from a markup `stream`.
+
+    Whitespace-only text in elements is collapsed to a space, and in HTML
+    dropped next to block elements, where other text also has runs of
+    whitespace collapsed. Whitespace outside of the root element is
+    dropped. The content of elements with
+    ``xml:space="preserve"``, and in HTML of ``pre``, ``textarea``,
+    ``script`` and ``style`` elements, is left alone, comments included,
+    as are conditional comments.
+
+    """
+    preserving = [False]
+    pending = None
+    block = True
+    for event in stream:
+        kind, data, pos = event
+        if kind is TEXT and not preserving[-1]:
+            if not data.strip(u' \t\n\r\f'):
+                pending = pos
+                continue
+            if html and not isinstance(data, Markup):
+                event = kind, _SPACES.sub(u' ', data), pos
+        elif (kind is COMMENT and not preserving[-1] and
+                not data.startswith('[')):
+            continue
+        if kind is START or kind is END:
+            tag = data[0] if kind is START else data
+            is_block = html and tag.localname in _BLOCK
+        else:
+            is_block = False
+        if pending is not None:
+            if len(preserving) > 1 and not (html and (block or is_block)):
+                yield TEXT, u' ', pending
+            pending = None
+        if kind is START:
+            space = data[1].get(_XML_SPACE)
+            if space is not None:
+                preserving.append(space == 'preserve')
+            else:
+                preserving.append(preserving[-1] or
+                                  (html and tag.localname in _PRESERVE))
+        elif kind is END:
+            preserving.pop()
+        block = is_block or kind not in (START, END, TEXT)
+        yield event
+
+
+def _minify_text(stream, css=False):
+    """Drop indentation, trailing whitespace and blank lines from a text
+    `stream`, and comments if it is `css`."""
+    line_start = True
+    comment = False
+    for kind, data, pos in stream:
+        if kind is not TEXT:
+            yield kind, data, pos
+            continue
+        if css:
+            parts = []
+            while data:
+                if comment:
+                    end = data.find('*/')
+                    comment = end == -1
+                    data = '' if comment else data[end + 2:]
+                else:
+                    start = data.find('/*')
+                    if start == -1:
+                        parts.append(data)
+                        break
+                    parts.append(data[:start])
+                    data = data[start + 2:]
+                    comment = True
+            data = u''.join(parts)
+        lines = []
+        for line in data.splitlines(True):
+            body = line.rstrip(u'\r\n')
+            newline = body != line
+            if line_start:
+                body = body.lstrip(u' \t')
+            if newline:
+                body = body.rstrip(u' \t')
+                if body or not line_start:
+                    lines.append(body + u'\n')
+                line_start = True
+            elif body:
+                lines.append(body)
+                line_start = False
+        if lines:
+            yield TEXT, u''.join(lines), pos
+
+
+_SERIALIZERS = {
+    'xml': XMLSerializer,
+    'xhtml': XHTMLSerializer,
+    'html': HTMLSerializer,
+    'text': TextSerializer,
+}
+
+# Serialization styles the compiled engine can produce, by serializer.
+_COMPILED_STYLES = {
+    XMLSerializer: 'xml',
+    XHTMLSerializer: 'xhtml',
+    HTMLSerializer: 'html',
+}
+
+_XHTML_NAMESPACE = 'http://www.w3.org/1999/xhtml'
+
+_PRESERVE_ELEMS = {
+    'xml': XMLSerializer._PRESERVE_SPACE,
+    'xhtml': XHTMLSerializer._PRESERVE_SPACE,
+    'html': HTMLSerializer._PRESERVE_SPACE,
+}
+
+_NOESCAPE_ELEMS = {
+    'xml': frozenset(),
+    'xhtml': frozenset(),
+    'html': HTMLSerializer._NOESCAPE_ELEMS,
+}
+
+_TRAILING_SPACE = re.compile('[ \t]+(?=\n)')
+_BLANK_LINES = re.compile('\n{2,}')
+
+# The events that Genshi evaluates away before serializing, which don't
+# keep an element from being written as an empty tag by themselves.
+_EVALUATED = frozenset([EXPR, SUB, EXEC, INCLUDE])
+
+_NO_ATTRS = object()
+
+
+class _Unsupported(Exception):
+    """Raised while compiling a template that uses something the compiled
+    engine doesn't handle."""
+
+
+class _Output(object):
+    """The output of a compiled template: the serialized chunks, the text
+    waiting to have whitespace stripped, and the start tag of an element
+    that may yet turn out to be empty, as a ``(start, empty)`` pair of
+    markup. Only one of the last two is ever set."""
+
+    __slots__ = ('chunks', 'text', 'pending', 'doctype', 'decl', 'prefixes',
+                 'generated')
+
+    def __init__(self):
+        self.chunks = []
+        self.text = []
+        self.pending = None
+        self.doctype = self.decl = False
+        self.prefixes = {}
+        self.generated = count(1)
+
+    def add(self, text):
+        """Add escaped `text`."""
+        if self.pending is not None:
+            self.chunks.append(self.pending[0])
+            self.pending = None
+        self.text.append(text)
+
+    def flush(self, preserve):
+        """Write the pending start tag or text, stripping whitespace from
+        the text as :class:`~genshi.output.WhitespaceFilter` does unless
+        `preserve` is true."""
+        if self.pending is not None:
+            self.chunks.append(self.pending[0])
+            self.pending = None
+        elif self.text:
+            text = u''.join(self.text)
+            del self.text[:]
+            if not preserve and '\n' in text:
+                text = _BLANK_LINES.sub('\n', _TRAILING_SPACE.sub('', text))
+            self.chunks.append(text)
+
+    def end(self, end, preserve):
+        """Write the `end` tag, or an empty tag if the element is empty."""
+        if self.pending is not None:
+            self.chunks.append(self.pending[1])
+            self.pending = None
+        else:
+            self.flush(preserve)
+            self.chunks.append(end)
+
+    def declare(self, uri, ns_attrs):
+        """Return the prefix for the namespace `uri` of an attribute that
+        isn't declared in the template, generated as
+        :class:`~genshi.output.NamespaceFlattener` does, and add its
+        declaration to `ns_attrs`. Each element that uses the namespace
+        declares it, with the same prefix."""
+        if uri not in self.prefixes:
+            self.prefixes[uri] = 'ns%d' % self.generated.next()
+        prefix = self.prefixes[uri]
+        attr = ('xmlns:%s' % prefix, uri)
+        if attr not in ns_attrs:
+            ns_attrs.append(attr)
+        return prefix
+
+
+def _start_tag(style, tag, attrs, empty=False):
+    """Serialize the start tag of an element, or the element if `empty`,
+    as the serializer for `style` would. `tag` and the names of `attrs`
+    are prefixed names."""
+    buf = ['<', tag]
+    if style == 'xml':
+        for attr, value in attrs:
+            buf += [' ', attr, '="', escape(value), '"']
+        buf.append(empty and '/>' or '>')
+        return Markup(''.join(buf))
+    html = style == 'html'
+    for attr, value in attrs:
+        if attr in XHTMLSerializer._BOOLEAN_ATTRS:
+            if html:
+                if value:
+                    buf += [' ', attr]
+                continue
+            value = attr
+        elif html and ':' in attr:
+            if attr == 'xml:lang' and 'lang' not in attrs:
+                buf += [' lang="', escape(value), '"']
+            continue
+        elif html and attr == 'xmlns':
+            continue
+        elif attr == 'xml:lang' and 'lang' not in attrs:
+            buf += [' lang="', escape(value), '"']
+        elif attr == 'xml:space':
+            continue
+        buf += [' ', attr, '="', escape(value), '"']
+    if html:
+        buf.append('>')
+        if empty and tag not in XHTMLSerializer._EMPTY_ELEMS:
+            buf.append('</%s>' % tag)
+    elif not empty:
+        buf.append('>')
+    elif tag in XHTMLSerializer._EMPTY_ELEMS:
+        buf.append(' />')
+    else:
+        buf.append('></%s>' % tag)
+    return Markup(''.join(buf))
+
+
+def _doctype_markup(doctype):
+    """Serialize a DOCTYPE as the serializers do."""
+    name, pubid, sysid = doctype
+    buf = ['<!DOCTYPE %s']
+    if pubid:
+        buf.append(' PUBLIC "%s"')
+    elif sysid:
+        buf.append(' SYSTEM')
+    if sysid:
+        buf.append(' "%s"')
+    buf.append('>\n')
+    return Markup(''.join(buf)) % tuple([part for part in doctype if part])
+
+
+def _decl_markup(decl):
+    """Serialize an XML declaration as the serializers do."""
+    version, encoding, standalone = decl
+    buf = ['<?xml version="%s"' % version]
+    if encoding:
+        buf.append(' encoding="%s"' % encoding)
+    if standalone != -1:
+        standalone = standalone and 'yes' or 'no'
+        buf.append(' standalone="%s"' % standalone)
+    buf.append('?>\n')
+    return Markup(''.join(buf))
+
+
+def _attr_text(value, texts, ctxt, template):
+    """Add the text of an expression interpolated into an attribute value
+    to `texts`, as Genshi's ``_flatten`` would."""
+    if value is None:
+        return
+    if isinstance(value, basestring):
+        texts.append(value)
+    elif isinstance(value, (int, float, long)):
+        texts.append(Markup(value))
+    elif hasattr(value, '__iter__'):
+        for kind, data, pos in template._flatten(_ensure(value), ctxt):
+            if kind is TEXT and data is not None:
+                texts.append(data)
+    else:
+        texts.append(unicode(value))
+
+
+def _open(out, element, extra, g, l, template):
+    """Write the start tag of an element with interpolated attributes or
+    ``py:attrs``. `extra` is the value of ``py:attrs``, and `element` is
+    what the compiler knows about the element: see
+    :meth:`_TemplateCompiler.start`. The whitespace in the element is
+    handled as its ``xml:space`` attribute in the template says, even if
+    ``py:attrs`` changes it."""
+    style, tag, ns_attrs, attrs, prefixes, preserve, empty = element
+    if extra is not _NO_ATTRS and extra:
+        if isinstance(extra, Stream):
+            try:
+                extra = iter(extra).next()
+            except StopIteration:
+                extra = []
+        elif not isinstance(extra, list):
+            extra = extra.items()
+        attrs |= [(QName(name), value is not None and
+                   unicode(value).strip() or None)
+                  for name, value in extra]
+    ns_attrs = list(ns_attrs)
+    flat = []
+    for name, value in attrs:
+        if type(value) is list:
+            texts = []
+            for part in value:
+                if type(part) is CodeType:
+                    _attr_text(eval(part, g, l), texts, l['__data__'],
+                               template)
+                else:
+                    texts.append(part)
+            if not texts:
+                continue
+            value = ''.join(texts)
+        if name.namespace:
+            if name.namespace in prefixes:
+                prefix = prefixes[name.namespace]
+            else:
+                prefix = out.declare(name.namespace, ns_attrs)
+            name = prefix and u'%s:%s' % (prefix, name.localname) or \
+                   name.localname
+        else:
+            name = name.localname
+        flat.append((name, value))
+    attrs = Attrs(ns_attrs + flat)
+    out.flush(preserve)
+    start = _start_tag(style, tag, attrs)
+    if empty:
+        out.pending = (start, _start_tag(style, tag, attrs, True))
+    else:
+        out.chunks.append(start)
+
+
+def _open_interpolated(out, element, g, l, template):
+    """Like :func:`_open`, for elements without ``py:attrs`` whose
+    attribute names are already prefixed."""
+    style, tag, attrs, preserve, empty = element
+    flat = []
+    for name, value in attrs:
+        if type(value) is list:
+            texts = []
+            for part in value:
+                if type(part) is CodeType:
+                    _attr_text(eval(part, g, l), texts, l['__data__'],
+                               template)
+                else:
+                    texts.append(part)
+            if not texts:
+                continue
+            value = ''.join(texts)
+        flat.append((name, value))
+    attrs = Attrs(flat)
+    out.flush(preserve)
+    start = _start_tag(style, tag, attrs)
+    if empty:
+        out.pending = (start, _start_tag(style, tag, attrs, True))
+    else:
+        out.chunks.append(start)
+
+
+def _emit(out, value, style, state, ctxt, template):
+    """Write the result of an expression as Genshi's ``_flatten`` would
+    produce it, in the namespace, whitespace and escaping `state` the
+    expression was compiled in."""
+    if isinstance(value, basestring):
+        pass
+    elif isinstance(value, (int, float, long)):
+        value = Markup(value)
+    elif type(value) is _Macro:
+        value.emit(out, style, state, template)
+        return
+    elif hasattr(value, '__iter__'):
+        _emit_events(out, _value_events(value, ctxt, template), style, state)
+        return
+    else:
+        value = unicode(value)
+    if state[3]:
+        out.add(Markup(value))
+    else:
+        out.add(escape(value, False))
+
+
+def _value_events(value, ctxt, template):
+    """The events of a stream an expression evaluated to, with the
+    expressions, directives and includes in it evaluated by the filters of
+    `template` as they would be in the template's stream. The events of
+    ``py:def`` functions are evaluated as they are generated, while the
+    arguments of the function are in the context."""
+    if type(value) is _Macro:
+        stream = value
+    else:
+        stream = list(_ensure(value))
+        if not ctxt._match_templates and not any(
+                kind in _EVALUATED for kind, data, pos in stream):
+            return stream
+    for filter_ in template.filters:
+        stream = filter_(iter(stream), ctxt)
+    return stream
+
+
+def _emit_events(out, events, style, state):
+    """Write a stream of events as the serializer for `style` and its
+    filters would write it in the namespace, whitespace and escaping `state`
+    where it is inserted."""
+    prefixes, namespaces, preserve, noescape = state
+    prefixes = dict((prefix, list(uris)) for prefix, uris in prefixes)
+    namespaces = dict((uri, list(names)) for uri, names in namespaces)
+
+    def push(prefix, uri):
+        namespaces.setdefault(uri, []).append(prefix)
+        prefixes.setdefault(prefix, []).append(uri)
+
+    def pop(prefix):
+        uris = prefixes[prefix]
+        uri = uris.pop()
+        if not uris:
+            del prefixes[prefix]
+        if uri not in uris or uri != uris[-1]:
+            names = namespaces[uri]
+            names.pop()
+            if not names:
+                del namespaces[uri]
+        return uri
+
+    preserve = int(preserve)
+    preserve_elems = _PRESERVE_ELEMS[style]
+    noescape_elems = _NOESCAPE_ELEMS[style]
+    html = style == 'html'
+    ns_attrs = []
+    for kind, data, pos in events:
+        if kind is TEXT:
+            out.add(noescape and Markup(data) or escape(data, False))
+            continue
+        if kind is END:
+            tagname = data.localname
+            if data.namespace in namespaces:
+                prefix = namespaces[data.namespace][-1]
+                if prefix:
+                    tagname = u'%s:%s' % (prefix, tagname)
+            out.end(Markup('</%s>' % tagname), preserve > 0)
+            noescape = False
+            if preserve:
+                preserve -= 1
+            continue
+        out.flush(preserve > 0)
+        if kind is START:
+            tag, attrs = data
+            if preserve or (tag in preserve_elems or
+                            attrs.get(_XML_SPACE) == 'preserve'):
+                preserve += 1
+            if not noescape and tag in noescape_elems:
+                noescape = True
+            tagname = tag.localname
+            if tag.namespace:
+                if tag.namespace in namespaces:
+                    prefix = namespaces[tag.namespace][-1]
+                    if prefix:
+                        tagname = u'%s:%s' % (prefix, tagname)
+                else:
+                    ns_attrs.append(('xmlns', tag.namespace))
+                    push('', tag.namespace)
+            flat = []
+            for name, value in attrs:
+                attrname = name.localname
+                if name.namespace:
+                    if name.namespace in namespaces:
+                        prefix = namespaces[name.namespace][-1]
+                    else:
+                        prefix = out.declare(name.namespace, ns_attrs)
+                        push(prefix, name.namespace)
+                    if prefix:
+                        attrname = u'%s:%s' % (prefix, attrname)
+                flat.append((attrname, value))
+            attrs = Attrs(ns_attrs + flat)
+            del ns_attrs[:]
+            out.pending = (_start_tag(style, tagname, attrs),
+                           _start_tag(style, tagname, attrs, True))
+        elif kind is START_NS:
+            prefix, uri = data
+            if uri not in namespaces:
+                prefix = prefixes.get(uri, [prefix])[-1]
+                ns_attrs.append(('xmlns%s' % (prefix and ':%s' % prefix
+                                              or ''), uri))
+            push(prefix, uri)
+        elif kind is END_NS:
+            if data in prefixes:
+                uri = pop(data)
+                attr = ('xmlns%s' % (data and ':%s' % data or ''), uri)
+                if attr in ns_attrs:
+                    ns_attrs.remove(attr)
+        elif kind is COMMENT:
+            out.chunks.append(Markup('<!--%s-->' % data))
+        elif kind is PI:
+            out.chunks.append(Markup('<?%s %s?>' % data))
+        elif kind is DOCTYPE:
+            if not out.doctype:
+                out.chunks.append(_doctype_markup(data))
+                out.doctype = True
+        elif kind is XML_DECL:
+            if style == 'xml' and not out.decl:
+                out.chunks.append(_decl_markup(data))
+                out.decl = True
+        elif kind is START_CDATA:
+            noescape = True
+            if not html:
+                out.chunks.append(Markup('<![CDATA['))
+        elif kind is END_CDATA:
+            noescape = False
+            if not html:
+                out.chunks.append(Markup(']]>'))
+
+
+class _Macro(object):
+    """The result of calling a ``py:def`` function of a compiled template.
+    Writing it where an expression is runs the compiled body of the
+    function; iterating over it generates its events as Genshi's function
+    would. The `definition` is the directive with the directives and stream
+    it applies to."""
+
+    __slots__ = ('body', 'definition', 'ctxt', 'out', 'state', 'args',
+                 'kwargs')
+
+    def __init__(self, body, definition, ctxt, out, state, args, kwargs):
+        self.body = body
+        self.definition = definition
+        self.ctxt = ctxt
+        self.out = out
+        self.state = state
+        self.args = args
+        self.kwargs = kwargs
+
+    def scope(self):
+        """The arguments of the function call, by name."""
+        directive, ctxt = self.definition[0], self.ctxt
+        scope = {}
+        args = list(self.args)
+        kwargs = dict(self.kwargs)
+        for name in directive.args:
+            if args:
+                scope[name] = args.pop(0)
+            elif name in kwargs:
+                scope[name] = kwargs.pop(name)
+            else:
+                scope[name] = _eval_expr(directive.defaults.get(name), ctxt)
+        if directive.star_args is not None:
+            scope[directive.star_args] = args
+        if directive.dstar_args is not None:
+            scope[directive.dstar_args] = kwargs
+        return scope
+
+    def __iter__(self):
+        directive, directives, stream = self.definition
+        ctxt = self.ctxt
+        ctxt.push(self.scope())
+        for event in _apply_directives(stream, directives, ctxt, {}):
+            yield event
+        ctxt.pop()
+
+    def emit(self, out, style, state, template):
+        if out is not self.out or state != self.state:
+            _emit_events(out, _value_events(self, self.ctxt, template),
+                         style, state)
+            return
+        ctxt = self.ctxt
+        ctxt.push(self.scope())
+        self.body()
+        ctxt.pop()
+
+
+def _choice(ctxt, directive, pos, needs_test=False):
+    """Return the state of the enclosing ``py:choose`` for a ``py:when`` or
+    ``py:otherwise`` `directive`, raising the errors Genshi does."""
+    info = ctxt._choice_stack and ctxt._choice_stack[-1]
+    if not info:
+        if isinstance(directive, WhenDirective):
+            message = ('"when" directives can only be used inside a '
+                       '"choose" directive')
+        else:
+            message = ('an "otherwise" directive can only be used inside a '
+                       '"choose" directive')
+        raise TemplateRuntimeError(message, directive.filename, *pos[1:])
+    if not info[0] and needs_test and not info[1]:
+        raise TemplateRuntimeError('either "choose" or "when" directive must '
+                                   'have a test expression',
+                                   directive.filename, *pos[1:])
+    return info
+
+
+def _include(out, ctxt, template, href, cls, pos, style, state):
+    """Write an included template, returning false if it isn't found."""
+    try:
+        included = template.loader.load(href, relative_to=pos[0],
+                                        cls=cls or template.__class__)
+    except TemplateNotFound:
+        return False
+    _write_included(out, ctxt, included, style, state)
+    return True
+
+
+def _include_required(out, ctxt, template, href, cls, pos, style, state):
+    """Like :func:`_include`, but let a missing template raise."""
+    included = template.loader.load(href, relative_to=pos[0],
+                                    cls=cls or template.__class__)
+    _write_included(out, ctxt, included, style, state)
+
+
+def _write_included(out, ctxt, included, style, state):
+    """Run the compiled function of an included template, or write the
+    stream Genshi generates from it if it can't be compiled. Templates that
+    include templates known not to compile aren't compiled themselves, so
+    that only happens for templates that weren't found or changed since."""
+    function = _compiled_function(included, style, None, False, state)
+    if function is None:
+        _emit_events(out, included.generate(ctxt), style, state)
+    else:
+        function(ctxt, out)
+
+
+_RUNTIME = dict(
+    _Macro=_Macro, _choice=_choice, _emit=_emit, _include=_include,
+    _include_required=_include_required, _open=_open,
+    _open_interpolated=_open_interpolated, _NO_ATTRS=_NO_ATTRS,
+    escape=escape, unicode=unicode,
+)
+
+
+def _initial_state(style):
+    """The namespace, whitespace and escaping state a serializer for
+    `style` starts in."""
+    prefixes = {'xml': (_XML_SPACE.namespace,)}
+    if style != 'xml':
+        prefixes[''] = (_XHTML_NAMESPACE,)
+    namespaces = {_XML_SPACE.namespace: ('xml',)}
+    return (tuple(sorted(prefixes.items())),
+            tuple(sorted(namespaces.items())), False, False)
+
+
+class _TemplateCompiler(object):
+    """Compiles the stream of a markup template into the source of a Python
+    function that writes the template serialized in a `style` to an
+    :class:`_Output`.
+
+    The compiler follows what the serializer's filters would do with the
+    events: it flattens namespaces, tracks where whitespace is preserved
+    and text isn't escaped, and writes elements without content as empty
+    tags. Markup that doesn't depend on the context is serialized while
+    compiling and written in one piece. Templates that use anything else,
+    such as match templates or directives from other modules, raise
+    :exc:`_Unsupported`.
+
+    """
+
+    def __init__(self, template, style, doctype, top, state):
+        self.template = template
+        self.style = style
+        self.doctype = doctype
+        self.top = top
+        prefixes, namespaces, preserve, noescape = state
+        self.prefixes = dict((prefix, list(uris)) for prefix, uris in prefixes)
+        self.namespaces = dict((uri, list(prefixes))
+                               for uri, prefixes in namespaces)
+        self.preserve = int(preserve)
+        self.noescape = noescape
+        self.ns_attrs = []
+        self.elements = []
+        # Whether a DOCTYPE and XML declaration were written: false if
+        # surely not, and None if that is only known when running.
+        if top:
+            self.have_doctype, self.have_decl = bool(doctype), False
+        else:
+            self.have_doctype = self.have_decl = None
+        self.lookup = None
+        self.constants = {}
+        self.constant_names = {}
+        self.names = count()
+        self.lines = []
+        self.indent = 1
+        # What is known to have been written since the last dynamic part:
+        # markup, text, or a pending start tag.
+        self.known = top
+        self.markup = []
+        self.text = []
+        self.pending = None
+
+    def compile(self):
+        """Return the compiled function."""
+        stream = self.template.stream
+        if self.top and self.doctype:
+            if stream and stream[0][0] is XML_DECL:
+                self.event(stream, 0)
+                stream = stream[1:]
+            self.write(_doctype_markup(self.doctype))
+            self.lines.append('    out.doctype = True')
+        self.events(stream)
+        self.materialize()
+        if self.elements or self.ns_attrs:
+            raise _Unsupported()
+        head = ['def render(ctxt, out):',
+                '    write = out.chunks.append',
+                '    add = out.add',
+                '    push = ctxt.push',
+                '    pop = ctxt.pop',
+                "    l = {'__data__': ctxt}"]
+        if self.lookup is not None:
+            head.append('    g = %s(ctxt)' % self.constant(self.lookup))
+        source = '\n'.join(head + self.lines) + '\n'
+        filename = self.template.filepath or '<string>'
+        code = compile(source, '<compiled %s>' % filename, 'exec')
+        namespace = dict(_RUNTIME)
+        namespace.update(self.constants)
+        exec code in namespace
+        return namespace['render']
+
+    def state_constant(self):
+        state = self.state()
+        return self.constant(state, ('state', state))
+
+    def state(self):
+        """The namespace, whitespace and escaping state at this point."""
+        return (tuple(sorted((prefix, tuple(uris))
+                             for prefix, uris in self.prefixes.iteritems())),
+                tuple(sorted((uri, tuple(prefixes)) for uri, prefixes
+                             in self.namespaces.iteritems())),
+                self.preserve > 0, self.noescape)
+
+    def line(self, code):
+        self.lines.append('    ' * self.indent + code)
+
+    def name(self, prefix):
+        return '%s%d' % (prefix, self.names.next())
+
+    def constant(self, value, key=None):
+        """Return the name of a constant for `value` in the function, the
+        same for equal strings or values with the same `key`."""
+        if key is None:
+            if isinstance(value, basestring):
+                key = (type(value), value)
+            else:
+                key = id(value)
+        if key not in self.constant_names:
+            name = '_k%d' % len(self.constants)
+            self.constants[name] = value
+            self.constant_names[key] = name
+        return self.constant_names[key]
+
+    def evaluate(self, expr):
+        """Return the source that evaluates `expr`."""
+        if self.lookup is None:
+            self.lookup = expr._globals
+        elif expr._globals != self.lookup:
+            raise _Unsupported()
+        return 'eval(%s, g, l)' % self.constant(expr.code)
+
+    # Writing output
+
+    def flush(self):
+        """Write the text or pending start tag so far."""
+        if self.known:
+            self.resolve()
+        else:
+            self.line('out.flush(%r)' % (self.preserve > 0))
+            self.known = True
+
+    def write(self, markup):
+        """Write `markup` after the text or pending start tag so far."""
+        self.flush()
+        self.markup.append(markup)
+
+    def write_text(self, text):
+        """Write escaped `text`."""
+        if self.known:
+            if self.pending is not None:
+                self.markup.append(self.pending[0])
+                self.pending = None
+            self.text.append(text)
+        else:
+            self.line('add(%s)' % self.constant(text))
+
+    def write_start(self, start, empty):
+        """Write a start tag that is written as `empty` if the element turns
+        out to have no content."""
+        self.flush()
+        self.pending = (start, empty)
+
+    def write_end(self, end):
+        if self.known:
+            if self.pending is not None:
+                self.markup.append(self.pending[1])
+                self.pending = None
+            else:
+                self.write(end)
+        else:
+            self.line('out.end(%s, %r)' % (self.constant(end),
+                                           self.preserve > 0))
+            self.known = True
+
+    def resolve(self):
+        """Serialize the known text or pending start tag as markup."""
+        if self.pending is not None:
+            self.markup.append(self.pending[0])
+            self.pending = None
+        elif self.text:
+            text = u''.join(self.text)
+            self.text = []
+            if not self.preserve and '\n' in text:
+                text = _BLANK_LINES.sub('\n', _TRAILING_SPACE.sub('', text))
+            self.markup.append(text)
+
+    def materialize(self):
+        """Generate the code that writes what is known to have been written,
+        before a dynamic part of the template."""
+        if not self.known:
+            return
+        markup = u''.join(self.markup)
+        if markup:
+            self.line('write(%s)' % self.constant(Markup(markup)))
+        if self.pending is not None:
+            self.line('out.pending = %s' % self.constant(self.pending))
+        elif self.text:
+            self.line('add(%s)' % self.constant(Markup(u''.join(self.text))))
+        self.markup, self.text, self.pending = [], [], None
+        self.known = False
+
+    def block(self, header):
+        self.materialize()
+        self.line(header)
+        self.indent += 1
+        return len(self.lines)
+
+    def end_block(self, start):
+        self.materialize()
+        if len(self.lines) == start:
+            self.line('pass')
+        self.indent -= 1
+
+    # Compiling events
+
+    def events(self, stream, extra=None):
+        for index in xrange(len(stream)):
+            if stream[index][0] is START:
+                self.start(stream, index, extra)
+                extra = None
+            else:
+                self.event(stream, index)
+
+    def event(self, stream, index):
+        kind, data, pos = stream[index]
+        if kind is TEXT:
+            if self.noescape:
+                self.write_text(Markup(data))
+            else:
+                self.write_text(escape(data, False))
+        elif kind is START:
+            self.start(stream, index)
+        elif kind is END:
+            self.end(data)
+        elif kind is EXPR:
+            self.expr(data)
+        elif kind is SUB:
+            self.sub(data[0], data[1])
+        elif kind is EXEC:
+            self.materialize()
+            self.line('%s.execute(ctxt)' % self.constant(data))
+        elif kind is INCLUDE:
+            self.include(data, pos)
+        elif kind is START_NS:
+            following = stream[index + 1:index + 2]
+            if not following or following[0][0] not in (START, START_NS,
+                                                         SUB):
+                raise _Unsupported()
+            self.start_ns(data)
+        elif kind is END_NS:
+            self.end_ns(data)
+        elif kind is COMMENT:
+            self.write(Markup('<!--%s-->' % data))
+        elif kind is PI:
+            self.write(Markup('<?%s %s?>' % data))
+        elif kind is DOCTYPE:
+            self.special(_doctype_markup(data), 'doctype')
+        elif kind is XML_DECL:
+            if self.style == 'xml':
+                self.special(_decl_markup(data), 'decl')
+            else:
+                self.flush()
+        elif kind is START_CDATA:
+            self.write(Markup(self.style != 'html' and '<![CDATA[' or ''))
+            self.noescape = True
+        elif kind is END_CDATA:
+            self.write(Markup(self.style != 'html' and ']]>' or ''))
+            self.noescape = False
+        else:
+            raise _Unsupported()
+
+    def special(self, markup, which):
+        """Write a DOCTYPE or XML declaration, which is only written once."""
+        attr = 'have_' + which
+        if getattr(self, attr) is False and self.indent == 1:
+            self.write(markup)
+            self.line('out.%s = True' % which)
+            setattr(self, attr, True)
+        elif getattr(self, attr):
+            self.flush()
+        else:
+            self.flush()
+            self.materialize()
+            self.line('if not out.%s:' % which)
+            self.line('    write(%s)' % self.constant(markup))
+            self.line('    out.%s = True' % which)
+            setattr(self, attr, None)
+
+    def flatten(self, name):
+        """Return the prefixed name for a qualified `name`."""
+        if not name.namespace:
+            return name.localname
+        if name.namespace not in self.namespaces:
+            raise _Unsupported()
+        prefix = self.namespaces[name.namespace][-1]
+        if prefix:
+            return u'%s:%s' % (prefix, name.localname)
+        return name.localname
+
+    def has_content(self, stream, index):
+        """Whether the element starting at `index` of `stream` surely has
+        content, so that it isn't written as an empty tag."""
+        depth = 0
+        for kind, data, pos in stream[index:]:
+            if kind is START:
+                depth += 1
+                if depth > 1:
+                    return True
+            elif kind is END:
+                return False
+            elif kind not in _EVALUATED:
+                return True
+        return False
+
+    def start(self, stream, index, extra=None, strip=None):
+        """Compile a start tag, with the value of ``py:attrs`` as `extra`
+        and the value of ``py:strip`` as `strip` if they are dynamic."""
+        tag, attrs = stream[index][1]
+        if self.noescape:
+            raise _Unsupported()
+        space = attrs.get(_XML_SPACE)
+        if type(space) is list:
+            raise _Unsupported()
+        preserve = (tag in _PRESERVE_ELEMS[self.style] or
+                    space == 'preserve')
+        noescape = tag in _NOESCAPE_ELEMS[self.style]
+        if strip is not None and (noescape or preserve and not self.preserve):
+            raise _Unsupported()
+        tagname = self.flatten(tag)
+        ns_attrs, self.ns_attrs = self.ns_attrs, []
+        empty = not self.has_content(stream, index)
+        dynamic = extra is not None or any(type(value) is list
+                                           for name, value in attrs)
+        if not dynamic:
+            attrs = Attrs(ns_attrs + [(self.flatten(name), value)
+                                      for name, value in attrs])
+            start = _start_tag(self.style, tagname, attrs)
+            if empty:
+                self.write_start(start, _start_tag(self.style, tagname,
+                                                   attrs, True))
+            else:
+                self.write(start)
+        else:
+            converted = []
+            for name, value in attrs:
+                if type(value) is list:
+                    value = [self.attr_part(event) for event in value]
+                if extra is None:
+                    name = self.flatten(name)
+                else:
+                    self.flatten(name)
+                converted.append((name, value))
+            self.materialize()
+            if extra is None and space is None:
+                element = (self.style, tagname, ns_attrs + converted,
+                           self.preserve > 0, empty)
+                self.line('_open_interpolated(out, %s, g, l, %s)'
+                          % (self.constant(element),
+                             self.constant(self.template)))
+            else:
+                prefixes = dict((uri, prefixes[-1]) for uri, prefixes
+                                in self.namespaces.iteritems())
+                element = (self.style, tagname, ns_attrs, Attrs(converted),
+                           prefixes, self.preserve > 0, empty)
+                if extra is None:
+                    value = '_NO_ATTRS'
+                else:
+                    value = self.evaluate(extra)
+                self.line('_open(out, %s, %s, g, l, %s)'
+                          % (self.constant(element), value,
+                             self.constant(self.template)))
+        if self.preserve or preserve:
+            self.preserve += 1
+        if noescape:
+            self.noescape = True
+        self.elements.append(tag)
+
+    def attr_part(self, event):
+        kind, data, pos = event
+        if kind is TEXT:
+            return data
+        if kind is EXPR:
+            self.evaluate(data)
+            return data.code
+        raise _Unsupported()
+
+    def end(self, tag):
+        if not self.elements:
+            raise _Unsupported()
+        self.elements.pop()
+        self.write_end(Markup('</%s>' % self.flatten(tag)))
+        self.noescape = False
+        if self.preserve:
+            self.preserve -= 1
+
+    def start_ns(self, data):
+        prefix, uri = data
+        if uri not in self.namespaces:
+            prefix = self.prefixes.get(uri, [prefix])[-1]
+            self.ns_attrs.append(('xmlns%s' % (prefix and ':%s' % prefix
+                                               or ''), uri))
+        self.namespaces.setdefault(uri, []).append(prefix)
+        self.prefixes.setdefault(prefix, []).append(uri)
+        self.flush()
+
+    def end_ns(self, prefix):
+        if prefix in self.prefixes:
+            uris = self.prefixes[prefix]
+            uri = uris.pop()
+            if not uris:
+                del self.prefixes[prefix]
+            if uri not in uris or uri != uris[-1]:
+                prefixes = self.namespaces[uri]
+                prefixes.pop()
+                if not prefixes:
+                    del self.namespaces[uri]
+            if self.ns_attrs:
+                attr = ('xmlns%s' % (prefix and ':%s' % prefix or ''), uri)
+                if attr in self.ns_attrs:
+                    self.ns_attrs.remove(attr)
+        self.flush()
+
+    def expr(self, expr):
+        self.materialize()
+        state = self.state_constant()
+        self.line('v = %s' % self.evaluate(expr))
+        if self.noescape:
+            self.line('if v is not None:')
+        else:
+            self.line('if v.__class__ is unicode:')
+            self.line('    add(escape(v, False))')
+            self.line('elif v is not None:')
+        self.line('    _emit(out, v, %r, %s, ctxt, %s)'
+                  % (self.style, state, self.constant(self.template)))
+        self.unknown_specials()
+
+    def include(self, (href, cls, fallback), pos):
+        if not isinstance(href, basestring):
+            raise _Unsupported()
+        loader = self.template.loader
+        if loader is not None:
+            # An included template that can't be compiled may define match
+            # templates for the rest of the output.
+            try:
+                included = loader.load(href, relative_to=pos[0],
+                                       cls=cls or self.template.__class__)
+            except TemplateError:
+                pass
+            else:
+                if _compiled_function(included, self.style, None, False,
+                                      self.state()) is None:
+                    raise _Unsupported()
+        self.materialize()
+        args = 'out, ctxt, %s, %s, %s, %s, %r, %s' % (
+            self.constant(self.template), self.constant(href),
+            self.constant(cls), self.constant(pos), self.style,
+            self.state_constant())
+        if fallback is None:
+            self.line('_include_required(%s)' % args)
+        else:
+            start = self.block('if not _include(%s):' % args)
+            self.events(fallback)
+            self.end_block(start)
+        self.unknown_specials()
+
+    def unknown_specials(self):
+        # Included templates and py:def functions may write a DOCTYPE.
+        self.have_doctype = self.have_doctype or None
+        self.have_decl = self.have_decl or None
+
+    # Compiling directives
 
-try:
-    from flask import signals_available
-except ImportError:
-    signals_available = False
-else:
-    from flask.signals import Namespace
-    signals = Namespace()
-    template_generated = signals.signal('template-generated')
+    def sub(self, directives, stream):
+        if self.ns_attrs and any(type(directive) not in (AttrsDirective,
+                                                         WithDirective)
+                                 for directive in directives):
+            raise _Unsupported()
+        state = self.state()
+        self.directives(list(directives), stream)
+        if self.state() != state:
+            raise _Unsupported()
+
+    def directives(self, directives, stream, extra=None):
+        if not directives:
+            self.events(stream, extra)
+            return
+        directive, rest = directives[0], directives[1:]
+        cls = type(directive)
+        if cls is IfDirective:
+            start = self.block('if %s:' % self.evaluate(directive.expr))
+            self.directives(rest, stream, extra)
+            self.end_block(start)
+        elif cls is ForDirective:
+            self.materialize()
+            items, scope, item = (self.name('items'), self.name('scope'),
+                                  self.name('item'))
+            self.line('%s = %s' % (items, self.evaluate(directive.expr)))
+            self.block('if %s is not None:' % items)
+            self.line('%s = {}' % scope)
+            start = self.block('for %s in %s:' % (item, items))
+            self.line('%s(%s, %s)' % (self.constant(directive.assign), scope,
+                                      item))
+            self.line('push(%s)' % scope)
+            self.directives(rest, stream, extra)
+            self.materialize()
+            self.line('pop()')
+            self.end_block(start)
+            self.indent -= 1
+        elif cls is ChooseDirective:
+            self.materialize()
+            info = self.name('choice')
+            if directive.expr:
+                value = self.evaluate(directive.expr)
+            else:
+                value = 'None'
+            self.line('%s = [False, %r, %s]' % (info, bool(directive.expr),
+                                                value))
+            self.line('ctxt._choice_stack.append(%s)' % info)
+            self.directives(rest, stream, extra)
+            self.materialize()
+            self.line('ctxt._choice_stack.pop()')
+        elif cls is WhenDirective or cls is OtherwiseDirective:
+            self.materialize()
+            info = self.name('choice')
+            self.line('%s = _choice(ctxt, %s, %s, %r)' % (
+                info, self.constant(directive), self.constant(stream[0][2]),
+                cls is WhenDirective and not directive.expr))
+            self.block('if not %s[0]:' % info)
+            if cls is OtherwiseDirective:
+                self.line('%s[0] = True' % info)
+            elif directive.expr:
+                value = self.evaluate(directive.expr)
+                self.line('%s[0] = %s[2] == %s if %s[1] else bool(%s)' % (
+                    info, info, value, info, value))
+            else:
+                self.line('%s[0] = bool(%s[2])' % (info, info))
+            start = self.block('if %s[0]:' % info)
+            self.directives(rest, stream, extra)
+            self.end_block(start)
+            self.indent -= 1
+        elif cls is WithDirective:
+            self.materialize()
+            frame = self.name('frame')
+            self.line('%s = {}' % frame)
+            self.line('push(%s)' % frame)
+            for targets, expr in directive.vars:
+                value = self.name('value')
+                self.line('%s = %s' % (value, self.evaluate(expr)))
+                for assign in targets:
+                    self.line('%s(%s, %s)' % (self.constant(assign), frame,
+                                              value))
+            self.directives(rest, stream, extra)
+            self.materialize()
+            self.line('pop()')
+        elif cls is AttrsDirective:
+            self.directives(rest, stream, directive.expr)
+        elif cls is StripDirective:
+            if rest:
+                raise _Unsupported()
+            if not directive.expr:
+                if extra is not None:
+                    self.materialize()
+                    self.line(self.evaluate(extra))
+                self.events(stream[1:-1])
+            else:
+                self.strip(directive.expr, stream, extra)
+        elif cls is DefDirective:
+            self.define(directive, rest, stream, extra)
+        else:
+            raise _Unsupported()
+
+    def strip(self, expr, stream, extra):
+        if self.ns_attrs:
+            raise _Unsupported()
+        self.materialize()
+        strip = self.name('strip')
+        self.line('%s = %s' % (strip, self.evaluate(expr)))
+        start = self.block('if not %s:' % strip)
+        self.start(stream, 0, extra, strip)
+        self.end_block(start)
+        self.events(stream[1:-1])
+        start = self.block('if not %s:' % strip)
+        self.end(stream[-1][1])
+        self.end_block(start)
+
+    def define(self, directive, rest, stream, extra):
+        self.materialize()
+        body = self.name('_body')
+        state = self.state()
+        elements = self.elements
+        self.elements = []
+        have = self.have_doctype, self.have_decl
+        self.have_doctype = self.have_decl = None
+        start = self.block('def %s():' % body)
+        self.directives(rest, stream, extra)
+        self.end_block(start)
+        if self.elements or self.state() != state:
+            raise _Unsupported()
+        self.elements = elements
+        self.have_doctype, self.have_decl = have
+        function = self.name('_def')
+        self.line('def %s(*args, **kwargs):' % function)
+        definition = (directive, rest, stream)
+        self.line('    return _Macro(%s, %s, ctxt, out, %s, args, kwargs)' % (
+            body, self.constant(definition), self.state_constant()))
+        self.line('%s.__name__ = %s' % (function,
+                                        self.constant(directive.name)))
+        self.line('ctxt.frames[-1][%s] = %s' % (self.constant(directive.name),
+                                                function))
+
+
+def _compiled_function(template, style, doctype, top, state):
+    """Return the compiled function for `template`, rendered in `style`
+    with `doctype` from the serializer in the namespace, whitespace and
+    escaping `state`, or :const:`None` if it can't be compiled."""
+    compiled = template.__dict__.setdefault('_compiled', {})
+    key = (style, doctype, top, state)
+    if key not in compiled:
+        # Templates that include themselves aren't compiled.
+        compiled[key] = function = None
+        if (isinstance(template, MarkupTemplate) and
+                template._number_conv is Markup and
+                template.filters == [template._flatten, template._match,
+                                     template._include]):
+            try:
+                function = _TemplateCompiler(template, style, doctype, top,
+                                             state).compile()
+            except _Unsupported:
+                pass
+        compiled[key] = function
+    return compiled[key]
+
+
+def _render_compiled(function, ctxt):
+    """Run a compiled template `function` with `ctxt`, returning the
+    serialized output."""
+    out = _Output()
+    function(ctxt, out)
+    out.flush(False)
+    return u''.join(out.chunks)
+
+
+class _RenderPlan(object):
+    """What rendering with a `method` of `genshi` involves, resolved once:
+    the template class, the mimetype, a factory for the serializer with
+    the doctype looked up, the minifier if any, the minimum size to
+    compress and the compiled filter pipeline, whether any of its
+    filters take the context, and the style and doctype to compile
+    templates for if the compiled engine can render them."""
+
+    __slots__ = ('changes', 'method', 'class_', 'mimetype', 'serializer',
+                 'serializer_factory', 'errors', 'minifier',
+                 'compress_min_size', 'pipeline', 'context_filters',
+                 'compiled_style', 'doctype')
+
+    def __init__(self, genshi, method):
+        self.changes = genshi._changes.count
+        options = genshi.methods[method]
+        self.method = method
+        self.class_ = options.get('class', MarkupTemplate)
+        self.mimetype = options.get('mimetype', 'text/html')
+        render_args = genshi._render_args(method)
+        self.serializer = render_args.pop('method')
+        doctype = render_args.get('doctype')
+        if isinstance(doctype, basestring):
+            render_args['doctype'] = DocType.get(doctype)
+        serializer = self.serializer
+        if isinstance(serializer, basestring):
+            serializer = _SERIALIZERS[serializer.lower()]
+        self.serializer_factory = partial(serializer, **render_args)
+        self.errors = _encoding_errors(self.serializer)
+        self.minifier = None
+        if options.get('minify'):
+            if issubclass(serializer, TextSerializer):
+                self.minifier = partial(_minify_text,
+                                        css=self.mimetype == 'text/css')
+            else:
+                self.minifier = partial(
+                    _minify_markup,
+                    html=issubclass(serializer, XHTMLSerializer))
+        self.compress_min_size = options.get('compress_min_size')
+        self.pipeline = genshi._filter_pipeline(method)
+        self.context_filters = any(takes_context
+                                   for _, takes_context in self.pipeline)
+        self.doctype = render_args.get('doctype')
+        self.compiled_style = None
+        if (not self.pipeline and self.minifier is None and
+                issubclass(self.class_, MarkupTemplate)):
+            self.compiled_style = _COMPILED_STYLES.get(serializer)
+
+    def serialize(self, stream):
+        """Serialize `stream`, returning an iterator of strings."""
+        if self.minifier is not None:
+            stream = Stream(self.minifier(stream))
+        return stream.serialize(method=self.serializer_factory)
+
+    def render(self, stream, encoding=None):
+        """Serialize `stream` to a string, encoded with `encoding` one
+        chunk at a time if given."""
+        if encoding is None:
+            return u''.join(self.serialize(stream))
+        errors = self.errors
+        return ''.join([chunk.encode(encoding, errors)
+                        for chunk in self.serialize(stream)])
+
+
+class _app_property(object):
+    """Like :class:`~werkzeug.cached_property`, but with a value for each
+    application, created by calling the decorated function with the
+    extension and the application. It can be set and deleted for the
+    current application."""
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, genshi, type=None):
+        if genshi is None:
+            return self
+        app = genshi._app()
+        values = genshi._app_values.setdefault(app, {})
+        try:
+            return values[self.__name__]
+        except KeyError:
+            value = values[self.__name__] = self.func(genshi, app)
+            return value
+
+    def __set__(self, genshi, value):
+        genshi._app_values.setdefault(genshi._app(), {})[self.__name__] = value
+
+    def __delete__(self, genshi):
+        genshi._app_values.get(genshi._app(), {}).pop(self.__name__, None)
 
 
 class Genshi(object):
@@ -48,9 +3185,8 @@ class Genshi(object):
     """
 
     def __init__(self, app=None):
-
-        if app is not None:
-            self.init_app(app)
+        self._changes = _Changes()
+        self._plans = {}
 
         #: A callable for Genshi's callback interface, called when a template
         #: is loaded, with the template as the only argument.
@@ -74,6 +3210,11 @@ class Genshi(object):
         #:
         #: .. versionchanged:: 0.3 Support for Javascript and CSS.
         #: .. versionchanged:: 0.4 Support for SVG.
+        #: .. versionchanged:: 0.6
+        #:     Methods with a true ``minify`` option have comments and
+        #:     insignificant whitespace removed from their output. The
+        #:     ``compress_min_size`` option overrides
+        #:     ``GENSHI_COMPRESS_MIN_SIZE``.
         self.methods = {
             'html': {
                 'serializer': 'html',
@@ -119,6 +3260,21 @@ class Genshi(object):
         #: .. versionadded:: 0.3
         self.filters = defaultdict(list)
 
+        self._pipelines = {}
+        self._loaders = WeakKeyDictionary()
+        self._watchers = WeakKeyDictionary()
+        self._app_values = WeakKeyDictionary()
+
+        if app is not None:
+            self.init_app(app)
+
+    def __setattr__(self, name, value):
+        # Changes to these invalidate render plans.
+        if name in ('extensions', 'methods', 'filters'):
+            value = _tracked(value, self._changes)
+            self._changes.count += 1
+        object.__setattr__(self, name, value)
+
     def init_app(self, app):
         """Initialize a :class:`~flask.Flask` application
         for use with this extension. Useful for the factory pattern but
@@ -134,7 +3290,55 @@ class Genshi(object):
 
         .. versionadded:: 0.4
 
+        .. versionchanged:: 0.6
+            Reads the ``GENSHI_STRING_CACHE_SIZE``, ``GENSHI_STREAM``,
+            ``GENSHI_STREAM_CHUNK_SIZE``, ``GENSHI_PRELOAD``,
+            ``GENSHI_CACHE_DIR``, ``GENSHI_FRAGMENT_CACHE_SIZE``,
+            ``GENSHI_FRAGMENT_CACHE_TIMEOUT``, ``GENSHI_ETAG``,
+            ``GENSHI_RESPONSE_CACHE_SIZE``,
+            ``GENSHI_RESPONSE_CACHE_TIMEOUT``, ``GENSHI_ASYNC_WORKERS``,
+            ``GENSHI_RENDER_STATS``, ``GENSHI_RENDER_STATS_SAMPLES``,
+            ``GENSHI_SERVER_TIMING``, ``GENSHI_ENCODING``,
+            ``GENSHI_COMPRESS``, ``GENSHI_COMPRESS_MIN_SIZE``,
+            ``GENSHI_COMPRESS_LEVEL``, ``GENSHI_CACHE_SIZE``,
+            ``GENSHI_CACHE_MEMORY``, ``GENSHI_AUTO_RELOAD``,
+            ``GENSHI_RELOAD_INTERVAL``, ``GENSHI_RELOAD_WATCH``,
+            ``GENSHI_STRICT_CONTEXT``, ``GENSHI_COMPILE``,
+            ``GENSHI_SHARED_TEMPLATES`` and ``GENSHI_DROP_POSITIONS``
+            configuration values. The extension can be initialized for
+            several applications, which each get their own
+            :attr:`template_loader`, caches, :attr:`executor` and
+            :attr:`render_stats`.
+
         """
+        app.config.setdefault('GENSHI_STRING_CACHE_SIZE', 25)
+        app.config.setdefault('GENSHI_STREAM', False)
+        app.config.setdefault('GENSHI_STREAM_CHUNK_SIZE', 8192)
+        app.config.setdefault('GENSHI_PRELOAD', False)
+        app.config.setdefault('GENSHI_CACHE_DIR', None)
+        app.config.setdefault('GENSHI_FRAGMENT_CACHE_SIZE', 100)
+        app.config.setdefault('GENSHI_FRAGMENT_CACHE_TIMEOUT', 300)
+        app.config.setdefault('GENSHI_ETAG', False)
+        app.config.setdefault('GENSHI_RESPONSE_CACHE_SIZE', 100)
+        app.config.setdefault('GENSHI_RESPONSE_CACHE_TIMEOUT', 300)
+        app.config.setdefault('GENSHI_ASYNC_WORKERS', 4)
+        app.config.setdefault('GENSHI_RENDER_STATS', False)
+        app.config.setdefault('GENSHI_RENDER_STATS_SAMPLES', 1000)
+        app.config.setdefault('GENSHI_SERVER_TIMING', False)
+        app.config.setdefault('GENSHI_ENCODING', None)
+        app.config.setdefault('GENSHI_COMPRESS', False)
+        app.config.setdefault('GENSHI_COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('GENSHI_COMPRESS_LEVEL', 6)
+        app.config.setdefault('GENSHI_CACHE_SIZE', 25)
+        app.config.setdefault('GENSHI_CACHE_MEMORY', None)
+        app.config.setdefault('GENSHI_AUTO_RELOAD', None)
+        app.config.setdefault('GENSHI_RELOAD_INTERVAL', 0)
+        app.config.setdefault('GENSHI_RELOAD_WATCH', False)
+        app.config.setdefault('GENSHI_STRICT_CONTEXT', False)
+        app.config.setdefault('GENSHI_COMPILE', False)
+        app.config.setdefault('GENSHI_SHARED_TEMPLATES', False)
+        app.config.setdefault('GENSHI_DROP_POSITIONS', False)
+
         if not hasattr(app, 'extensions'):
             app.extensions = {}
 
@@ -142,6 +3346,9 @@ class Genshi(object):
         app.genshi_instance = self
         self.app = app
 
+        if app.config['GENSHI_PRELOAD']:
+            self.preload(app)
+
     def template_parsed(self, callback):
         """Set up a calback to be called with a template when it is first
         loaded and parsed. This is the correct way to set up the
@@ -151,24 +3358,229 @@ class Genshi(object):
 
         """
         self.callback = callback
+        for loader in self._loaders.values():
+            loader.callback = callback
         return callback
 
-    @cached_property
+    def _app(self):
+        """The current application, or outside of an application context
+        the one the extension was last initialized with."""
+        if current_app:
+            return current_app._get_current_object()
+        return self.app
+
+    @property
     def template_loader(self):
         """A :class:`genshi.template.TemplateLoader` that loads templates
         from the same places as Flask.
 
+        .. versionchanged:: 0.6
+            A :class:`FlaskTemplateLoader` that keeps parsed templates in the
+            ``GENSHI_CACHE_DIR`` directory if it is set, and reloads them as
+            configured by ``GENSHI_AUTO_RELOAD``, ``GENSHI_RELOAD_INTERVAL``
+            and ``GENSHI_RELOAD_WATCH``. It keeps ``GENSHI_CACHE_SIZE``
+            parsed templates, within ``GENSHI_CACHE_MEMORY`` bytes if set,
+            and finds them with a :class:`TemplateIndex` that includes the
+            template folders of blueprints. Each application has its own
+            loader, and this is the one of the current application. With
+            ``GENSHI_SHARED_TEMPLATES`` the loaders share parsed templates
+            through :data:`shared_templates`, and with
+            ``GENSHI_DROP_POSITIONS`` templates are loaded without the line
+            and column of their events.
+
+        """
+        return self._loader(self._app())
+
+    @template_loader.setter
+    def template_loader(self, loader):
+        self._loaders[self._app()] = loader
+
+    @template_loader.deleter
+    def template_loader(self):
+        self._loaders.pop(self._app(), None)
+
+    @property
+    def template_watcher(self):
+        """The :class:`TemplateWatcher` reloading changed templates of the
+        current application if ``GENSHI_RELOAD_WATCH`` is set, once its
+        :attr:`template_loader` has been created.
+
+        .. versionadded:: 0.6
+
         """
-        path = loader.directory(os.path.join(self.app.root_path, 'templates'))
-        module_paths = {}
-        modules = getattr(self.app, 'modules', {})
-        for name, module in modules.iteritems():
+        return self._watchers.get(self._app())
+
+    def _loader(self, app):
+        """The :attr:`template_loader` of `app`, created if needed."""
+        try:
+            return self._loaders[app]
+        except KeyError:
+            loader = self._loaders[app] = self._create_loader(app)
+            return loader
+
+    def _create_loader(self, app):
+        """Create the :attr:`template_loader` for `app`."""
+        config = app.config
+        paths = self._template_paths(app)
+        auto_reload = config['GENSHI_AUTO_RELOAD']
+        if auto_reload is None:
+            auto_reload = app.debug
+        watch = config['GENSHI_RELOAD_WATCH']
+        reload_interval = config['GENSHI_RELOAD_INTERVAL']
+        index = TemplateIndex(paths, remember_missing=watch or not auto_reload)
+        template_loader = FlaskTemplateLoader(
+            [index],
+            config['GENSHI_CACHE_DIR'],
+            reload_interval=None if watch else reload_interval,
+            max_cache_size=config['GENSHI_CACHE_SIZE'],
+            max_cache_memory=config['GENSHI_CACHE_MEMORY'],
+            store=shared_templates if config['GENSHI_SHARED_TEMPLATES']
+                  else None,
+            drop_positions=config['GENSHI_DROP_POSITIONS'],
+            auto_reload=auto_reload or watch,
+            callback=self.callback)
+        if watch:
+            watcher = self._watchers[app] = TemplateWatcher(
+                template_loader, [p for _, p in paths],
+                reload_interval or 1.0)
+            watcher.start()
+        return template_loader
+
+    def _template_paths(self, app=None):
+        """The template directories of `app`, by default the current
+        application, as a list of ``(prefix, path)`` pairs in order of
+        precedence, starting with the application's own directory which has
+        no prefix. Modules have their name as prefix, and blueprints with a
+        template folder are searched without one, after the application,
+        like Flask does.
+
+        """
+        if app is None:
+            app = self._app()
+        paths = [(None, os.path.join(app.root_path, 'templates'))]
+        blueprints = getattr(app, 'blueprints', None)
+        if blueprints is None:
+            blueprints = {}
+            modules = getattr(app, 'modules', {})
+        else:
+            modules = dict((name, blueprint)
+                           for name, blueprint in blueprints.iteritems()
+                           if blueprint_is_module(blueprint))
+        for name, module in sorted(modules.iteritems()):
             module_path = os.path.join(module.root_path, 'templates')
             if os.path.isdir(module_path):
-                module_paths[name] = loader.directory(module_path)
-        return TemplateLoader([path, loader.prefixed(**module_paths)],
-                              auto_reload=self.app.debug,
-                              callback=self.callback)
+                paths.append((name, module_path))
+        for name, blueprint in sorted(blueprints.iteritems()):
+            folder = getattr(blueprint, 'template_folder', None)
+            if folder is not None and not blueprint_is_module(blueprint):
+                paths.append((None, os.path.join(blueprint.root_path,
+                                                 folder)))
+        return paths
+
+    def preload(self, app=None):
+        """Load and parse every template in the template directories of
+        `app`, by default the current application, and its modules with its
+        :attr:`template_loader`, so the first requests don't have to.
+        Templates with an extension that is not in :attr:`extensions` are
+        skipped.
+
+        Returns a dict of the time in seconds spent loading each template,
+        by template name.
+
+        This is done from :meth:`init_app` if the ``GENSHI_PRELOAD``
+        configuration value is true, in which case the
+        :meth:`template_parsed` callback should be set up before
+        :meth:`init_app` is called. Preloading before a forking server such
+        as Gunicorn forks lets the workers share the parsed templates.
+
+        .. versionadded:: 0.6
+
+        """
+        if app is None:
+            app = self._app()
+        loader = self._loader(app)
+        timings = {}
+        for name, filepath in _walk_templates(self._template_paths(app)):
+            ext = os.path.splitext(name)[1][1:]
+            if name in timings or ext not in self.extensions:
+                continue
+            method = self.extensions[ext]
+            class_ = self.methods[method].get('class', MarkupTemplate)
+            started = time()
+            loader.load(name, cls=class_)
+            timings[name] = time() - started
+        return timings
+
+    @_app_property
+    def string_cache(self, app):
+        """A :class:`TemplateCache` for templates rendered from strings,
+        sized by the ``GENSHI_STRING_CACHE_SIZE`` configuration value.
+
+        .. versionadded:: 0.6
+
+        """
+        return TemplateCache(app.config['GENSHI_STRING_CACHE_SIZE'])
+
+    @_app_property
+    def fragment_cache(self, app):
+        """The cache for the ``cache:fragment`` directive, by default a
+        :class:`MemoryCache` sized by the ``GENSHI_FRAGMENT_CACHE_SIZE``
+        configuration value, keeping fragments for
+        ``GENSHI_FRAGMENT_CACHE_TIMEOUT`` seconds. It can be set to any
+        :class:`~werkzeug.contrib.cache.BaseCache`, such as a
+        :class:`~werkzeug.contrib.cache.MemcachedCache`, or to ``None`` to
+        disable fragment caching.
+
+        .. versionadded:: 0.6
+
+        """
+        capacity = app.config['GENSHI_FRAGMENT_CACHE_SIZE']
+        if not capacity:
+            return None
+        return MemoryCache(capacity,
+                           app.config['GENSHI_FRAGMENT_CACHE_TIMEOUT'])
+
+    @_app_property
+    def response_cache(self, app):
+        """The cache for responses rendered by :func:`render_response` with
+        a fingerprint, by default a :class:`MemoryCache` sized by the
+        ``GENSHI_RESPONSE_CACHE_SIZE`` configuration value, keeping
+        responses for ``GENSHI_RESPONSE_CACHE_TIMEOUT`` seconds. Like
+        :attr:`fragment_cache` it can be set to any
+        :class:`~werkzeug.contrib.cache.BaseCache`, or to ``None`` to
+        disable response caching.
+
+        .. versionadded:: 0.6
+
+        """
+        capacity = app.config['GENSHI_RESPONSE_CACHE_SIZE']
+        if not capacity:
+            return None
+        return MemoryCache(capacity,
+                           app.config['GENSHI_RESPONSE_CACHE_TIMEOUT'])
+
+    @_app_property
+    def executor(self, app):
+        """A pool of ``GENSHI_ASYNC_WORKERS`` threads used by
+        :func:`render_template_async` and friends, a
+        :class:`multiprocessing.pool.ThreadPool`.
+
+        .. versionadded:: 0.6
+
+        """
+        from multiprocessing.pool import ThreadPool
+        return ThreadPool(app.config['GENSHI_ASYNC_WORKERS'])
+
+    @_app_property
+    def render_stats(self, app):
+        """A :class:`RenderStats` with the timings of renders while the
+        ``GENSHI_RENDER_STATS`` configuration value is true, keeping the
+        last ``GENSHI_RENDER_STATS_SAMPLES`` timings of each phase.
+
+        .. versionadded:: 0.6
+
+        """
+        return RenderStats(app.config['GENSHI_RENDER_STATS_SAMPLES'])
 
     def filter(self, *methods):
         """Decorator that adds a function to apply filters
@@ -179,13 +3591,60 @@ class Genshi(object):
         .. versionchanged:: 0.5
             Filters can now optionally take a second argument for the context.
 
+        .. versionchanged:: 0.6
+            :class:`~genshi.filters.Transformer` instances can be used as
+            filters directly, and consecutive ones are combined into one.
+
         """
         def decorator(function):
             for method in methods:
                 self.filters[method].append(function)
+                self._pipelines.pop(method, None)
             return function
         return decorator
 
+    def _filter_pipeline(self, method):
+        """The filters for ``method`` compiled into a list of
+        ``(function, takes_context)`` pairs, recompiled when the filters
+        change.
+
+        """
+        filters = tuple(self.filters.get(method, ()))
+        try:
+            compiled_filters, pipeline = self._pipelines[method]
+        except KeyError:
+            pass
+        else:
+            if compiled_filters == filters:
+                return pipeline
+        pipeline = []
+        transformers = []
+        for function in filters + (None,):
+            if isinstance(function, Transformer):
+                transformers.append(function)
+                continue
+            if transformers:
+                pipeline.append((_chain_transformers(transformers), False))
+                transformers = []
+            if function is not None:
+                pipeline.append((function, _takes_context(function)))
+        self._pipelines[method] = (filters, pipeline)
+        return pipeline
+
+    def _render_plan(self, template, method=None):
+        """The :class:`_RenderPlan` for rendering ``template`` with
+        ``method``, or the method for its extension. Plans are made once and
+        made again when :attr:`methods`, :attr:`extensions` or
+        :attr:`filters` change.
+
+        """
+        key = (template, method)
+        plan = self._plans.get(key)
+        if plan is None or plan.changes != self._changes.count:
+            plan = _RenderPlan(self, self._method_for(template, method))
+            self._plans[key] = plan
+        return plan
+
     def _method_for(self, template, method=None):
         """Selects a method from :attr:`Genshi.methods`
         based on the file extension of ``template``
@@ -197,6 +3656,120 @@ class Genshi(object):
             return self.extensions[ext]
         return method
 
+    def _jinja_namespace(self):
+        """The globals, filters and tests of the current application's
+        Jinja environment as a namespace for templates."""
+        return _JinjaNamespace(current_app.jinja_env)
+
+    def _render_args(self, method):
+        """Keyword arguments for serializing a stream with ``method``."""
+        render_args = dict(method=self.methods[method]['serializer'])
+        if 'doctype' in self.methods[method]:
+            render_args['doctype'] = self.methods[method]['doctype']
+        return render_args
+
+
+_arity_cache = WeakKeyDictionary()
+
+
+def _takes_context(function):
+    """Whether the filter `function` takes the context as a second
+    argument.
+
+    """
+    if isinstance(function, Transformer):
+        return False
+    try:
+        return _arity_cache[function]
+    except (KeyError, TypeError):
+        pass
+    if ismethod(function):
+        takes_context = len(getargspec(function)[0]) == 3
+    elif hasattr(function, 'func_code'):
+        takes_context = len(getargspec(function)[0]) == 2
+    else:
+        takes_context = len(getargspec(function.__call__)[0]) == 3
+    try:
+        _arity_cache[function] = takes_context
+    except TypeError:
+        pass
+    return takes_context
+
+
+def _remark(stream):
+    """Strip the marks of one transformer and mark the stream afresh for
+    the next, like unmarking and marking between separate transformers.
+
+    """
+    for mark, event in stream:
+        kind = event[0]
+        if not (kind is None or kind is ATTR or kind is BREAK):
+            yield OUTSIDE, event
+
+
+def _chain_transformers(transformers):
+    """Combine `transformers` into a single
+    :class:`~genshi.filters.Transformer` that applies all of their
+    transformations in order, so the stream is marked and unmarked once
+    rather than once for each. Each transformation still goes over the
+    stream on its own, since what one selects can depend on what the ones
+    before it did.
+
+    """
+    if len(transformers) == 1:
+        return transformers[0]
+    chained = Transformer()
+    chained.transforms = list(transformers[0].transforms)
+    for transformer in transformers[1:]:
+        chained.transforms.append(_remark)
+        chained.transforms.extend(transformer.transforms)
+    return chained
+
+
+def lazy(function):
+    """Wrap `function` so that, as a value in a template context, it is only
+    called if the template uses the value, and then only once per render::
+
+        render_response('index.html', dict(
+            posts=lazy(lambda: Post.query.all())))
+
+    .. versionadded:: 0.6
+
+    """
+    return LazyValue(function)
+
+
+def lazy_context_processor(*names):
+    """Decorator for a context processor that is only run when a template
+    uses one of the `names` it returns, and then only once per render::
+
+        @app.context_processor
+        @lazy_context_processor('user', 'notifications')
+        def inject_user():
+            user = User.query.get(session['user_id'])
+            return dict(user=user, notifications=user.notifications)
+
+    The values are :class:`LazyValue` objects, so the context processor is
+    only suited for Genshi templates.
+
+    .. versionadded:: 0.6
+
+    """
+    def decorator(function):
+        def processor():
+            computed = []
+            def compute(name):
+                if not computed:
+                    computed.append(function())
+                return computed[0][name]
+            return dict((name, LazyValue(partial(compute, name)))
+                        for name in names)
+        processor.__name__ = function.__name__
+        processor.__doc__ = function.__doc__
+        processor.lazy_names = names
+        return processor
+    return decorator
+
 
 def select_method(template, method=None):
     """Same as :meth:`Genshi._method_for`.
@@ -214,81 +3787,784 @@ def generate_template(template=None, context=None,
     """Creates a Genshi template stream that you can
     run filters and transformations on.
 
+    .. versionchanged:: 0.6
+        The `context` is no longer modified. The Jinja globals, filters and
+        tests are looked up from a shared scope beneath it, and signals and
+        filters are passed the :class:`~genshi.template.Context` the
+        template was generated with.
+
     """
     genshi = current_app.extensions['genshi']
-    method = genshi._method_for(template, method)
-    class_ = genshi.methods[method].get('class', MarkupTemplate)
-
-    context = context or {}
-    for key, value in current_app.jinja_env.globals.iteritems():
-        context.setdefault(key, value)
-    context.setdefault('filters', current_app.jinja_env.filters)
-    context.setdefault('tests', current_app.jinja_env.tests)
-    for key, value in current_app.jinja_env.filters.iteritems():
-        context.setdefault(key, value)
-    for key, value in current_app.jinja_env.tests.iteritems():
-        context.setdefault('is%s' % key, value)
-    current_app.update_template_context(context)
+    plan = genshi._render_plan(template, method)
+    return _generate(genshi, template, context, plan, string, filter, {})[0]
+
+
+def _generate(genshi, template, context, plan, string, filter, timings,
+              profile=False):
+    """Generate a template stream as planned by `plan`, recording the time
+    spent in each phase in `timings`. If `profile` is true, also return a
+    list of ``(phase, iterator)`` pairs of :class:`_TimedIterator` that time
+    the stages of the stream.
+
+    """
+    template, ctxt = _template_context(genshi, template, context, plan,
+                                       string, filter, timings)
+    return _generate_stream(template, ctxt, plan, filter, timings, profile)
+
 
+def _template_context(genshi, template, context, plan, string, filter,
+                      timings):
+    """Load a template and build the context to generate it with, recording
+    the time spent on each in `timings`."""
+    class_ = plan.class_
+
+    started = time()
     if template is not None:
-        template = genshi.template_loader.load(template, cls=class_)
+        loader = genshi.template_loader
+        if os.path.normpath(template) in loader._cache:
+            timings['loader'] = 'hit'
+        else:
+            timings['loader'] = 'miss'
+        template = loader.load(template, cls=class_)
     elif string is not None:
-        template = class_(string)
+        template = genshi.string_cache.load(class_, string)
     else:
         raise RuntimeError('Need a template or string')
+    timings['load'] = time() - started
 
-    stream = template.generate(**context)
+    started = time()
+    names, required = _context_names(template)
+    ctxt = _LazyContext()
+    data = ctxt.frames[0]
+    if context:
+        # Filters and signal receivers that get the context may look up
+        # values the template doesn't use, so only prune without them.
+        if (names is None or plan.context_filters or
+                (filter and _takes_context(filter)) or
+                (signals_available and template_generated.receivers)):
+            data.update(context)
+        elif len(names) < len(context):
+            data.update((name, context[name]) for name in names
+                        if name in context)
+        else:
+            data.update((name, value) for name, value in context.iteritems()
+                        if name in names)
+    if names is None:
+        current_app.update_template_context(data)
+    else:
+        _update_template_context(data, names)
+    namespace = genshi._jinja_namespace()
+    if names is None or not namespace.isdisjoint(names):
+        # py:def stores functions in the bottom frame, which must not be
+        # the namespace that is shared by all renders.
+        ctxt.frames.append(namespace)
+        ctxt.frames.append({})
+    if names is not None and current_app.config['GENSHI_STRICT_CONTEXT']:
+        _check_context(template, context, names, required, ctxt)
+    timings['context'] = time() - started
+    return template, ctxt
+
+
+def _generate_stream(template, ctxt, plan, filter, timings, profile=False):
+    """The part of :func:`_generate` after building the context."""
+    started = time()
+    stream = template.generate(ctxt)
 
     if signals_available:
         template_generated.send(current_app._get_current_object(),
-                                template=template, context=context)
+                                template=template, context=ctxt)
 
-    for func in genshi.filters[method]:
-        if len(getargspec(func)[0]) == 2:  # Filter takes context?
-            stream = func(stream, context)
-        else:
-            stream = func(stream)
+    timers = []
+    if profile:
+        timer = _TimedIterator(stream)
+        timers.append(('evaluate', timer))
+        stream = Stream(timer)
 
+    filters = plan.pipeline
     if filter:
-        if len(getargspec(filter)[0]) == 2:  # Filter takes context?
-            stream = filter(stream, context)
+        filters = filters + [(filter, _takes_context(filter))]
+    for func, takes_context in filters:
+        if takes_context:
+            stream = func(stream, ctxt)
         else:
-            stream = filter(stream)
+            stream = func(stream)
+        if profile:
+            name = getattr(func, '__name__', type(func).__name__)
+            timer = _TimedIterator(stream)
+            timers.append(('filter.%s' % name, timer))
+            stream = Stream(timer)
 
-    return stream
+    timings['generate'] = time() - started
+    return stream, timers
+
+
+def _update_template_context(context, names):
+    """Same as :meth:`flask.Flask.update_template_context`, but skips lazy
+    context processors that provide none of `names`."""
+    processors = current_app.template_context_processors
+    funcs = processors[None]
+    blueprint = None
+    ctx = _request_ctx_stack.top
+    if ctx is not None:
+        # Flask before 0.7 only knows modules.
+        blueprint = getattr(ctx.request, 'blueprint',
+                            getattr(ctx.request, 'module', None))
+    if blueprint is not None and blueprint in processors:
+        funcs = chain(funcs, processors[blueprint])
+    original = context.copy()
+    for func in funcs:
+        lazy_names = getattr(func, 'lazy_names', None)
+        if lazy_names is None or not names.isdisjoint(lazy_names):
+            context.update(func())
+    context.update(original)
+
+
+def _stacklevel():
+    """The `stacklevel` that makes a warning issued by the caller point at
+    the code outside of this module that called into it."""
+    frame = sys._getframe(2)
+    level = 2
+    while frame is not None and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+        level += 1
+    return level
+
+
+def _check_context(template, context, names, required, ctxt):
+    """Warn about values in `context` that `template` doesn't use and names
+    it requires that `ctxt` lacks."""
+    name = template.filename or '<string>'
+    if context:
+        unused = sorted(set(context) - names)
+        if unused:
+            warn('Template %r does not use context values: %s'
+                 % (name, ', '.join(unused)), stacklevel=_stacklevel())
+    missing = sorted(key for key in required if key not in ctxt)
+    if missing:
+        warn('Template %r uses names missing from its context: %s'
+             % (name, ', '.join(missing)), stacklevel=_stacklevel())
+
+
+def _render(genshi, template, context, plan, string, filter, timings,
+            encoding=None):
+    """Generate and serialize a template, encoded with `encoding` if given,
+    recording the time spent in each phase in `timings`.
+
+    """
+    profile = current_app.config['GENSHI_RENDER_STATS']
+    if (filter is None and plan.compiled_style is not None and
+            current_app.config['GENSHI_COMPILE']):
+        loaded, ctxt = _template_context(genshi, template, context, plan,
+                                         string, filter, timings)
+        started = time()
+        function = _compiled_function(loaded, plan.compiled_style,
+                                      plan.doctype, True,
+                                      _initial_state(plan.compiled_style))
+        timings['generate'] = time() - started
+        if function is not None:
+            started = time()
+            rendered = _render_compiled(function, ctxt)
+            if encoding is not None:
+                rendered = rendered.encode(encoding, plan.errors)
+            timings['serialize'] = time() - started
+            timings['bytes'] = len(rendered)
+            if signals_available:
+                template_generated.send(current_app._get_current_object(),
+                                        template=loaded, context=ctxt)
+            return rendered
+        stream, timers = _generate_stream(loaded, ctxt, plan, filter,
+                                          timings, profile)
+    else:
+        loaded, ctxt = _template_context(genshi, template, context, plan,
+                                         string, filter, timings)
+        stream, timers = _generate_stream(loaded, ctxt, plan, filter,
+                                          timings, profile)
+    started = time()
+    rendered = plan.render(stream, encoding)
+    elapsed = 0.0
+    for phase, timer in timers:
+        timings[phase] = timer.elapsed - elapsed
+        elapsed = timer.elapsed
+    timings['serialize'] = time() - started - elapsed
+    timings['bytes'] = len(rendered)
+    match_templates = ctxt._match_templates
+    if match_templates.defined:
+        timings['matches'] = match_templates.tests
+    return rendered
+
+
+def _before_render(template, method):
+    if signals_available:
+        before_render.send(current_app._get_current_object(),
+                           template=template, method=method)
+
+
+def _after_render(genshi, template, method, timings):
+    if current_app.config['GENSHI_RENDER_STATS']:
+        genshi.render_stats.record(template, timings)
+    if signals_available:
+        after_render.send(current_app._get_current_object(),
+                          template=template, method=method, timings=timings)
 
 
 def render_template(template=None, context=None,
-                    method=None, string=None, filter=None):
-    """Renders a template to a string."""
+                    method=None, string=None, filter=None, encoding=None):
+    """Renders a template to a string, or to a byte string encoded with
+    `encoding` if it is given.
+
+    .. versionchanged:: 0.6
+        Sends the :data:`before_render` and :data:`after_render` signals,
+        and records the timings of the render in :attr:`Genshi.render_stats`
+        if the ``GENSHI_RENDER_STATS`` configuration value is true.
+        The timings are a dict with the seconds spent in these phases:
+
+        ``context``
+            Updating the context, including context processors.
+        ``load``
+            Loading the template, with ``loader`` set to ``'hit'`` or
+            ``'miss'`` for the template loader cache.
+        ``generate``
+            Generating the stream and setting up filters.
+        ``serialize``
+            Serializing the stream. Genshi evaluates templates and applies
+            filters lazily, so this includes the time spent on those,
+            except when recording render stats, which records that time as
+            ``evaluate`` and ``filter.<name>`` for each filter instead.
+
+        The size of the output is recorded as ``bytes``, and for
+        templates with ``py:match`` templates, the number of times those
+        were tested against the stream as ``matches``.
+
+    .. versionchanged:: 0.6
+        Added the `encoding` parameter. The template is encoded as it is
+        serialized, rather than serialized into a unicode string first.
+
+    """
     genshi = current_app.extensions['genshi']
-    method = genshi._method_for(template, method)
-    template = generate_template(template, context, method, string, filter)
-    render_args = dict(method=genshi.methods[method]['serializer'])
-    if 'doctype' in genshi.methods[method]:
-        render_args['doctype'] = genshi.methods[method]['doctype']
-    return template.render(**render_args)
+    plan = genshi._render_plan(template, method)
+    name = template or '<string>'
+    _before_render(name, plan.method)
+    timings = {}
+    rendered = _render(genshi, template, context, plan, string, filter,
+                       timings, encoding)
+    _after_render(genshi, name, plan.method, timings)
+    return rendered
+
+
+def _iter_encoded(chunks, encoding, chunk_size, method='xml'):
+    """Encode serialized `chunks` and coalesce them into byte strings of at
+    least `chunk_size` bytes, except for the last one. Characters that can't
+    be encoded are replaced with character references, or with ``?`` for the
+    ``text`` serialization `method`.
+
+    """
+    errors = _encoding_errors(method)
+    buffered = []
+    size = 0
+    for chunk in chunks:
+        chunk = chunk.encode(encoding, errors)
+        buffered.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            yield ''.join(buffered)
+            buffered = []
+            size = 0
+    if buffered:
+        yield ''.join(buffered)
+
+
+def _with_request_context(iterable):
+    """Keep the current request context around while `iterable` is
+    consumed by the WSGI server, as Genshi evaluates template expressions
+    lazily during serialization.
+
+    """
+    if stream_with_context is not None:
+        return stream_with_context(iterable)
+    ctx = _request_ctx_stack.top
+    def generator():
+        pushed = _request_ctx_stack.top is not ctx
+        if pushed:
+            _request_ctx_stack.push(ctx)
+        try:
+            for item in iterable:
+                yield item
+        finally:
+            if pushed:
+                _request_ctx_stack.pop()
+    return generator()
 
 
 def render_response(template=None, context=None,
-                    method=None, string=None, filter=None):
+                    method=None, string=None, filter=None, stream=None,
+                    etag=None, fingerprint=None, cache_timeout=None):
     """Renders a template and wraps it in a :attr:`~flask.Flask.response_class`
     with mimetype set according to the rendering method.
 
+    If `stream` is true the serialized template is sent to the client in
+    chunks of ``GENSHI_STREAM_CHUNK_SIZE`` bytes as it is rendered, rather than
+    rendered into memory first. It defaults to the ``GENSHI_STREAM``
+    configuration value.
+
+    If `etag` is true the response gets an ETag computed from the rendered
+    output, and a ``304 Not Modified`` response is sent instead if it
+    matches the ``If-None-Match`` header of the request. It defaults to the
+    ``GENSHI_ETAG`` configuration value.
+
+    If a `fingerprint` is passed, the rendered response is kept in
+    :attr:`Genshi.response_cache` for `cache_timeout` seconds, keyed by the
+    template, the rendering method and the fingerprint, and later calls with
+    the same fingerprint send the cached response without rendering. The
+    fingerprint should identify everything in the context that affects the
+    output, for example ``(post.id, post.modified)``. Cached responses
+    always have an ETag.
+
+    Responses with an ETag or a fingerprint are never streamed.
+
+    If the ``GENSHI_SERVER_TIMING`` configuration value is true, the
+    timings of the render, as described for :func:`render_template`, are
+    sent in a ``Server-Timing`` header. Streamed responses have no such
+    header, and send the :data:`after_render` signal and record their
+    timings once the whole response has been sent.
+
+    If the ``GENSHI_COMPRESS`` configuration value is true, responses of at
+    least ``GENSHI_COMPRESS_MIN_SIZE`` bytes, or the ``compress_min_size``
+    of the method, are compressed with gzip or deflate if the client
+    accepts it. Streamed responses are compressed as they are sent, once
+    that many bytes have been rendered, and cached responses are kept
+    compressed as well.
+
+    The template is encoded as it is serialized, with the
+    ``GENSHI_ENCODING`` configuration value or otherwise the charset of
+    the response class, which is added to the content type.
+
+    .. versionchanged:: 0.6
+        Added the `stream`, `etag`, `fingerprint` and `cache_timeout`
+        parameters, ``GENSHI_ENCODING`` and compression.
+
     """
     genshi = current_app.extensions['genshi']
-    method = genshi._method_for(template, method)
-    mimetype = genshi.methods[method].get('mimetype', 'text/html')
-    template = render_template(template, context, method, string, filter)
-    return current_app.response_class(template, mimetype=mimetype)
+    plan = genshi._render_plan(template, method)
+    method = plan.method
+    encoding = _output_encoding()
+    if etag is None:
+        etag = current_app.config['GENSHI_ETAG']
+    if stream is None:
+        stream = current_app.config['GENSHI_STREAM']
+    compress = current_app.config['GENSHI_COMPRESS']
+    compression = None
+    if compress:
+        compression = _accepted_compression()
+        min_size = plan.compress_min_size
+        if min_size is None:
+            min_size = current_app.config['GENSHI_COMPRESS_MIN_SIZE']
+        level = current_app.config['GENSHI_COMPRESS_LEVEL']
+    name = template or '<string>'
+    _before_render(name, method)
+    timings = {}
+    digest = None
+    cache = None
+    streamed = False
+    if fingerprint is not None:
+        cache = genshi.response_cache
+    if cache is not None:
+        key = (template, string, method, encoding, fingerprint)
+        key = 'flask-genshi/response/%s' % sha1(repr(key)).hexdigest()
+        cached = cache.get(key)
+        if cached is None:
+            body = _render(genshi, template, context, plan, string,
+                           filter, timings, encoding)
+            cached = (body, sha1(body).hexdigest(), {})
+            cache.set(key, cached, cache_timeout)
+        body, digest, compressed = cached
+        if compression is not None and len(body) >= min_size:
+            if compression not in compressed:
+                compressed = dict(compressed)
+                compressed[compression] = _compress(body, compression,
+                                                    level, timings)
+                cache.set(key, (body, digest, compressed), cache_timeout)
+            body = compressed[compression]
+        else:
+            compression = None
+    elif stream and not etag:
+        streamed = True
+        template = _generate(genshi, template, context, plan, string,
+                             filter, timings)[0]
+        chunks = _iter_encoded(plan.serialize(template), encoding,
+                               current_app.config['GENSHI_STREAM_CHUNK_SIZE'],
+                               plan.serializer)
+        chunks = _finish_streamed(chunks, genshi, name, method, timings)
+        if compression is not None:
+            head = []
+            size = 0
+            for chunk in chunks:
+                head.append(chunk)
+                size += len(chunk)
+                if size >= min_size:
+                    chunks = _iter_compressed(chain(head, chunks),
+                                              compression, level)
+                    break
+            else:
+                chunks = head
+                compression = None
+        body = _with_request_context(chunks)
+    else:
+        body = _render(genshi, template, context, plan, string, filter,
+                       timings, encoding)
+        if etag:
+            digest = sha1(body).hexdigest()
+        if compression is not None and len(body) >= min_size:
+            body = _compress(body, compression, level, timings)
+        else:
+            compression = None
+    content_type = '%s; charset=%s' % (plan.mimetype, encoding)
+    response = current_app.response_class(body, content_type=content_type)
+    if not streamed:
+        _after_render(genshi, name, method, timings)
+        if current_app.config['GENSHI_SERVER_TIMING'] and timings:
+            response.headers['Server-Timing'] = _server_timing(timings)
+    if compress:
+        response.vary.add('Accept-Encoding')
+    if compression is not None:
+        response.content_encoding = compression
+    if digest is not None:
+        if compression is not None:
+            digest = '%s-%s' % (digest, compression)
+        response.set_etag(digest)
+        response.make_conditional(request)
+    return response
+
+
+def _finish_streamed(chunks, genshi, template, method, timings):
+    """Yield the encoded `chunks` of a streamed response, recording the
+    time spent serializing them and their size in `timings`, and finish the
+    render of `template` once they have all been sent."""
+    elapsed = 0.0
+    size = 0
+    started = time()
+    for chunk in chunks:
+        elapsed += time() - started
+        size += len(chunk)
+        yield chunk
+        started = time()
+    timings['serialize'] = elapsed + time() - started
+    timings['bytes'] = size
+    _after_render(genshi, template, method, timings)
+
+
+def _accepted_compression():
+    """The compression the client accepts for the response, ``'gzip'``,
+    ``'deflate'`` or ``None``."""
+    accept = request.accept_encodings
+    best, best_quality = None, 0
+    for compression in ('gzip', 'deflate'):
+        if accept[compression] > best_quality:
+            best, best_quality = compression, accept[compression]
+    return best
+
+
+def _compressor(compression, level):
+    wbits = zlib.MAX_WBITS
+    if compression == 'gzip':
+        wbits += 16
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+
+def _compress(body, compression, level, timings):
+    """Compress `body`, recording the time spent in `timings`."""
+    started = time()
+    compressor = _compressor(compression, level)
+    body = compressor.compress(body) + compressor.flush()
+    timings['compress'] = time() - started
+    return body
+
+
+def _iter_compressed(chunks, compression, level):
+    """Compress `chunks` as they come, flushing after each so that the
+    client can decompress what it has received."""
+    compressor = _compressor(compression, level)
+    for chunk in chunks:
+        chunk = compressor.compress(chunk)
+        chunk += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def _output_encoding():
+    """The encoding of rendered responses."""
+    return (current_app.config['GENSHI_ENCODING'] or
+            current_app.response_class.charset)
+
+
+def _server_timing(timings):
+    """Format `timings` for the ``Server-Timing`` response header."""
+    metrics = []
+    for phase, value in sorted(timings.iteritems()):
+        if phase not in ('loader', 'bytes', 'matches'):
+            metrics.append('%s;dur=%.3f' % (phase, value * 1000))
+    return ', '.join(metrics)
 
 
 def render(template, **context):
     """Render a template to a response object, passing the context as
     keyword arguments. Shorthand for
-    ``render_response(template, dict(**context))``.
+    ``render_response(template, dict(**context))``. Whether the response is
+    streamed is decided by the ``GENSHI_STREAM`` configuration value.
 
     .. versionadded:: 0.6
 
     """
     return render_response(template, context)
+
+
+def _in_context(function):
+    """Wrap `function` to run with the current application and request
+    contexts in another thread. The contexts are not popped when it
+    returns, so teardown functions don't run in the other thread.
+
+    """
+    contexts = [_request_ctx_stack]
+    if _app_ctx_stack is not None:
+        contexts.insert(0, _app_ctx_stack)
+    contexts = [(stack, stack.top) for stack in contexts]
+    def wrapper(*args, **kwargs):
+        for stack, ctx in contexts:
+            stack.push(ctx)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            for stack, ctx in reversed(contexts):
+                stack.pop()
+    return wrapper
+
+
+def render_template_async(template=None, context=None,
+                          method=None, string=None, filter=None):
+    """Like :func:`render_template` but renders in a thread of
+    :attr:`Genshi.executor`, with the request context of the caller.
+    Returns an :class:`~multiprocessing.pool.AsyncResult`; call its ``get``
+    method to wait for the rendered template. This must be done before the
+    request ends.
+
+    .. versionadded:: 0.6
+
+    """
+    executor = current_app.extensions['genshi'].executor
+    return executor.apply_async(_in_context(render_template),
+                                (template, context, method, string, filter))
+
+
+def render_response_async(template=None, context=None,
+                          method=None, string=None, filter=None):
+    """Like :func:`render_response` but renders in a thread of
+    :attr:`Genshi.executor`, with the request context of the caller.
+    Returns an :class:`~multiprocessing.pool.AsyncResult` for the response.
+
+    .. versionadded:: 0.6
+
+    """
+    executor = current_app.extensions['genshi'].executor
+    return executor.apply_async(_in_context(render_response),
+                                (template, context, method, string, filter))
+
+
+def stream_template_async(template=None, context=None,
+                          method=None, string=None, filter=None,
+                          queue_size=16, timeout=60):
+    """Generate and serialize a template in a thread of
+    :attr:`Genshi.executor`, returning an iterator over the encoded chunks
+    as they are produced. At most `queue_size` chunks are rendered ahead of
+    the consumer. The iterator can be passed to a response as-is.
+
+    Rendering stops when the iterator is closed or garbage collected, or
+    when no chunk has been taken from it for `timeout` seconds, so that
+    abandoned streams don't keep threads of the executor busy.
+
+    .. versionadded:: 0.6
+
+    """
+    genshi = current_app.extensions['genshi']
+    plan = genshi._render_plan(template, method)
+    encoding = _output_encoding()
+    chunks = Queue(queue_size)
+    closed = []
+    def put(item):
+        deadline = time() + timeout
+        while not closed and time() < deadline:
+            try:
+                chunks.put(item, timeout=0.1)
+            except Full:
+                continue
+            return True
+        return False
+    def produce():
+        try:
+            stream = _generate(genshi, template, context, plan, string,
+                               filter, {})[0]
+            for chunk in _iter_encoded(plan.serialize(stream), encoding,
+                                       current_app.config[
+                                           'GENSHI_STREAM_CHUNK_SIZE'],
+                                       plan.serializer):
+                if not put((chunk, None)):
+                    return
+        except Exception, e:
+            put((None, e))
+        else:
+            put((None, None))
+    genshi.executor.apply_async(_in_context(produce))
+    return _ChunkIterator(chunks, closed)
+
+
+class _ChunkIterator(object):
+    """Iterator over the chunks put in the `chunks` queue by
+    :func:`stream_template_async`, which tells the producer to stop by
+    appending to `closed` when it is closed or garbage collected."""
+
+    def __init__(self, chunks, closed):
+        self.chunks = chunks
+        self.closed = closed
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.closed:
+            raise StopIteration
+        chunk, error = self.chunks.get()
+        if error is not None:
+            self.close()
+            raise error
+        if chunk is None:
+            self.close()
+            raise StopIteration
+        return chunk
+
+    def close(self):
+        if not self.closed:
+            self.closed.append(True)
+
+    __del__ = close
+
+
+class RenderResult(object):
+    """The outcome of rendering one item with :func:`render_many`.
+
+    .. versionadded:: 0.6
+
+    """
+
+    def __init__(self, index, template, output=None, error=None,
+                 traceback=None):
+
+        #: Position of the item in the rendered items.
+        self.index = index
+
+        #: The template that was rendered.
+        self.template = template
+
+        #: The rendered template, or ``None`` if rendering failed.
+        self.output = output
+
+        #: The exception raised while rendering, if any. Exceptions that
+        #: can't be pickled are replaced by a :exc:`RuntimeError`.
+        self.error = error
+
+        #: The formatted traceback of :attr:`error`.
+        self.traceback = traceback
+
+    def __repr__(self):
+        return '<%s %d %r%s>' % (type(self).__name__, self.index,
+                                 self.template, self.error and ' failed' or '')
+
+
+_worker_app = None
+
+
+def _init_worker(app):
+    global _worker_app
+    _worker_app = app
+
+
+def _render_item(item):
+    index, template, context, method = item
+    try:
+        ctx = _worker_app.test_request_context()
+        ctx.push()
+        try:
+            return index, render_template(template, context, method), None
+        finally:
+            ctx.pop()
+    except Exception, e:
+        return index, None, (_picklable_error(e), format_exc())
+
+
+def _picklable_error(error):
+    try:
+        pickle.loads(pickle.dumps(error, pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return RuntimeError('%s: %s' % (type(error).__name__, error))
+    return error
+
+
+def render_many(items, processes=None, ordered=True):
+    """Render many templates in parallel across a pool of `processes`
+    worker processes, by default one per CPU. The `items` are
+    ``(template, context)`` or ``(template, context, method)`` tuples, and
+    the contexts must be picklable.
+
+    Returns an iterator of :class:`RenderResult` in the order of `items`,
+    or as they complete if `ordered` is false. An item that fails to render
+    gets a result with the error, and does not affect the other items.
+
+    Workers are forked from the current process, so they start with the
+    templates it has already loaded, such as with :meth:`Genshi.preload`,
+    and render in a test request context of the current application.
+
+    .. versionadded:: 0.6
+
+    """
+    from multiprocessing import Pool
+    app = current_app._get_current_object()
+    tasks = []
+    failed = []
+    for index, item in enumerate(items):
+        template, context = item[:2]
+        method = len(item) > 2 and item[2] or None
+        try:
+            pickle.dumps(context, pickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            failed.append(RenderResult(index, template,
+                                       error=_picklable_error(e),
+                                       traceback=format_exc()))
+        else:
+            tasks.append((index, template, context, method))
+    templates = dict((task[0], task[1]) for task in tasks)
+
+    def results():
+        # The pool is created when the results are first asked for, so
+        # that no workers are left running if they never are.
+        pool = Pool(processes, _init_worker, (app,))
+        try:
+            if ordered:
+                outcomes = pool.imap(_render_item, tasks)
+            else:
+                for result in failed:
+                    yield result
+                outcomes = pool.imap_unordered(_render_item, tasks)
+            for index, output, error in outcomes:
+                while ordered and failed and failed[0].index < index:
+                    yield failed.pop(0)
+                result = RenderResult(index, templates[index], output)
+                if error is not None:
+                    result.error, result.traceback = error
+                yield result
+            if ordered:
+                for result in failed:
+                    yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    return results()
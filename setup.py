@@ -25,7 +25,7 @@ setup(
     tests_require=['attest>=0.2', 'flatland', 'blinker'],
     install_requires=[
         'Flask',
-        'Genshi>=0.5'
+        'Genshi>=0.6'
     ],
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -34,7 +34,6 @@ setup(
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.5',
         'Programming Language :: Python :: 2.6',
         'Programming Language :: Python :: 2.7',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
@@ -8,4 +8,20 @@ all = Tests(['tests.rendering.rendering',
              'tests.jinja_tests_and_filters.jinja',
              'tests.i18n.i18n',
              'tests.signals.signals',
+             'tests.preloading.preloading',
+             'tests.disk_cache.disk_cache',
+             'tests.fragments.fragments',
+             'tests.conditional.conditional',
+             'tests.threaded.threaded',
+             'tests.batch.batch',
+             'tests.instrumentation.instrumentation',
+             'tests.reloading.reloading',
+             'tests.template_cache.template_cache',
+             'tests.template_index.template_index',
+             'tests.minify.minify',
+             'tests.compression.compression',
+             'tests.context_names.context_names',
+             'tests.compiled.compiled',
+             'tests.matching.matching',
+             'tests.shared_templates.shared',
             ])
@@ -0,0 +1,55 @@
+from __future__ import with_statement
+import multiprocessing
+
+from attest import Assert
+from flaskext.genshi import render_many
+
+from tests.utils import flask_tests
+
+
+batch = flask_tests()
+
+
+@batch.test
+def renders_in_parallel(context):
+    """Many templates can be rendered in parallel processes"""
+
+    items = [('test.txt', dict(name=name)) for name in ['Dasher', 'Dancer',
+                                                        'Prancer', 'Vixen']]
+    items.append(('test.xml', context, 'xml'))
+    results = list(render_many(items, processes=2))
+
+    assert [result.index for result in results] == range(5)
+    assert [result.output for result in results] == [
+        'Hi Dasher\n', 'Hi Dancer\n', 'Hi Prancer\n', 'Hi Vixen\n',
+        '<name>Rudolf</name>']
+    assert Assert([result.error for result in results]) == [None] * 5
+
+
+@batch.test
+def captures_errors(context):
+    """Failing items are reported without affecting the others"""
+
+    items = [('missing.txt', context),
+             ('test.txt', dict(name=lambda: 'Comet')),
+             ('test.txt', context)]
+    results = list(render_many(items, processes=2, ordered=False))
+    results.sort(key=lambda result: result.index)
+
+    assert results[0].error is not None
+    assert 'TemplateNotFound' in results[0].traceback
+    assert 'missing.txt' in results[0].traceback
+    assert results[1].error is not None
+    assert results[1].output is None
+    assert results[2].output == 'Hi Rudolf\n'
+
+
+@batch.test
+def starts_workers_when_iterated(context):
+    """No worker processes are started until results are asked for"""
+
+    children = len(multiprocessing.active_children())
+    results = render_many([('test.txt', context)], processes=2)
+    assert Assert(len(multiprocessing.active_children())) == children
+    assert Assert([result.output for result in results]) == ['Hi Rudolf\n']
+    assert Assert(len(multiprocessing.active_children())) == children
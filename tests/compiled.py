@@ -0,0 +1,185 @@
+from __future__ import with_statement
+
+from attest import Assert
+from flask import current_app
+from genshi.builder import tag
+from genshi.core import Markup
+from genshi.input import XML
+from genshi.template import MarkupTemplate
+from flaskext.genshi import render_template, render_response
+
+from tests.utils import template_tests, app_context
+
+
+TEMPLATES = [
+    '<p class="a ${cls} b" id="${None}">$name ${5} ${None} ${""}</p>',
+    '<div>\n\n  text   \n\n\n  <pre>\n\n  kept  \n\n</pre>  \n\n</div>',
+    '<div><p/><br/><p>${""}</p><p>${[]}</p><hr noshade=""/></div>',
+    '<script>if (a &lt; b) { x = "$name"; }</script>',
+    '<p>${tag.b("bold", class_="c")} ${Markup("&lt;i>raw&lt;/i>")}</p>',
+    '<input type="checkbox" checked="${True}" disabled="${None}"/>',
+    '<p class="x" py:attrs="{\'class\': \'y\', \'id\': None}"/>',
+    '<ul><li py:for="i in items" py:if="i % 2">$i</li></ul>',
+    '<div py:choose="len(items)"><p py:when="3">3</p>'
+    '<p py:otherwise="">?</p></div>',
+    '<p py:with="y = len(name) * 2">$y</p>',
+    '<div><p py:content="name">a</p><p py:replace="name">b</p></div>',
+    '<div><p py:strip="">a</p><p py:strip="True">b</p>'
+    '<p py:strip="False">c</p></div>',
+    '<div><py:def function="greet(who, greeting=\'Hi\')">'
+    '<b>$greeting $who</b></py:def>${greet("a")} ${greet("b", "Yo")}</div>',
+    '<div><?python\ny = name.upper()\n?>$y</div>',
+    '<div><!-- comment --><![CDATA[ < & ]]></div>',
+    '<root xmlns:a="urn:a"><a:item a:attr="$name">x</a:item></root>',
+    '<p xml:lang="en" xml:space="preserve">\n\n  x  \n\n</p>',
+]
+
+
+def render(string, compile, method, **context):
+    current_app.config['GENSHI_COMPILE'] = compile
+    context.update(tag=tag, Markup=Markup, cls='c"d', items=[1, 2, 3])
+    return render_template(string=string, method=method, context=context)
+
+
+def compiled_functions(string):
+    cache = current_app.extensions['genshi'].string_cache
+    template = cache.load(MarkupTemplate, string)
+    return template.__dict__.get('_compiled', {}).values()
+
+
+INCLUDED = '''\
+<div xmlns:py="http://genshi.edgewall.org/" py:strip="">
+  <py:def function="shout(text)"><b>${text.upper()}</b></py:def>
+  <p>included $name</p>
+</div>'''
+
+PAGE = '''\
+<html xmlns:py="http://genshi.edgewall.org/"
+      xmlns:xi="http://www.w3.org/2001/XInclude">
+  <xi:include href="included.html"/>
+  <body>${shout(name)}
+    <xi:include href="missing.html">
+      <xi:fallback>$name</xi:fallback>
+    </xi:include>
+  </body>
+</html>'''
+
+LAYOUT = '''\
+<div xmlns:py="http://genshi.edgewall.org/" py:strip="">
+  <body py:match="body">[${select('*')}]</body>
+</div>'''
+
+MATCHING = '''\
+<html xmlns:py="http://genshi.edgewall.org/"
+      xmlns:xi="http://www.w3.org/2001/XInclude">
+  <xi:include href="layout.html"/>
+  <body><p>$name</p></body>
+</html>'''
+
+
+compiled = template_tests({'templates/included.html': INCLUDED,
+                           'templates/page.html': PAGE,
+                           'templates/layout.html': LAYOUT,
+                           'templates/matching.html': MATCHING})
+
+
+@compiled.test
+def renders_like_streams(root):
+    """Compiled templates render the same as template streams"""
+
+    context = dict(name='Rudolf')
+
+    with app_context(root):
+        for source in TEMPLATES:
+            string = ('<root xmlns:py="http://genshi.edgewall.org/">%s</root>'
+                      % source)
+            for method in ('html', 'html5', 'xhtml', 'xml'):
+                expected = render(string, False, method, **context)
+                rendered = render(string, True, method, **context)
+                assert Assert(rendered) == expected
+                assert all(compiled_functions(string))
+
+
+@compiled.test
+def is_opt_in(root):
+    """Templates are only compiled with GENSHI_COMPILE"""
+
+    string = '<p>$name</p>'
+    with app_context(root):
+        render(string, False, 'html', name='Rudolf')
+        assert not compiled_functions(string)
+
+        current_app.config['GENSHI_COMPILE'] = True
+        response = render_response(string=string, method='html',
+                                   context=dict(name='Rudolf'))
+        assert response.data.endswith('\n<p>Rudolf</p>')
+        assert compiled_functions(string)
+
+
+@compiled.test
+def writes_values_inline(root):
+    """Values the engine doesn't write directly render as streams would"""
+
+    calls = []
+    string = ('<div xmlns:py="http://genshi.edgewall.org/">'
+              '<p py:def="f(x)">f $x</p><p py:for="i in items">$i</p>'
+              '<a title="${f(1)}">${value}</a><pre>${f(2)}</pre>'
+              '${len(list(f(3)))}<p py:attrs="attrs"/></div>')
+    values = [XML('<x:a xmlns:x="urn:x" x:b="1"><x:c/></x:a>'),
+              tag.pre('\n\n  x  \n\n', tag.script('a < b')),
+              XML('<a xml:space="preserve">  \n\n  x  \n\n</a>')]
+
+    with app_context(root) as app:
+        @app.context_processor
+        def count_calls():
+            calls.append(True)
+            return {}
+
+        for value in values:
+            for method in ('html', 'xhtml', 'xml'):
+                context = dict(items=iter([1, 2]), value=value,
+                               attrs={'{urn:y}a': 'b'})
+                expected = render(string, False, method, **context)
+                del calls[:]
+                context['items'] = iter([1, 2])
+                rendered = render(string, True, method, **context)
+                assert Assert(rendered) == expected
+                assert Assert(calls) == [True]
+        assert all(compiled_functions(string))
+
+
+@compiled.test
+def leaves_match_templates_to_streams(root):
+    """Templates that use or include py:match templates render as streams"""
+
+    with app_context(root):
+        string = ('<div xmlns:py="http://genshi.edgewall.org/">'
+                  '<p py:match="p">matched</p><p>$name</p></div>')
+        expected = render(string, False, 'html', name='Rudolf')
+        assert Assert(render(string, True, 'html', name='Rudolf')) == expected
+        assert Assert(compiled_functions(string)) == [None]
+
+    for auto_reload in (False, True):
+        with app_context(root, GENSHI_AUTO_RELOAD=auto_reload) as app:
+            context = dict(name='Rudolf')
+            expected = render_template('matching.html', context)
+            app.config['GENSHI_COMPILE'] = True
+            assert Assert(render_template('matching.html', context)) == \
+                expected
+            loader = app.extensions['genshi'].template_loader
+            template = loader.load('matching.html')
+            assert Assert(template._compiled.values()) == [None]
+
+
+@compiled.test
+def compiles_includes(root):
+    """Included templates and their functions are compiled as well"""
+
+    for auto_reload in (False, True):
+        with app_context(root, GENSHI_AUTO_RELOAD=auto_reload) as app:
+            expected = render_template('page.html', context=dict(name='a'))
+            app.config['GENSHI_COMPILE'] = True
+            rendered = render_template('page.html', context=dict(name='a'))
+            assert Assert(rendered) == expected
+            loader = app.extensions['genshi'].template_loader
+            assert all(loader.load('page.html')._compiled.values())
@@ -0,0 +1,104 @@
+from __future__ import with_statement
+
+import zlib
+from contextlib import contextmanager
+
+from attest import Assert
+from flask import current_app
+import flaskext.genshi
+from flaskext.genshi import render_response
+
+from tests.utils import flask_tests
+
+
+compression = flask_tests()
+
+
+@contextmanager
+def accepting(encodings):
+    app = current_app._get_current_object()
+    app.config['GENSHI_COMPRESS'] = True
+    app.config['GENSHI_COMPRESS_MIN_SIZE'] = 0
+    with app.test_request_context(headers=[('Accept-Encoding', encodings)]):
+        yield app
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+@compression.test
+def compresses_responses(context):
+    """Responses are compressed as the client accepts"""
+
+    expected = render_response('test.html', context).data
+
+    with accepting('gzip, deflate'):
+        response = render_response('test.html', context)
+        assert Assert(response.headers['Content-Encoding']) == 'gzip'
+        assert Assert(response.headers['Vary']) == 'Accept-Encoding'
+        assert Assert(gunzip(response.data)) == expected
+
+    with accepting('gzip;q=0.5, deflate'):
+        response = render_response('test.html', context)
+        assert Assert(response.headers['Content-Encoding']) == 'deflate'
+        assert Assert(zlib.decompress(response.data)) == expected
+
+    with accepting('gzip;q=0, identity'):
+        response = render_response('test.html', context)
+        assert 'Content-Encoding' not in response.headers
+        assert Assert(response.data) == expected
+
+
+@compression.test
+def compresses_above_threshold(context):
+    """Only responses of the minimum size are compressed"""
+
+    with accepting('gzip') as app:
+        app.config['GENSHI_COMPRESS_MIN_SIZE'] = 1000
+        response = render_response('test.html', context)
+        assert 'Content-Encoding' not in response.headers
+        assert Assert(response.headers['Vary']) == 'Accept-Encoding'
+
+        app.extensions['genshi'].methods['html']['compress_min_size'] = 10
+        response = render_response('test.html', context)
+        assert Assert(response.headers['Content-Encoding']) == 'gzip'
+
+
+@compression.test
+def compresses_streamed_responses(context):
+    """Streamed responses are compressed as they are sent"""
+
+    expected = render_response('test.html', context).data
+
+    with accepting('gzip') as app:
+        app.config['GENSHI_STREAM_CHUNK_SIZE'] = 10
+        response = render_response('test.html', context, stream=True)
+        assert Assert(response.headers['Content-Encoding']) == 'gzip'
+        assert Assert(gunzip(''.join(response.response))) == expected
+
+
+@compression.test
+def caches_compressed_responses(context):
+    """Cached responses are only compressed once"""
+
+    compressed = []
+    compress = flaskext.genshi._compress
+    def counting(*args):
+        compressed.append(args[1])
+        return compress(*args)
+    flaskext.genshi._compress = counting
+    try:
+        with accepting('gzip'):
+            first = render_response('test.html', context, fingerprint=1)
+            second = render_response('test.html', context, fingerprint=1)
+        with accepting('deflate'):
+            render_response('test.html', context, fingerprint=1)
+            render_response('test.html', context, fingerprint=1)
+    finally:
+        flaskext.genshi._compress = compress
+
+    assert Assert(compressed) == ['gzip', 'deflate']
+    assert Assert(first.data) == second.data
+    assert Assert(first.headers['ETag']) == second.headers['ETag']
+    assert first.headers['ETag'].endswith('-gzip"')
@@ -0,0 +1,51 @@
+from __future__ import with_statement
+
+from attest import Assert
+from flask import current_app
+from flaskext.genshi import render_response
+
+from tests.utils import flask_tests
+
+
+conditional = flask_tests()
+
+
+@conditional.test
+def sends_not_modified(context):
+    """Responses with a matching ETag are not sent again"""
+
+    response = render_response('test.html', context, etag=True)
+    etag = response.headers['ETag']
+    rendered = Assert(response)
+
+    assert rendered.status_code == 200
+    assert rendered.data.endswith('<body>Hi Rudolf</body>')
+
+    app = current_app._get_current_object()
+    with app.test_request_context(headers=[('If-None-Match', etag)]):
+        rendered = Assert(render_response('test.html', context, etag=True))
+        assert rendered.status_code == 304
+
+        context['name'] = 'Prancer'
+        rendered = Assert(render_response('test.html', context, etag=True))
+        assert rendered.status_code == 200
+
+
+@conditional.test
+def caches_responses(context):
+    """Responses with a fingerprint are cached"""
+
+    rendered = Assert(render_response('test.html', context, fingerprint=1))
+    assert rendered.data.endswith('<body>Hi Rudolf</body>')
+    assert rendered.headers['ETag'] is not None
+
+    context['name'] = 'Prancer'
+    rendered = Assert(render_response('test.html', context, fingerprint=1))
+    assert rendered.data.endswith('<body>Hi Rudolf</body>')
+
+    rendered = Assert(render_response('test.html', context, fingerprint=2))
+    assert rendered.data.endswith('<body>Hi Prancer</body>')
+
+    current_app.extensions['genshi'].response_cache = None
+    rendered = Assert(render_response('test.html', context, fingerprint=1))
+    assert rendered.data.endswith('<body>Hi Prancer</body>')
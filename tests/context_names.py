@@ -0,0 +1,115 @@
+from __future__ import with_statement
+
+import warnings
+
+from attest import Assert
+from genshi.template import MarkupTemplate
+from flaskext.genshi import (render_template, render_response,
+                             generate_template)
+
+from tests.utils import template_tests, app_context
+
+
+LAYOUT = '''\
+<html xmlns:py="http://genshi.edgewall.org/" py:strip="">
+  <body py:match="body">${select('*')}<p>$footer</p></body>
+</html>'''
+
+PAGE = '''\
+<html xmlns:py="http://genshi.edgewall.org/"
+      xmlns:xi="http://www.w3.org/2001/XInclude">
+  <xi:include href="layout.html"/>
+  <body>
+    <h1>$title</h1>
+    <ul>
+      <li py:for="row in rows">${row} ${', '.join(t for t in tags)}</li>
+    </ul>
+    <p py:with="count = len(rows)">$count</p>
+    <p py:if="defined('note')">$note</p>
+  </body>
+</html>'''
+
+PAGE_NAMES = frozenset(['defined', 'footer', 'iter', 'len', 'note', 'rows',
+                        'tags', 'title'])
+
+context_names = template_tests({'templates/layout.html': LAYOUT,
+                                'templates/page.html': PAGE})
+
+
+@context_names.test
+def finds_free_names(root):
+    """Templates know the names they and their includes look up"""
+
+    for auto_reload in (False, True):
+        with app_context(root, GENSHI_AUTO_RELOAD=auto_reload) as app:
+            loader = app.extensions['genshi'].template_loader
+            template = loader.load('page.html')
+            assert Assert(template.free_names) == PAGE_NAMES
+
+
+@context_names.test
+def gives_up_on_dynamic_names(root):
+    """Templates that look up names dynamically have no free names"""
+
+    with app_context(root) as app:
+        cache = app.extensions['genshi'].string_cache
+        template = cache.load(MarkupTemplate, '<p>${locals()}</p>')
+        assert template.free_names is None
+
+        template = cache.load(MarkupTemplate, '<p>${value_of(name)}</p>')
+        assert template.free_names is None
+
+        template = cache.load(MarkupTemplate, '<p>$name</p>')
+        assert Assert(template.free_names) == frozenset(['name'])
+
+
+@context_names.test
+def warns_in_strict_mode(root):
+    """Unused and missing context values are warned about in strict mode"""
+
+    context = dict(title='Reindeer', rows=['Rudolf'], tags=['red'],
+                   unused=True)
+    with app_context(root, GENSHI_STRICT_CONTEXT=True):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            generate_template('page.html', context=context)
+        messages = [str(warning.message) for warning in caught]
+        assert Assert(messages) == [
+            "Template 'page.html' does not use context values: unused",
+            "Template 'page.html' uses names missing from its context: "
+            "footer"]
+        assert all(warning.filename == __file__.rstrip('c')
+                   for warning in caught)
+
+        context['footer'] = 'Santa'
+        for render in (render_template, render_response):
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                render('page.html', context=context)
+            assert Assert(len(caught)) == 1
+            assert all(warning.filename == __file__.rstrip('c')
+                       for warning in caught)
+
+        del context['unused']
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            generate_template('page.html', context=context)
+        assert not caught
+
+
+@context_names.test
+def keeps_context_for_filters(root):
+    """Filters that take the context see all of it"""
+
+    seen = []
+    context = dict(title='Reindeer', rows=[], tags=[], footer='Santa',
+                   unused=True)
+    with app_context(root) as app:
+        genshi = app.extensions['genshi']
+        @genshi.filter('html')
+        def record(stream, ctxt):
+            seen.append(ctxt.get('unused'))
+            return stream
+
+        render_template('page.html', context=context)
+        assert Assert(seen) == [True]
@@ -1,7 +1,9 @@
 from __future__ import with_statement
 
-from flask import current_app
-from flaskext.genshi import render_response
+from attest import Assert
+from flask import current_app, request, Blueprint
+from flaskext.genshi import (render_response, render_template, lazy,
+                             lazy_context_processor)
 
 from tests.utils import flask_tests
 
@@ -18,3 +20,101 @@ def updates_context():
         return dict(rudolf='The red-nosed reindeer')
 
     render_response('context.html')
+
+
+@contexts.test
+def computes_lazy_values():
+    """Lazy values are computed when used, once per render"""
+
+    calls = []
+    def compute(value):
+        def function():
+            calls.append(value)
+            return value
+        return lazy(function)
+
+    context = dict(name=compute('Rudolf'), unused=compute('Prancer'))
+    rendered = Assert(render_template(string='<p>$name ${name}</p>',
+                                      method='xml', context=context))
+
+    assert rendered == '<p>Rudolf Rudolf</p>'
+    assert Assert(calls) == ['Rudolf']
+
+
+@contexts.test
+def runs_lazy_context_processors():
+    """Lazy context processors run when one of their names is used"""
+
+    calls = []
+    @current_app.context_processor
+    @lazy_context_processor('reindeer', 'sleigh')
+    def inject_reindeer():
+        calls.append(True)
+        return dict(reindeer='Rudolf', sleigh='red')
+
+    render_template(string='<p>$name</p>', method='xml',
+                    context=dict(name='Santa'))
+    assert not calls
+
+    rendered = Assert(render_template(string='<p>$reindeer $sleigh</p>',
+                                      method='xml'))
+    assert rendered == '<p>Rudolf red</p>'
+    assert Assert(calls) == [True]
+
+    rendered = Assert(render_template(
+        string='<p py:if="defined(\'reindeer\')" '
+               'xmlns:py="http://genshi.edgewall.org/">yes</p>',
+        method='xml'))
+    assert rendered == '<p>yes</p>'
+    assert Assert(calls) == [True]
+
+
+@contexts.test
+def runs_blueprint_context_processors():
+    """Context processors of the current blueprint are run"""
+
+    blueprint = Blueprint('reindeer', __name__)
+    blueprint.add_url_rule('/reindeer', 'index', lambda: '')
+
+    @blueprint.context_processor
+    def inject_who():
+        return dict(who='blueprint')
+
+    current_app.register_blueprint(blueprint)
+    with current_app.test_request_context('/reindeer'):
+        rendered = Assert(render_template(string='<p>$who</p>',
+                                          method='xml'))
+    assert rendered == '<p>blueprint</p>'
+
+
+@contexts.test
+def runs_without_a_blueprint():
+    """Context processors run when there is no blueprint to look up"""
+
+    app = current_app._get_current_object()
+
+    @app.context_processor
+    def inject_who():
+        return dict(who='app')
+
+    if hasattr(app, 'app_context'):
+        with app.app_context():
+            rendered = Assert(render_template(string='<p>$who</p>',
+                                              method='xml'))
+        assert rendered == '<p>app</p>'
+
+    # Requests of Flask before 0.7 only know their module.
+    class ModuleRequest(app.request_class):
+        blueprint = property()
+        module = 'reindeer'
+
+    app.template_context_processors['reindeer'] = [
+        lambda: dict(where='module')]
+    with app.test_request_context():
+        request.__class__ = ModuleRequest
+        try:
+            rendered = Assert(render_template(string='<p>$who $where</p>',
+                                              method='xml'))
+        finally:
+            request.__class__ = app.request_class
+    assert rendered == '<p>app module</p>'
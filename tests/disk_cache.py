@@ -0,0 +1,95 @@
+from __future__ import with_statement
+
+import imp
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from attest import Tests, Assert
+from genshi.template import MarkupTemplate
+from flaskext.genshi import render_template
+
+from flask_genshi_testapp import create_app
+
+
+disk_cache = Tests()
+
+
+@disk_cache.context
+def cache_dir():
+    path = tempfile.mkdtemp()
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path)
+
+
+@contextmanager
+def app_context(cache_dir):
+    app = create_app()
+    app.config['GENSHI_CACHE_DIR'] = cache_dir
+    with app.test_request_context():
+        yield app
+
+
+@disk_cache.test
+def stores_parsed_templates(cache_dir):
+    """Parsed templates are stored in and loaded from the cache directory"""
+
+    with app_context(cache_dir):
+        expected = render_template('jinja_tests_and_filters.html')
+
+    assert Assert(os.listdir(cache_dir)).__len__() == 1
+
+    parse = MarkupTemplate._parse
+    def fail(*args, **kwargs):
+        raise AssertionError('template was parsed')
+    MarkupTemplate._parse = fail
+    try:
+        with app_context(cache_dir):
+            rendered = Assert(render_template('jinja_tests_and_filters.html'))
+    finally:
+        MarkupTemplate._parse = parse
+
+    assert rendered == expected
+
+
+@disk_cache.test
+def invalidates_changed_templates(cache_dir):
+    """Cached templates are not used for templates that have changed"""
+
+    with app_context(cache_dir) as app:
+        render_template('test.html', dict(name='Rudolf'))
+        path = os.path.join(app.root_path, 'templates', 'test.html')
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    try:
+        with app_context(cache_dir):
+            rendered = Assert(render_template('test.html',
+                                              dict(name='Rudolf')))
+    finally:
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+
+    assert Assert(os.listdir(cache_dir)).__len__() == 2
+    assert rendered == ('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN" '
+                        '"http://www.w3.org/TR/html4/strict.dtd">\n'
+                        '<body>Hi Rudolf</body>')
+
+
+@disk_cache.test
+def keeps_bytecode_apart(cache_dir):
+    """Templates cached by other Python versions are not used"""
+
+    with app_context(cache_dir):
+        render_template('test.html', dict(name='Rudolf'))
+
+    get_magic = imp.get_magic
+    imp.get_magic = lambda: 'ABCD'
+    try:
+        with app_context(cache_dir):
+            render_template('test.html', dict(name='Rudolf'))
+    finally:
+        imp.get_magic = get_magic
+
+    assert Assert(os.listdir(cache_dir)).__len__() == 2
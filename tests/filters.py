@@ -66,3 +66,49 @@ def works_with_flatland():
                 '<input type="text" name="username" value="dag">')
 
     assert rendered == expected
+
+
+@filters.test
+def chains_transformers():
+    """Transformers can be filters and are chained into one pipeline step"""
+
+    genshi = current_app.extensions['genshi']
+    genshi.filter('html')(Transformer('head/title').prepend('Flask-Genshi - '))
+    genshi.filter('html')(Transformer('head/title').append(' - Welcome'))
+    pipeline = Assert(genshi._filter_pipeline('html'))
+
+    assert pipeline.__len__() == 1
+
+    rendered = Assert(render_template('filter.html'))
+    expected = ('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN" '
+                '"http://www.w3.org/TR/html4/strict.dtd">\n'
+                '<html><head><title>Flask-Genshi - Hi! - Welcome</title>'
+                '</head></html>')
+
+    assert rendered == expected
+
+
+@filters.test
+def recompiles_changed_filters():
+    """Filter pipelines are compiled once and recompiled on changes"""
+
+    genshi = current_app.extensions['genshi']
+    @genshi.filter('html')
+    def prepend_title(template, context):
+        return template | Transformer('head/title').prepend('Flask-Genshi - ')
+
+    pipeline = genshi._filter_pipeline('html')
+    assert genshi._filter_pipeline('html') is pipeline
+    assert pipeline == [(prepend_title, True)]
+
+    genshi.filters['html'].append(
+        Transformer('head/title').append(' - Welcome'))
+    assert genshi._filter_pipeline('html') is not pipeline
+
+    rendered = Assert(render_template('filter.html'))
+    expected = ('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN" '
+                '"http://www.w3.org/TR/html4/strict.dtd">\n'
+                '<html><head><title>Flask-Genshi - Hi! - Welcome</title>'
+                '</head></html>')
+
+    assert rendered == expected
@@ -0,0 +1,80 @@
+from __future__ import with_statement
+
+from attest import Assert
+from flask import current_app
+from flaskext.genshi import render_template
+from werkzeug.contrib.cache import SimpleCache
+
+from tests.utils import flask_tests
+
+
+fragments = flask_tests()
+
+
+@fragments.test
+def caches_fragments():
+    """Fragments are cached by the values of their key expressions"""
+
+    rendered = Assert(render_template('fragment.html', dict(
+        name='Rudolf', lang='en', numbers=[1, 2])))
+    expected = ('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01//EN" '
+                '"http://www.w3.org/TR/html4/strict.dtd">\n'
+                '<div>\n'
+                '  <p>Hi Rudolf</p>\n'
+                '  <span>1</span><span>2</span>\n'
+                '</div>')
+    assert rendered == expected
+
+    rendered = Assert(render_template('fragment.html', dict(
+        name='Prancer', lang='en', numbers=[3])))
+    assert rendered == expected
+
+    rendered = Assert(render_template('fragment.html', dict(
+        name='Prancer', lang='sv', numbers=[3])))
+    assert rendered == expected.replace('Rudolf', 'Prancer')
+
+
+@fragments.test
+def uses_pluggable_backends():
+    """Fragments can be cached with werkzeug cache backends"""
+
+    genshi = current_app.extensions['genshi']
+    genshi.fragment_cache = cache = SimpleCache()
+    render_template('fragment.html', dict(
+        name='Rudolf', lang='en', numbers=[1, 2]))
+
+    assert Assert(cache._cache).__len__() == 2
+
+    rendered = Assert(render_template('fragment.html', dict(
+        name='Prancer', lang='en', numbers=[3])))
+    assert 'Hi Rudolf' in rendered
+    assert '<span>1</span><span>2</span>' in rendered
+
+
+@fragments.test
+def can_be_disabled():
+    """Fragments are rendered every time without a fragment cache"""
+
+    genshi = current_app.extensions['genshi']
+    genshi.fragment_cache = None
+    render_template('fragment.html', dict(
+        name='Rudolf', lang='en', numbers=[1, 2]))
+    rendered = Assert(render_template('fragment.html', dict(
+        name='Prancer', lang='en', numbers=[3])))
+
+    assert 'Hi Prancer' in rendered
+    assert '<span>3</span>' in rendered
+
+
+@fragments.test
+def keys_string_templates_by_source():
+    """Fragments of different templates rendered from strings are apart"""
+
+    source = ('<ul xmlns:cache="http://packages.python.org/Flask-Genshi/'
+              'cache" cache:fragment="\'nav\'"><li>%s</li></ul>')
+    rendered = Assert(render_template(string=source % 'users',
+                                      method='xml'))
+    assert rendered == '<ul><li>users</li></ul>'
+    rendered = Assert(render_template(string=source % 'groups',
+                                      method='xml'))
+    assert rendered == '<ul><li>groups</li></ul>'
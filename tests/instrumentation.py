@@ -0,0 +1,97 @@
+from __future__ import with_statement
+
+from attest import Assert
+from flask import current_app
+from genshi.filters import Transformer
+from flaskext.genshi import (before_render, after_render,
+                             render_template, render_response)
+
+from tests.utils import flask_tests
+
+
+instrumentation = flask_tests()
+
+
+@instrumentation.test
+def sends_render_signals(context):
+    """Signals with timings are sent before and after rendering"""
+
+    app = current_app._get_current_object()
+    events = Assert([])
+    def started(app, template, method):
+        events.append(('before', template, method))
+    def finished(app, template, method, timings):
+        events.append(('after', template, method, timings))
+    before_render.connect(started, app)
+    after_render.connect(finished, app)
+    try:
+        render_template('test.html', context)
+    finally:
+        before_render.disconnect(started, app)
+        after_render.disconnect(finished, app)
+
+    assert events.__len__() == 2
+    assert events[0] == ('before', 'test.html', 'html')
+    assert events[1][:3] == ('after', 'test.html', 'html')
+
+    timings = Assert(events[1][3].obj)
+    assert timings['loader'] == 'miss'
+    assert timings['bytes'] == 113
+    for phase in ('context', 'load', 'generate', 'serialize'):
+        assert timings[phase] >= 0
+
+
+@instrumentation.test
+def records_render_stats(context):
+    """Timings of each phase and filter are recorded when enabled"""
+
+    current_app.config['GENSHI_RENDER_STATS'] = True
+    genshi = current_app.extensions['genshi']
+    @genshi.filter('html')
+    def prepend_title(template):
+        return template | Transformer('head/title').prepend('Flask-Genshi - ')
+
+    for _ in range(3):
+        render_template('filter.html', context)
+
+    stats = genshi.render_stats
+    summary = Assert(stats.summary()['filter.html'])
+
+    assert summary['loader'] == {'hit': 2, 'miss': 1}
+    assert summary['serialize']['count'] == 3
+    assert summary['filter.prepend_title']['count'] == 3
+    assert summary['evaluate']['p90'] >= summary['evaluate']['p50']
+    assert stats.percentile('filter.html', 'load', 100) == \
+           summary['load']['max']
+
+
+@instrumentation.test
+def sends_server_timing(context):
+    """Timings can be sent in a Server-Timing header"""
+
+    response = render_response('test.html', context)
+    assert 'Server-Timing' not in response.headers
+
+    current_app.config['GENSHI_SERVER_TIMING'] = True
+    response = Assert(render_response('test.html', context))
+    header = response.headers['Server-Timing']
+
+    assert 'load;dur=' in header
+    assert 'serialize;dur=' in header
+
+
+@instrumentation.test
+def times_streamed_responses(context):
+    """Streamed responses are timed once they have been sent"""
+
+    current_app.config['GENSHI_RENDER_STATS'] = True
+    current_app.config['GENSHI_SERVER_TIMING'] = True
+    stats = current_app.extensions['genshi'].render_stats
+    response = render_response('test.html', context, stream=True)
+    assert 'Server-Timing' not in response.headers
+    assert 'test.html' not in stats.summary()
+
+    body = ''.join(response.response)
+    summary = Assert(stats.summary()['test.html'])
+    assert summary['serialize']['count'] == 1
+    assert summary['bytes']['max'] == len(body)
@@ -1,6 +1,7 @@
 from __future__ import with_statement
 
 from attest import Assert
+from flask import current_app
 from flaskext.genshi import render_template
 
 from tests.utils import flask_tests
@@ -24,3 +25,59 @@ def provides_jinja_tests_and_filters():
                      '</p>')
 
     assert rendered == expected_data
+
+
+@jinja.test
+def does_not_modify_context(context):
+    """Jinja tests and filters are not copied into the passed context"""
+
+    render_template('jinja_tests_and_filters.html', context)
+
+    assert Assert(context.keys()) == ['name']
+
+
+@jinja.test
+def picks_up_new_filters(context):
+    """Filters added to the Jinja environment after a render are available"""
+
+    render_template('jinja_tests_and_filters.html', context)
+    current_app.jinja_env.filters['shout'] = lambda s: s.upper() + '!'
+    rendered = Assert(render_template(string='${shout(name)}',
+                                      context=context, method='text'))
+
+    assert rendered == 'RUDOLF!'
+
+
+@jinja.test
+def does_not_leak_definitions(context):
+    """Functions defined by templates stay out of the Jinja namespace"""
+
+    source = ('<div xmlns:py="http://genshi.edgewall.org/">'
+              '<py:def function="greet(n)">${n}</py:def>'
+              '${greet(upper(name))}</div>')
+    rendered = Assert(render_template(string=source, context=context,
+                                      method='html'))
+
+    assert rendered.endswith('<div>RUDOLF</div>')
+    source = '${defined("greet") or "greet" in filters}'
+    rendered = Assert(render_template(string=source, method='text'))
+    assert rendered == 'False'
+
+
+@jinja.test
+def picks_up_replaced_values(context):
+    """Replacing a Jinja global or filter takes effect on the next render"""
+
+    env = current_app.jinja_env
+    env.globals['site'] = 'one'
+    env.filters['shout'] = lambda s: s.upper()
+    source = '${site} ${shout(name)}'
+    rendered = Assert(render_template(string=source, context=context,
+                                      method='text'))
+    assert rendered == 'one RUDOLF'
+
+    env.globals['site'] = 'two'
+    env.filters['shout'] = lambda s: s.upper() + '!'
+    rendered = Assert(render_template(string=source, context=context,
+                                      method='text'))
+    assert rendered == 'two RUDOLF!'
@@ -0,0 +1,60 @@
+from __future__ import with_statement
+
+from attest import Assert
+from flask import current_app
+from genshi.template import MarkupTemplate
+from flaskext.genshi import render_template
+
+from tests.utils import flask_tests
+
+
+matching = flask_tests()
+
+
+TEMPLATES = [
+    '<body py:match="body"><h1>$name</h1>${select("*|text()")}</body>'
+    '<body><p>a</p><p>b</p></body>',
+    '<p py:match="p" once="true">[${select("text()")}]</p><p>a</p><p>b</p>',
+    '<p py:match="p" recursive="false"><p>${select("*|text()")}</p></p>'
+    '<p>a<p>b</p></p>',
+    '<p py:match="p[@class=\'x\']">x</p><p class="x">a</p><p>b</p>',
+    '<x:p py:match="x:p">x</x:p><x:p>a</x:p><p>b</p>',
+    '<py:match path="p|b">${select("text()")}!</py:match>'
+    '<p>a</p><b>b</b><i>c</i>',
+    '<py:match path="div/p">p</py:match><div><p>a</p></div><p>b</p>',
+    '<py:match path="b">(${select("text()")})</py:match>'
+    '<py:match path="p">${select("*|text()")}</py:match><p>a<b>b</b></p>'
+    '<div><py:match path="i">i</py:match><i>c</i></div><i>d</i>',
+]
+
+
+def wrap(source):
+    return ('<root xmlns:py="http://genshi.edgewall.org/" xmlns:x="urn:x">'
+            '%s</root>' % source)
+
+
+@matching.test
+def matches_like_genshi(context):
+    """Match templates apply as they do in Genshi"""
+
+    for source in TEMPLATES:
+        expected = MarkupTemplate(wrap(source)).generate(**context)
+        rendered = render_template(string=wrap(source), method='xml',
+                                   context=context)
+        assert Assert(rendered) == expected.render('xml')
+
+
+@matching.test
+def only_tests_matching_tags(context):
+    """Match templates are only tested against elements they can match"""
+
+    current_app.config['GENSHI_RENDER_STATS'] = True
+    string = wrap(TEMPLATES[0].replace('<p>a</p>', '<p>a</p>' * 100))
+    render_template(string=string, method='xml', context=context)
+    summary = current_app.extensions['genshi'].render_stats.summary()
+    assert Assert(summary['<string>']['matches']['max']) == 2
+
+    render_template(string=wrap('<p>$name</p>'), method='xml',
+                    context=context)
+    summary = current_app.extensions['genshi'].render_stats.summary()
+    assert Assert(summary['<string>']['matches']['count']) == 1
@@ -0,0 +1,106 @@
+from attest import Assert
+from flask import current_app
+from flaskext.genshi import render_template, render_response
+
+from tests.utils import flask_tests
+
+
+minify = flask_tests()
+
+
+def minified(string, method, **context):
+    current_app.extensions['genshi'].methods[method]['minify'] = True
+    return render_template(string=string, method=method, context=context)
+
+
+@minify.test
+def minifies_html():
+    """Whitespace is collapsed and comments are dropped in HTML"""
+
+    rendered = Assert(minified(
+        '<html>\n  <head>\n    <title>  A   title </title>\n  </head>\n'
+        '  <body>\n    <!-- comment -->\n    <!--[if IE]>ie<![endif]-->\n'
+        '    <p>\n      Some <b>bold</b>  <i>text</i>\n    </p>\n'
+        '    <p>${name}&nbsp; x</p>\n'
+        '  </body>\n</html>', 'html5', name='a  \n b'))
+
+    assert rendered == (
+        u'<!DOCTYPE html>\n<html><head><title> A title </title></head>'
+        u'<body><!--[if IE]>ie<![endif]-->'
+        u'<p> Some <b>bold</b> <i>text</i></p>'
+        u'<p>a b\xa0 x</p></body></html>')
+
+
+@minify.test
+def preserves_whitespace():
+    """Whitespace is preserved where it is significant"""
+
+    rendered = Assert(minified(
+        '<div>\n  <pre>  a\n    b  </pre>\n'
+        '  <textarea>  c  </textarea>\n'
+        '  <script>\n  var d =  1;\n</script>\n'
+        '  <p xml:space="preserve">  e  </p>\n</div>', 'html'))
+
+    assert rendered.endswith(
+        '<div><pre>  a\n    b  </pre> <textarea>  c  </textarea>'
+        '<script>\n  var d =  1;\n</script>'
+        '<p>  e  </p></div>')
+
+
+@minify.test
+def keeps_comments_in_scripts():
+    """Comments are kept in elements whose content is left alone"""
+
+    rendered = Assert(minified(
+        '<div>\n  <!-- dropped -->\n'
+        '  <script><!--\nalert(1);\n//--></script>\n</div>', 'html'))
+
+    assert rendered.endswith(
+        '<div><script><!--\nalert(1);\n//--></script></div>')
+
+
+@minify.test
+def minifies_xml():
+    """Whitespace-only text is collapsed and comments are dropped in XML"""
+
+    rendered = Assert(minified(
+        '<a>\n  <!-- comment -->\n  <b> c  d </b>\n  <e/>\n</a>', 'xml'))
+
+    assert rendered == '<a> <b> c  d </b> <e/> </a>'
+
+
+@minify.test
+def minifies_css_and_js():
+    """Indentation, blank lines and CSS comments are dropped"""
+
+    rendered = Assert(minified(
+        '/* comment\n   spanning lines */\nbody {\n    color: ${color};\n\n'
+        '}  \n', 'css', color='red'))
+    assert rendered == 'body {\ncolor: red;\n}\n'
+
+    rendered = Assert(minified(
+        'function f() {\n    // comment\n\n    return 1;\n}\n', 'js'))
+    assert rendered == 'function f() {\n// comment\nreturn 1;\n}\n'
+
+
+@minify.test
+def minifies_streamed_responses():
+    """Streamed responses are minified as they are rendered"""
+
+    current_app.extensions['genshi'].methods['xml']['minify'] = True
+    response = render_response(string='<a>\n  <b/>\n</a>', method='xml',
+                               stream=True)
+    assert Assert(''.join(response.response)) == '<a> <b/> </a>'
+
+
+@minify.test
+def keeps_spaces_between_svg_text():
+    """Spaces between runs of SVG text are kept"""
+
+    rendered = Assert(minified(
+        '<svg xmlns="http://www.w3.org/2000/svg">\n'
+        '  <text><tspan>a</tspan> <tspan>b</tspan></text>\n</svg>', 'svg'))
+
+    assert rendered.endswith(
+        '<svg xmlns="http://www.w3.org/2000/svg"> '
+        '<text><tspan>a</tspan> <tspan>b</tspan></text> </svg>')
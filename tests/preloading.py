@@ -0,0 +1,45 @@
+from __future__ import with_statement
+
+from attest import Assert
+from flask import current_app
+from flaskext.genshi import Genshi, render_template
+
+from tests.utils import flask_tests
+from flask_genshi_testapp import create_app
+
+
+preloading = flask_tests()
+
+
+@preloading.test
+def preloads_all_templates():
+    """All application and module templates can be preloaded"""
+
+    genshi = current_app.extensions['genshi']
+    parsed = []
+    genshi.template_parsed(parsed.append)
+    timings = Assert(genshi.preload())
+
+    assert timings.__len__() == 14
+    assert 'test.html' in timings
+    assert 'package_mod/module-template.txt' in timings
+    assert Assert(parsed).__len__() == 14
+
+    render_template('test.html', dict(name='Rudolf'))
+    assert Assert(parsed).__len__() == 14
+
+
+@preloading.test
+def preloads_from_init_app():
+    """Templates are preloaded by init_app when configured to"""
+
+    app = create_app()
+    app.config['GENSHI_PRELOAD'] = True
+    genshi = Genshi()
+    parsed = []
+    genshi.template_parsed(parsed.append)
+    genshi.init_app(app)
+
+    assert Assert(parsed).__len__() == 14
+    with app.test_request_context():
+        assert Assert(len(genshi.template_loader._cache)) == 14
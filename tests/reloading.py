@@ -0,0 +1,84 @@
+from __future__ import with_statement
+
+import os
+
+from attest import Assert
+from flaskext.genshi import render_template
+
+from tests.utils import template_tests, app_context
+
+
+reloading = template_tests({'templates/a.html': '<p>A1</p>',
+                            'templates/b.html': '<p>B1</p>'})
+
+
+def write(root, name, text):
+    path = os.path.join(root, 'templates', name)
+    mtime = None
+    if os.path.exists(path):
+        mtime = os.stat(path).st_mtime + 10
+    with open(path, 'w') as fp:
+        fp.write('<p>%s</p>' % text)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def render(name):
+    return render_template(name, method='xml')
+
+
+@reloading.test
+def follows_debug_by_default(root):
+    """Templates are reloaded in debug mode unless configured otherwise"""
+
+    with app_context(root) as app:
+        assert not app.extensions['genshi'].template_loader.auto_reload
+
+    with app_context(root, DEBUG=True) as app:
+        assert app.extensions['genshi'].template_loader.auto_reload
+
+    with app_context(root, DEBUG=True, GENSHI_AUTO_RELOAD=False) as app:
+        assert not app.extensions['genshi'].template_loader.auto_reload
+
+    with app_context(root, GENSHI_AUTO_RELOAD=True) as app:
+        assert app.extensions['genshi'].template_loader.auto_reload
+        assert Assert(render('a.html')) == '<p>A1</p>'
+        write(root, 'a.html', 'A2')
+        assert Assert(render('a.html')) == '<p>A2</p>'
+
+
+@reloading.test
+def throttles_reload_checks(root):
+    """Templates are checked for changes at most once per interval"""
+
+    with app_context(root, GENSHI_AUTO_RELOAD=True,
+                     GENSHI_RELOAD_INTERVAL=3600) as app:
+        loader = app.extensions['genshi'].template_loader
+        assert Assert(render('a.html')) == '<p>A1</p>'
+        write(root, 'a.html', 'A2')
+        assert Assert(render('a.html')) == '<p>A1</p>'
+
+        loader.reload_interval = 0
+        assert Assert(render('a.html')) == '<p>A2</p>'
+
+
+@reloading.test
+def watches_changed_templates(root):
+    """The watcher invalidates only the templates that changed"""
+
+    with app_context(root, GENSHI_RELOAD_WATCH=True,
+                     GENSHI_RELOAD_INTERVAL=3600) as app:
+        genshi = app.extensions['genshi']
+        assert Assert(render('a.html')) == '<p>A1</p>'
+        assert Assert(render('b.html')) == '<p>B1</p>'
+        b = genshi.template_loader.load('b.html')
+
+        write(root, 'a.html', 'A2')
+        assert Assert(render('a.html')) == '<p>A1</p>'
+
+        assert Assert(genshi.template_watcher.poll()) == ['a.html']
+        assert Assert(genshi.template_watcher.poll()) == []
+        assert Assert(render('a.html')) == '<p>A2</p>'
+        assert genshi.template_loader.load('b.html') is b
+
+        genshi.template_watcher.stop()
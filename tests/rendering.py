@@ -1,6 +1,7 @@
 from __future__ import with_statement
 from attest import Assert
-from flaskext.genshi import render_response, render
+from flask import current_app
+from flaskext.genshi import render_response, render, render_template
 from tests.utils import flask_tests
 
 
@@ -79,3 +80,72 @@ def renders_svg(context):
 
     assert rendered.mimetype == 'image/svg+xml'
     assert rendered.data == expected_data
+
+
+@rendering.test
+def streams_responses(context):
+    """Responses can be streamed in chunks while they are rendered"""
+
+    expected_data = render_response('test.svg', context).data
+    response = render_response('test.svg', context, stream=True)
+    rendered = Assert(response)
+    chunks = Assert(list(response.response))
+
+    assert rendered.is_streamed
+    assert rendered.mimetype == 'image/svg+xml'
+    assert chunks.__len__() == 1
+    assert ''.join(chunks.obj) == expected_data
+
+    current_app.config['GENSHI_STREAM'] = True
+    current_app.config['GENSHI_STREAM_CHUNK_SIZE'] = 16
+    response = render('test.svg', **context)
+    rendered = Assert(response)
+    chunks = Assert(list(response.response))
+
+    assert rendered.is_streamed
+    assert chunks.__len__() > 1
+    assert ''.join(chunks.obj) == expected_data
+
+
+@rendering.test
+def follows_changes_to_methods(context):
+    """Changes to methods and extensions apply to later renders"""
+
+    genshi = current_app.extensions['genshi']
+    plan = genshi._render_plan('test.html')
+    assert genshi._render_plan('test.html') is plan
+
+    genshi.methods['html']['doctype'] = 'html5'
+    rendered = Assert(render_response('test.html', context))
+    assert rendered.data == '<!DOCTYPE html>\n<body>Hi Rudolf</body>'
+
+    genshi.extensions['html'] = 'xhtml'
+    rendered = Assert(render_response('test.html', context))
+    assert rendered.mimetype == 'application/xhtml+xml'
+
+    genshi.methods = dict(genshi.methods, xhtml={'serializer': 'xml'})
+    rendered = Assert(render_response('test.html', context))
+    assert rendered.mimetype == 'text/html'
+    assert rendered.data == '<body>Hi Rudolf</body>'
+
+
+@rendering.test
+def encodes_output():
+    """Output is encoded with the configured encoding"""
+
+    context = dict(name=u'R\xe5dolf')
+    rendered = Assert(render_response('test.xml', context))
+    assert rendered.headers['Content-Type'] == \
+        'application/xml; charset=utf-8'
+    assert rendered.data == '<name>R\xc3\xa5dolf</name>'
+
+    current_app.config['GENSHI_ENCODING'] = 'iso-8859-1'
+    rendered = Assert(render_response('test.svg', context))
+    assert rendered.headers['Content-Type'] == \
+        'image/svg+xml; charset=iso-8859-1'
+    assert rendered.data.endswith('>Hi R\xe5dolf</text>\n</svg>')
+
+    rendered = Assert(render_template('test.xml', context, encoding='ascii'))
+    assert rendered == '<name>R&#229;dolf</name>'
+    rendered = Assert(render_template('test.txt', context, encoding='ascii'))
+    assert rendered == 'Hi R?dolf\n'
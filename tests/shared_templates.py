@@ -0,0 +1,149 @@
+from __future__ import with_statement
+import os
+
+from attest import Tests, Assert
+from flask import Flask
+from flaskext.genshi import (Genshi, render_template, render_response,
+                             shared_templates)
+
+from tests.utils import template_dir
+
+
+shared = Tests()
+
+
+LAYOUT = '''\
+<html xmlns:py="http://genshi.edgewall.org/" py:strip="">
+  <body py:match="body">${select('*')}<p>$site</p></body>
+</html>'''
+
+PAGE = '''\
+<html xmlns:py="http://genshi.edgewall.org/"
+      xmlns:xi="http://www.w3.org/2001/XInclude">
+  <xi:include href="layout.html"/>
+  <body><h1>$title</h1></body>
+</html>'''
+
+
+@shared.context
+def template_dirs():
+    with template_dir(site_files('a')) as a:
+        with template_dir(site_files('b')) as b:
+            shared_templates.clear()
+            yield [a, b]
+
+
+def site_files(site):
+    return {'templates/layout.html': LAYOUT.replace('$site', site),
+            'templates/page.html': PAGE}
+
+
+def create_apps(genshi, roots, **config):
+    apps = []
+    for root in roots:
+        app = Flask(__name__)
+        app.root_path = root
+        app.config.update(config)
+        genshi.init_app(app)
+        apps.append(app)
+    return apps
+
+
+def render(app):
+    with app.test_request_context():
+        loader = app.extensions['genshi'].template_loader
+        rendered = render_template('page.html', dict(title='Hi'),
+                                   method='xml')
+        return loader, rendered
+
+
+@shared.test
+def has_a_loader_per_app(roots):
+    """Each application has its own template loader"""
+
+    genshi = Genshi()
+    parsed = []
+    genshi.template_parsed(parsed.append)
+    first, second = create_apps(genshi, roots)
+
+    loader, rendered = render(first)
+    assert '<h1>Hi</h1><p>a</p>' in rendered
+    other_loader, other_rendered = render(second)
+    assert '<h1>Hi</h1><p>b</p>' in other_rendered
+    assert loader is not other_loader
+    assert Assert(render(first)) == (loader, rendered)
+    assert Assert(len(parsed)) == 4
+    assert Assert(len(shared_templates)) == 0
+
+
+@shared.test
+def shares_parsed_templates(roots):
+    """Applications can share parsed templates"""
+
+    genshi = Genshi()
+    parsed = []
+    genshi.template_parsed(parsed.append)
+    first, second = create_apps(genshi, [roots[0], roots[0]],
+                                GENSHI_SHARED_TEMPLATES=True)
+
+    loader, rendered = render(first)
+    other_loader, other_rendered = render(second)
+    assert Assert(other_rendered) == rendered
+    assert loader is not other_loader
+    assert Assert(shared_templates.misses) == 2
+    assert Assert(shared_templates.hits) == 2
+
+    template = loader.load('page.html')
+    other_template = other_loader.load('page.html')
+    assert template is not other_template
+    assert other_template.loader is other_loader
+    assert Assert(len(parsed)) == 4
+
+
+@shared.test
+def keeps_caches_per_app(roots):
+    """Each application has its own caches"""
+
+    genshi = Genshi()
+    first, second = create_apps(genshi, roots)
+    second.config['GENSHI_STRING_CACHE_SIZE'] = 5
+
+    responses = []
+    for app in (first, second):
+        with app.test_request_context():
+            response = render_response('page.html', dict(title='Hi'),
+                                       method='xml', fingerprint=1)
+            responses.append((response.data, response.headers['ETag']))
+            assert Assert(genshi.string_cache.capacity) == \
+                   app.config['GENSHI_STRING_CACHE_SIZE']
+
+    assert '<p>a</p>' in responses[0][0]
+    assert '<p>b</p>' in responses[1][0]
+    assert responses[0][1] != responses[1][1]
+
+
+@shared.test
+def stores_templates_as_parsed(roots):
+    """Shared templates are stored as parsed, with their positions"""
+
+    path = os.path.join(roots[0], 'templates', 'fragments.html')
+    with open(path, 'w') as fp:
+        fp.write('<div xmlns:cache="http://packages.python.org/Flask-Genshi/'
+                 'cache">\n  <p cache:fragment="1">first</p>\n'
+                 '  <p cache:fragment="1">second</p>\n</div>')
+
+    genshi = Genshi()
+    apps = create_apps(genshi, [roots[0], roots[0]],
+                       GENSHI_SHARED_TEMPLATES=True,
+                       GENSHI_DROP_POSITIONS=True)
+    for app in apps:
+        with app.test_request_context():
+            rendered = Assert(render_template('fragments.html',
+                                              method='xml'))
+            assert rendered == ('<div>\n  <p>first</p>\n'
+                                '  <p>second</p>\n</div>')
+
+    app, = create_apps(genshi, [roots[0]], GENSHI_SHARED_TEMPLATES=True)
+    with app.test_request_context():
+        template = genshi.template_loader.load('fragments.html')
+        assert Assert(template.stream[0][2][1:]) == (1, 0)
@@ -1,6 +1,7 @@
 from __future__ import with_statement
 
 from attest import Assert
+from flask import current_app
 from flaskext.genshi import render_response
 
 from tests.utils import flask_tests
@@ -25,3 +26,35 @@ def fails_without_template_or_string(context):
 
     with Assert.raises(RuntimeError):
         render_response(context=context, method='text')
+
+
+@strings.test
+def caches_string_templates(context):
+    """Templates rendered from strings are compiled once and cached"""
+
+    cache = current_app.extensions['genshi'].string_cache
+    render_response(string='The name is $name', context=context, method='text')
+    render_response(string='The name is $name', context=context, method='text')
+    render_response(string='<p>The name is $name</p>',
+                    context=context, method='xml')
+
+    assert cache.misses == 2
+    assert cache.hits == 1
+    assert len(cache) == 2
+
+
+@strings.test
+def string_cache_size_is_configurable(context):
+    """The string template cache is bounded by GENSHI_STRING_CACHE_SIZE"""
+
+    app = current_app._get_current_object()
+    app.config['GENSHI_STRING_CACHE_SIZE'] = 1
+    cache = app.extensions['genshi'].string_cache
+    render_response(string='One $name', context=context, method='text')
+    render_response(string='Two $name', context=context, method='text')
+    rendered = Assert(render_response(string='One $name',
+                                      context=context, method='text'))
+
+    assert rendered.data == 'One Rudolf'
+    assert cache.misses == 3
+    assert len(cache) == 1
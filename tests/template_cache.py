@@ -0,0 +1,104 @@
+from attest import Tests, Assert
+from flask import current_app
+from flaskext.genshi import render_template
+
+from tests.utils import flask_tests
+
+
+template_cache = flask_tests()
+
+
+@template_cache.test
+def cache_size_is_configurable():
+    """The number of cached templates is configurable"""
+
+    current_app.config['GENSHI_CACHE_SIZE'] = 2
+    loader = current_app.extensions['genshi'].template_loader
+    for name in ('test.html', 'test.xml', 'test.svg'):
+        loader.load(name)
+
+    assert Assert(len(loader._cache)) == 2
+    stats = loader.cache_stats()
+    assert Assert(stats['test.html']) == dict(hits=0, misses=1, evictions=1,
+                                              size=None)
+
+    loader.load('test.svg')
+    loader.load('test.html')
+    stats = loader.cache_stats()
+    assert Assert(stats['test.svg']['hits']) == 1
+    assert Assert(stats['test.html']['misses']) == 2
+
+
+@template_cache.test
+def evicts_to_stay_within_memory_budget():
+    """Templates are evicted while the cache exceeds its memory budget"""
+
+    loader = current_app.extensions['genshi'].template_loader
+    loader.load('test.html')
+    size = loader.cache_stats()['test.html']['size']
+    assert size is None
+
+    del current_app.extensions['genshi'].template_loader
+    current_app.config['GENSHI_CACHE_MEMORY'] = 1
+    loader = current_app.extensions['genshi'].template_loader
+    loader.load('test.html')
+    size = Assert(loader.cache_stats()['test.html']['size'])
+    assert size > 1000
+
+    loader.load('test.xml')
+    stats = loader.cache_stats()
+    assert Assert(len(loader._cache)) == 1
+    assert Assert(stats['test.html']['evictions']) == 1
+    assert stats['test.html']['size'] is None
+    assert stats['test.xml']['size'] is not None
+
+
+@template_cache.test
+def compacts_templates(context):
+    """Templates share equal strings, names and events when loaded"""
+
+    loader = current_app.extensions['genshi'].template_loader
+    first = loader.load('i18n.html')
+    second = loader.load('jinja_tests_and_filters.html')
+    assert first.stream[0][1][0] is second.stream[0][1][0]
+    assert first.stream[-1] is not second.stream[-1]
+
+    report = loader.memory_report()
+    assert Assert(sorted(report)) == ['i18n.html',
+                                      'jinja_tests_and_filters.html']
+    assert report['i18n.html']['size'] > report['i18n.html']['shared'] > 0
+
+
+@template_cache.test
+def drops_positions(context):
+    """Templates can be loaded without line and column positions"""
+
+    current_app.config['GENSHI_DROP_POSITIONS'] = True
+    template = current_app.extensions['genshi'].template_loader.load(
+        'test.html')
+    assert Assert(set(pos[1:] for kind, data, pos in template.stream)) == \
+           set([(-1, -1)])
+    assert render_template('test.html', context).endswith(
+        '<body>Hi Rudolf</body>')
+
+
+@template_cache.test
+def releases_interned_objects():
+    """Objects interned for templates that left the cache are released"""
+
+    names = ['test.html', 'test.xml', 'test.svg', 'i18n.html',
+             'jinja_tests_and_filters.html', 'context.html', 'filter.html']
+    loader = current_app.extensions['genshi'].template_loader
+    for name in names:
+        loader.load(name)
+    interned = len(loader._interned)
+
+    del current_app.extensions['genshi'].template_loader
+    current_app.config['GENSHI_CACHE_SIZE'] = 2
+    loader = current_app.extensions['genshi'].template_loader
+    for name in names * 2:
+        loader.load(name)
+    for name in names:
+        loader.load(name)
+        assert len(loader._interned) < interned
+    assert Assert(len(loader._cache)) == 2
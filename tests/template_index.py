@@ -0,0 +1,80 @@
+from __future__ import with_statement
+
+import os
+
+from attest import Assert
+from flask import Blueprint
+from genshi.template import TemplateNotFound
+from flaskext.genshi import render_template
+
+from tests import utils
+
+
+template_index = utils.template_tests({
+    'templates/page.html': '<p>app page</p>',
+    'blueprint/views/shared.html': '<p>blueprint shared</p>',
+    'blueprint/views/page.html': '<p>blueprint page</p>',
+    'blueprint/templates/hidden.html': '<p>blueprint hidden</p>'})
+
+
+def write(root, name, text):
+    utils.write_file(root, name, '<p>%s</p>' % text)
+
+
+def app_context(root, **config):
+    blueprint = Blueprint('blueprint', __name__, template_folder='views')
+    blueprint.root_path = os.path.join(root, 'blueprint')
+    return utils.app_context(root, [blueprint], **config)
+
+
+def render(name):
+    return render_template(name, method='xml')
+
+
+@template_index.test
+def finds_blueprint_templates(root):
+    """Templates are found in blueprint template folders after the app's"""
+
+    with app_context(root) as app:
+        assert Assert(render('shared.html')) == '<p>blueprint shared</p>'
+        assert Assert(render('page.html')) == '<p>app page</p>'
+
+        index = app.extensions['genshi'].template_loader.search_path[0]
+        assert Assert(index.names()) == ['page.html', 'shared.html']
+
+
+@template_index.test
+def remembers_missing_templates(root):
+    """Missing templates are remembered until the index is rebuilt"""
+
+    with app_context(root) as app:
+        with Assert.raises(TemplateNotFound):
+            render('new.html')
+        write(root, 'templates/new.html', 'new')
+        with Assert.raises(TemplateNotFound):
+            render('new.html')
+
+        app.extensions['genshi'].template_loader.search_path[0].rebuild()
+        assert Assert(render('new.html')) == '<p>new</p>'
+
+
+@template_index.test
+def looks_for_missing_templates_when_reloading(root):
+    """Missing templates are looked for again when templates are reloaded"""
+
+    with app_context(root, GENSHI_AUTO_RELOAD=True):
+        with Assert.raises(TemplateNotFound):
+            render('new.html')
+        write(root, 'templates/new.html', 'new')
+        assert Assert(render('new.html')) == '<p>new</p>'
+
+
+@template_index.test
+def ignores_other_blueprint_directories(root):
+    """Blueprints only provide templates from their template folder"""
+
+    with app_context(root):
+        with Assert.raises(TemplateNotFound):
+            render('blueprint/hidden.html')
+        with Assert.raises(TemplateNotFound):
+            render('hidden.html')
@@ -0,0 +1,61 @@
+from __future__ import with_statement
+import gc
+
+from attest import Assert
+from flask import current_app
+from flaskext.genshi import (render_template, render_template_async,
+                             render_response_async, stream_template_async)
+
+from tests.utils import flask_tests
+
+
+threaded = flask_tests()
+
+
+@threaded.test
+def renders_in_threads(context):
+    """Templates can be rendered in other threads with the request context"""
+
+    context['rudolf'] = 'The red-nosed reindeer'
+    rendered = Assert(render_template_async('context.html', context).get(5))
+    assert rendered == render_template('context.html', context)
+    assert 'request = &lt;Request' in rendered
+
+    response = Assert(render_response_async('test.txt', context).get(5))
+    assert response.mimetype == 'text/plain'
+    assert response.data == 'Hi Rudolf\n'
+
+
+@threaded.test
+def streams_from_threads(context):
+    """Templates can be streamed from other threads"""
+
+    chunks = stream_template_async('test.svg', context)
+    rendered = Assert(''.join(chunks))
+
+    assert rendered == render_template('test.svg', context)
+
+    chunks = stream_template_async(string='${1 / 0}', method='text')
+    with Assert.raises(ZeroDivisionError):
+        list(chunks)
+
+
+@threaded.test
+def stops_abandoned_streams(context):
+    """Streams that are dropped unread stop rendering"""
+
+    current_app.config['GENSHI_ASYNC_WORKERS'] = 1
+    current_app.config['GENSHI_STREAM_CHUNK_SIZE'] = 1
+    chunks = stream_template_async('test.svg', context, queue_size=1)
+    del chunks
+    gc.collect()
+
+    rendered = Assert(render_template_async('test.txt', context).get(5))
+    assert rendered == 'Hi Rudolf\n'
+
+    chunks = stream_template_async('test.svg', context, queue_size=1)
+    assert render_template('test.svg', context).startswith(chunks.next())
+    chunks.close()
+    assert Assert(list(chunks)) == []
+    rendered = Assert(render_template_async('test.txt', context).get(5))
+    assert rendered == 'Hi Rudolf\n'
@@ -1,5 +1,12 @@
 from __future__ import with_statement
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
 from attest import Tests
+from flask import Flask
+from flaskext.genshi import Genshi
 
 from flask_genshi_testapp import create_app
 
@@ -12,3 +19,46 @@ def flask_tests():
         with app.test_request_context():
             yield dict(name='Rudolf')
     return tests
+
+
+def write_file(root, name, text):
+    path = os.path.join(root, name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fp:
+        fp.write(text)
+
+
+@contextmanager
+def template_dir(files):
+    """A temporary application root holding *files*, a mapping of paths
+    relative to the root to their contents."""
+    path = tempfile.mkdtemp()
+    try:
+        for name, text in files.iteritems():
+            write_file(path, name, text)
+        yield path
+    finally:
+        shutil.rmtree(path)
+
+
+def template_tests(files):
+    """Tests given the path of a :func:`template_dir` holding *files*."""
+    tests = Tests()
+    @tests.context
+    def root():
+        with template_dir(files) as path:
+            yield path
+    return tests
+
+
+@contextmanager
+def app_context(root, blueprints=(), **config):
+    app = Flask(__name__)
+    app.root_path = root
+    app.config.update(config)
+    for blueprint in blueprints:
+        app.register_blueprint(blueprint)
+    Genshi(app)
+    with app.test_request_context():
+        yield app